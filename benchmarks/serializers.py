@@ -0,0 +1,168 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Compares compiled IDObject converters with previous implementation.
+#
+# Usage (from repository root):
+#     python benchmarks/serializers.py [number of pages]
+
+import os
+import sys
+import json
+import timeit
+
+from typing import Any, Dict, Mapping, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "iomirea"))
+
+from db.postgres import IDObject, MESSAGE, CHANNEL  # noqa: E402
+
+
+PAGE_SIZE = 200
+
+
+def legacy_to_json(
+    self: IDObject,
+    record: Mapping[str, Any],
+    *,
+    _embedded: Optional[str] = None,
+) -> Dict[str, Any]:
+    obj: Dict[str, Any] = {}
+
+    for k in self._keys:
+        if _embedded is None:
+            key = k
+        else:
+            key = f"_{_embedded}_{k}"
+
+        value = record[key]
+
+        if (k == "id" or k.endswith("_id")) and value is not None:
+            obj[k] = str(value)
+        else:
+            obj[k] = value
+
+    for e_name, e_cls in self._embedded.items():
+        obj[e_name] = legacy_to_json(e_cls, record, _embedded=e_name)
+
+    return obj
+
+
+def legacy_diff_to_json(
+    self: IDObject, old: Mapping[str, Any], new: Mapping[str, Any]
+) -> Dict[str, Any]:
+    obj: Dict[str, Any] = {}
+
+    modified = False
+
+    for k in self._keys:
+        if old[k] == new[k]:
+            if k not in self._diff_reserved:
+                continue
+        else:
+            if k not in self._diff_ignored:
+                modified = True
+
+        obj[k] = new[k]
+
+    if not modified:
+        return {}
+
+    for e_name, e_cls in self._embedded.items():
+        obj[e_name] = legacy_to_json(e_cls, new, _embedded=e_name)
+
+    return obj
+
+
+def make_message(i: int) -> Dict[str, Any]:
+    return {
+        "id": 570000000000000000 + i,
+        "edit_id": None,
+        "channel_id": 560000000000000000,
+        "content": f"message number {i}",
+        "pinned": False,
+        "type": 0,
+        "_author_id": 550000000000000000 + i % 10,
+        "_author_name": f"user {i % 10}",
+        "_author_bot": False,
+    }
+
+
+def main() -> None:
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    page = [make_message(i) for i in range(PAGE_SIZE)]
+    edited = [dict(m, content="edited", edit_id=1) for m in page]
+
+    old_channel = {
+        "id": 1,
+        "name": "old",
+        "owner_id": 2,
+        "user_ids": [2],
+        "pinned_ids": [],
+    }
+    new_channel = dict(old_channel, name="new")
+
+    # implementations should produce identical output
+    assert [MESSAGE.to_json(r) for r in page] == [
+        legacy_to_json(MESSAGE, r) for r in page
+    ]
+    assert [MESSAGE.diff_to_json(*p) for p in zip(page, edited)] == [
+        legacy_diff_to_json(MESSAGE, *p) for p in zip(page, edited)
+    ]
+    assert json.loads(MESSAGE.list_to_json_bytes(page)) == [
+        MESSAGE.to_json(r) for r in page
+    ]
+    assert CHANNEL.diff_to_json(
+        old_channel, new_channel
+    ) == legacy_diff_to_json(CHANNEL, old_channel, new_channel)
+
+    cases = {
+        "to_json": (
+            lambda: [legacy_to_json(MESSAGE, r) for r in page],
+            lambda: [MESSAGE.to_json(r) for r in page],
+        ),
+        "diff_to_json": (
+            lambda: [
+                legacy_diff_to_json(MESSAGE, *p) for p in zip(page, edited)
+            ],
+            lambda: [MESSAGE.diff_to_json(*p) for p in zip(page, edited)],
+        ),
+        "json bytes": (
+            lambda: json.dumps(
+                [legacy_to_json(MESSAGE, r) for r in page]
+            ).encode(),
+            lambda: MESSAGE.list_to_json_bytes(page),
+        ),
+    }
+
+    print(f"{pages} pages of {PAGE_SIZE} messages")
+
+    for name, (legacy, compiled) in cases.items():
+        legacy_time = timeit.timeit(legacy, number=pages)
+        compiled_time = timeit.timeit(compiled, number=pages)
+
+        print(
+            f"{name:>12}: legacy {legacy_time / pages * 1000:.3f}ms/page, "
+            f"compiled {compiled_time / pages * 1000:.3f}ms/page, "
+            f"x{legacy_time / compiled_time:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
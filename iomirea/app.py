@@ -19,6 +19,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import os
 import asyncio
 import ssl
+import secrets
 
 from typing import Optional
 
@@ -28,7 +29,6 @@ import aiohttp_jinja2
 import aiohttp_remotes
 import aiohttp_session
 
-from aiohttp_session.redis_storage import RedisStorage
 from aiohttp import web
 
 import middlewares
@@ -40,12 +40,25 @@ from routes.websocket import routes as ws_routes
 from routes.auth import routes as auth_routes
 from routes.oauth2 import routes as oauth2_routes
 from routes.misc import routes as misc_routes
+from routes.stats import routes as stats_routes
 
 from models.snowflake import SnowflakeGenerator
 from models.event_emitter import EventEmitter
+from models.cache_invalidator import CacheInvalidator
+from models.access_token import TokenCache, TokenEpochs
+from models.session_storage import CachedRedisStorage
+from models.permissions import PermissionCache
+from models.membership import MembershipCache
+from models.user_cache import UserCache
+from models.recent_messages import RecentMessagesCache
+from models.message_batcher import MessageBatcher
 from log import setup_logging, server_log, AccessLogger
+from security.security_checks import PasswordHasher
+from utils.ratelimit import RateLimiter
 
 from db.postgres import create_postgres_connection, close_postgres_connection
+from db.partitions import MessagePartitionManager
+from db.profiler import QueryProfiler
 from db.redis import create_redis_pool, close_redis_pool
 
 
@@ -70,12 +83,90 @@ async def on_startup(app: web.Application) -> None:
     # support for X-Forwarded headers
     await aiohttp_remotes.setup(app, aiohttp_remotes.XForwardedRelaxed())
 
+    await EventEmitter.setup_emitter(app)
+    await QueryProfiler.setup_profiler(app)
+    await CacheInvalidator.setup_invalidator(app)
+    await PasswordHasher.setup_hasher(app)
+    await MessagePartitionManager.setup_manager(app)
+    await MessageBatcher.setup_batcher(app)
+
+    app["rate_limiter"] = RateLimiter(app["rd_conn"])
+
+    cache_config = app["config"].get("cache", {})
+
     max_cookie_age = 2592000  # 30 days
-    aiohttp_session.setup(
-        app, RedisStorage(app["rd_conn"], max_age=max_cookie_age)
+    session_cache_config = cache_config.get("sessions", {})
+    app["session_storage"] = CachedRedisStorage(
+        app["rd_conn"],
+        app["cache_invalidator"],
+        cache_size=session_cache_config.get("max-size", 10000),
+        cache_ttl=session_cache_config.get("ttl", 60),
+        max_age=max_cookie_age,
     )
+    aiohttp_session.setup(app, app["session_storage"])
 
-    await EventEmitter.setup_emitter(app)
+    token_cache_config = cache_config.get("tokens", {})
+    app["token_cache"] = TokenCache(
+        app["cache_invalidator"],
+        max_size=token_cache_config.get("max-size", 10000),
+        ttl=token_cache_config.get("ttl", 300),
+    )
+
+    permission_cache_config = cache_config.get("permissions", {})
+    app["permission_cache"] = PermissionCache(
+        app["pg_conn"],
+        app["rd_conn"],
+        app["cache_invalidator"],
+        max_size=permission_cache_config.get("max-size", 10000),
+        ttl=permission_cache_config.get("ttl", 60),
+    )
+
+    membership_cache_config = cache_config.get("membership", {})
+    app["membership_cache"] = MembershipCache(
+        app["pg_conn"],
+        app["rd_conn"],
+        app["cache_invalidator"],
+        max_size=membership_cache_config.get("max-size", 10000),
+        ttl=membership_cache_config.get("ttl", 60),
+    )
+
+    user_cache_config = cache_config.get("users", {})
+    app["user_cache"] = UserCache(
+        app["pg_conn"],
+        app["rd_conn"],
+        app["cache_invalidator"],
+        max_size=user_cache_config.get("max-size", 10000),
+        ttl=user_cache_config.get("ttl", 60),
+    )
+
+    recent_messages_config = cache_config.get("recent-messages", {})
+    app["recent_messages"] = RecentMessagesCache(
+        app["pg_conn"],
+        app["rd_conn"],
+        app["cache_invalidator"],
+        app["user_cache"],
+        size=recent_messages_config.get("messages", 200),
+        max_size=recent_messages_config.get("max-size", 1000),
+        ttl=recent_messages_config.get("ttl", 10),
+    )
+
+    app["token_epochs"] = TokenEpochs(
+        app["rd_conn"], app["cache_invalidator"]
+    )
+
+    access_token_config = app["config"].get("access-tokens", {})
+    app["access_token_life_time"] = access_token_config.get("life-time", 3600)
+
+    secret = access_token_config.get("secret")
+    if secret is None:
+        server_log.warn(
+            "Access tokens: secret is not configured, using random one. "
+            "Tokens will not be accepted by other nodes and after restart"
+        )
+
+        app["access_token_secret"] = secrets.token_bytes(32)
+    else:
+        app["access_token_secret"] = secret.encode()
 
 
 async def on_cleanup(app: web.Application) -> None:
@@ -83,7 +174,9 @@ async def on_cleanup(app: web.Application) -> None:
 
 
 if __name__ == "__main__":
-    app = web.Application()
+    app = web.Application(
+        middlewares=[middlewares.rate_limiter, middlewares.db_connection]
+    )
 
     app["args"] = args
 
@@ -128,6 +221,15 @@ if __name__ == "__main__":
 
     app.add_subapp("/api/", APIApp)
 
+    # stats setup
+    if app["args"].with_stats:
+        StatsApp = web.Application()
+        StatsApp.add_routes(stats_routes)
+
+        app.add_subapp("/stats", StatsApp)
+
+        server_log.info("Enabled stats endpoint")
+
     # logging setup
     setup_logging(app)
 
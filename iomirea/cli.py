@@ -47,6 +47,12 @@ argparser.add_argument(
     help="enable static files support by server (works only in debug mode)",
 )
 
+argparser.add_argument(
+    "--with-stats",
+    action="store_true",
+    help="enable internal stats endpoint (should not be exposed publicly)",
+)
+
 argparser.add_argument(
     "-H",
     "--host",
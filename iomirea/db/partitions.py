@@ -0,0 +1,268 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+import time
+import asyncio
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncpg
+
+from aiohttp import web
+
+from log import server_log
+from constants import EPOCH_OFFSET_MS
+from models.snowflake import TIMESTAMP_SHIFT
+
+
+_Month = Tuple[int, int]
+
+
+def snowflake_at(dt: datetime) -> int:
+    """Returns smallest snowflake generated at given time."""
+
+    return (int(dt.timestamp() * 1000) - EPOCH_OFFSET_MS) << TIMESTAMP_SHIFT
+
+
+def add_months(month: _Month, count: int) -> _Month:
+    year, month_number = month
+    index = year * 12 + month_number - 1 + count
+
+    return index // 12, index % 12 + 1
+
+
+def month_start(month: _Month) -> datetime:
+    return datetime(month[0], month[1], 1, tzinfo=timezone.utc)
+
+
+class MessagePartitionManager:
+    """
+    Maintains monthly range partitions of messages table.
+
+    Partitions are bounded by snowflakes generated at the start of months
+    (UTC). Partitions for current and premake next months are created in
+    advance. If retention is set, partitions older than retention months
+    are detached and moved to archive schema, where they can be dumped or
+    dropped by operator.
+
+    Maintenance runs periodically on every node, advisory lock ensures only
+    one node works at the same time.
+    """
+
+    TABLE = "messages"
+    LOCK_ID = 0x6D736770  # "msgp"
+    CHECK_INTERVAL = 3600
+
+    def __init__(
+        self,
+        pg_conn: asyncpg.pool.Pool,
+        *,
+        premake: int = 3,
+        retention: Optional[int] = None,
+        archive_schema: str = "archive",
+    ):
+        self._pg_conn = pg_conn
+
+        self.premake = premake
+        self.retention = retention
+        self.archive_schema = archive_schema
+
+        self._task: Optional[asyncio.Task[None]] = None
+
+        self.created = 0
+        self.detached = 0
+        self.last_run: Optional[float] = None
+
+    @staticmethod
+    async def setup_manager(app: web.Application) -> None:
+        """Creates partition_manager property in application."""
+
+        config = app["config"].get("partitions", {}).get("messages", {})
+
+        manager = MessagePartitionManager(
+            app["pg_conn"],
+            premake=config.get("premake", 3),
+            retention=config.get("retention"),
+            archive_schema=config.get("archive-schema", "archive"),
+        )
+        await manager.start()
+
+        app["partition_manager"] = manager
+        app.on_cleanup.append(manager.close)
+
+    @classmethod
+    def partition_name(cls, month: _Month) -> str:
+        return f"{cls.TABLE}_p{month[0]:04}_{month[1]:02}"
+
+    @classmethod
+    def parse_partition_name(cls, name: str) -> Optional[_Month]:
+        prefix = f"{cls.TABLE}_p"
+        if not name.startswith(prefix):
+            return None
+
+        try:
+            year, month = name[len(prefix) :].split("_")
+
+            return int(year), int(month)
+        except ValueError:
+            return None
+
+    async def start(self) -> None:
+        # first run is awaited, new messages require current partition
+        await self.run()
+
+        self._task = asyncio.create_task(self._run_periodically())
+
+    async def close(self, app: web.Application) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    async def run(self) -> None:
+        """Creates missing partitions and detaches expired ones."""
+
+        now = datetime.now(timezone.utc)
+        current = (now.year, now.month)
+
+        async with self._pg_conn.acquire() as conn:
+            async with conn.transaction():
+                locked = await conn.fetchval(
+                    "SELECT pg_try_advisory_xact_lock($1)", self.LOCK_ID
+                )
+                if not locked:
+                    return
+
+                partitioned = await conn.fetchval(
+                    "SELECT relkind = 'p' FROM pg_class WHERE oid = $1::text::regclass",
+                    self.TABLE,
+                )
+                if not partitioned:
+                    server_log.warn(
+                        f"Partitions: {self.TABLE} table is not partitioned, "
+                        "was migration 011 applied?"
+                    )
+
+                    return
+
+                existing = await self._partitions(conn)
+
+                for i in range(self.premake + 1):
+                    month = add_months(current, i)
+                    if month not in existing:
+                        await self._create(conn, month)
+
+                if self.retention is not None:
+                    oldest = add_months(current, -self.retention)
+
+                    for month in existing:
+                        if month < oldest:
+                            await self._detach(conn, month)
+
+        self.last_run = time.time()
+
+    async def _run_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.CHECK_INTERVAL)
+
+            try:
+                await self.run()
+            except (OSError, asyncpg.PostgresError) as e:
+                server_log.warn(f"Partitions: maintenance failed: {e}")
+
+    async def _partitions(self, conn: asyncpg.Connection) -> List[_Month]:
+        """Returns months of attached monthly partitions."""
+
+        names = await conn.fetch(
+            "SELECT child.relname FROM pg_inherits inh "
+            "INNER JOIN pg_class child ON child.oid = inh.inhrelid "
+            "WHERE inh.inhparent = $1::text::regclass",
+            self.TABLE,
+        )
+
+        months = [self.parse_partition_name(r["relname"]) for r in names]
+
+        return sorted(m for m in months if m is not None)
+
+    async def _create(self, conn: asyncpg.Connection, month: _Month) -> None:
+        name = self.partition_name(month)
+        lower = snowflake_at(month_start(month))
+        upper = snowflake_at(month_start(add_months(month, 1)))
+
+        try:
+            # savepoint, failure should not abort other operations
+            async with conn.transaction():
+                await conn.execute(
+                    f"CREATE TABLE {name} PARTITION OF {self.TABLE} "
+                    f"FOR VALUES FROM ({lower}) TO ({upper})"
+                )
+        except asyncpg.InvalidObjectDefinitionError:
+            # range is covered by other partition (legacy one after migration)
+            return
+        except asyncpg.CheckViolationError:
+            server_log.warn(
+                f"Partitions: unable to create {name}, default partition "
+                "contains rows from its range"
+            )
+
+            return
+
+        server_log.info(f"Partitions: created {name}")
+
+        self.created += 1
+
+    async def _detach(self, conn: asyncpg.Connection, month: _Month) -> None:
+        name = self.partition_name(month)
+
+        try:
+            async with conn.transaction():
+                await conn.execute(
+                    f"ALTER TABLE {self.TABLE} DETACH PARTITION {name}"
+                )
+                await conn.execute(
+                    f"CREATE SCHEMA IF NOT EXISTS {self.archive_schema}"
+                )
+                await conn.execute(
+                    f"ALTER TABLE {name} SET SCHEMA {self.archive_schema}"
+                )
+        except asyncpg.ForeignKeyViolationError:
+            server_log.warn(
+                f"Partitions: unable to detach {name}, its messages are "
+                "referenced by files or read states"
+            )
+
+            return
+
+        server_log.info(
+            f"Partitions: moved {name} to {self.archive_schema} schema"
+        )
+
+        self.detached += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "premake": self.premake,
+            "retention": self.retention,
+            "created": self.created,
+            "detached": self.detached,
+            "last_run": self.last_run,
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} premake={self.premake} retention={self.retention}>"
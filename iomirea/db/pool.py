@@ -0,0 +1,359 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+import time
+import asyncio
+
+from typing import Any, Dict, Generator, Optional, Tuple
+from contextvars import ContextVar
+
+import asyncpg
+
+from asyncpg.pool import PoolConnectionProxy
+
+from log import server_log
+
+
+# route of request being handled, set by db_connection middleware
+current_route: ContextVar[Optional[str]] = ContextVar(
+    "current_route", default=None
+)
+
+
+class _HoldStats:
+    __slots__ = ("acquires", "total_time", "max_time")
+
+    def __init__(self) -> None:
+        self.acquires = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def add(self, hold_time: float) -> None:
+        self.acquires += 1
+        self.total_time += hold_time
+        self.max_time = max(self.max_time, hold_time)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "acquires": self.acquires,
+            "avg_hold_ms": round(
+                self.total_time / (self.acquires or 1) * 1000, 3
+            ),
+            "max_hold_ms": round(self.max_time * 1000, 3),
+        }
+
+
+class InstrumentedPool(asyncpg.pool.Pool):
+    """
+    Pool that records acquire wait time, number of used connections and
+    time connections are held by every route.
+
+    Number of connections used at the same time is limited. In adaptive
+    mode limit starts at min_limit and is adjusted periodically: it grows
+    while average acquire wait time exceeds wait_target and shrinks while
+    waits are short and connections above limit are not used. Pool queue is
+    LIFO, so connections above limit become idle and are closed after
+    max_inactive_connection_lifetime. Otherwise limit is always max_size.
+
+    Note: number of open connections is read from private _holders list,
+    asyncpg 0.18 has no public api for it. asyncpg version is pinned in
+    requirements.
+    """
+
+    ADJUST_INTERVAL = 1
+
+    def __init__(
+        self,
+        *args: Any,
+        adaptive: bool = False,
+        min_limit: int = 1,
+        wait_target: float = 0.01,
+        **kwargs: Any,
+    ):
+        super().__init__(*args, **kwargs)
+
+        self.max_limit: int = kwargs["max_size"]
+        self.min_limit = min(min_limit, self.max_limit)
+
+        self.adaptive = adaptive
+        self.wait_target = wait_target
+
+        self.limit = self.min_limit if adaptive else self.max_limit
+
+        self._slots = asyncio.Condition()
+
+        # maps ids of acquired proxies to acquire time and route
+        self._held: Dict[int, Tuple[float, str]] = {}
+
+        self._route_stats: Dict[str, _HoldStats] = {}
+
+        self._task: Optional[asyncio.Task[None]] = None
+
+        self.in_use = 0
+        self.waiting = 0
+
+        self.acquires = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        # values collected since last limit adjustment
+        self._window_acquires = 0
+        self._window_wait = 0.0
+        self._window_peak = 0
+
+    def start(self) -> None:
+        if self.adaptive:
+            self._task = asyncio.create_task(self._adjust_periodically())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+        await super().close()
+
+    def acquire(self, *, timeout: Optional[float] = None) -> _AcquireContext:
+        """Works like asyncpg Pool.acquire."""
+
+        return _AcquireContext(self, timeout)
+
+    async def _acquire_instrumented(
+        self, timeout: Optional[float]
+    ) -> PoolConnectionProxy:
+        started_at = time.perf_counter()
+
+        self.waiting += 1
+        try:
+            if timeout is None:
+                await self._acquire_slot()
+            else:
+                await asyncio.wait_for(self._acquire_slot(), timeout)
+
+                # rest of timeout is left for pool
+                timeout = max(
+                    timeout - (time.perf_counter() - started_at), 0.001
+                )
+
+            try:
+                proxy = await super().acquire(timeout=timeout)
+            except BaseException:
+                await self._release_slot()
+
+                raise
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+
+            raise
+        finally:
+            self.waiting -= 1
+
+        acquired_at = time.perf_counter()
+        wait_time = acquired_at - started_at
+
+        self.acquires += 1
+        self.total_wait += wait_time
+        self.max_wait = max(self.max_wait, wait_time)
+
+        self._window_acquires += 1
+        self._window_wait += wait_time
+        self._window_peak = max(self._window_peak, self.in_use)
+
+        self._held[id(proxy)] = (
+            acquired_at,
+            current_route.get() or "background",
+        )
+
+        return proxy
+
+    async def release(
+        self,
+        connection: asyncpg.Connection,
+        *,
+        timeout: Optional[float] = None,
+    ) -> None:
+        held = self._held.pop(id(connection), None)
+
+        try:
+            await super().release(connection, timeout=timeout)
+        finally:
+            if held is not None:
+                acquired_at, route = held
+
+                route_stats = self._route_stats.get(route)
+                if route_stats is None:
+                    route_stats = self._route_stats[route] = _HoldStats()
+
+                route_stats.add(time.perf_counter() - acquired_at)
+
+                await self._release_slot()
+
+    async def _acquire_slot(self) -> None:
+        async with self._slots:
+            await self._slots.wait_for(lambda: self.in_use < self.limit)
+
+            self.in_use += 1
+
+    async def _release_slot(self) -> None:
+        async with self._slots:
+            self.in_use -= 1
+
+            self._slots.notify()
+
+    async def _adjust_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.ADJUST_INTERVAL)
+
+            await self.adjust_limit()
+
+    async def adjust_limit(self) -> None:
+        """Changes limit based on waits since last call."""
+
+        avg_wait = self._window_wait / (self._window_acquires or 1)
+        peak = max(self._window_peak, self.in_use)
+
+        self._window_acquires = 0
+        self._window_wait = 0.0
+        self._window_peak = 0
+
+        if avg_wait > self.wait_target or (
+            self.waiting and self.in_use >= self.limit
+        ):
+            if self.limit >= self.max_limit:
+                return
+
+            # grow fast, pool exhaustion hurts more than extra connections
+            new_limit = min(
+                self.limit + max(self.limit // 4, 1), self.max_limit
+            )
+        elif avg_wait < self.wait_target / 2 and peak < self.limit - 1:
+            if self.limit <= self.min_limit:
+                return
+
+            new_limit = self.limit - 1
+        else:
+            return
+
+        server_log.debug(
+            f"Pool: changing limit {self.limit} -> {new_limit}, "
+            f"avg wait {avg_wait * 1000:.3f}ms"
+        )
+
+        async with self._slots:
+            self.limit = new_limit
+
+            self._slots.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        connected = sum(1 for h in self._holders if h._con is not None)
+
+        return {
+            "limit": self.limit,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "adaptive": self.adaptive,
+            "connections": connected,
+            "in_use": self.in_use,
+            "idle": max(connected - self.in_use, 0),
+            "waiting": self.waiting,
+            "acquires": self.acquires,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(
+                self.total_wait / (self.acquires or 1) * 1000, 3
+            ),
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+            "routes": {
+                route: route_stats.stats()
+                for route, route_stats in sorted(self._route_stats.items())
+            },
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} limit={self.limit} in_use={self.in_use} waiting={self.waiting}>"
+
+
+class _AcquireContext:
+    """Works like asyncpg PoolAcquireContext for InstrumentedPool."""
+
+    __slots__ = ("_pool", "_timeout", "_connection")
+
+    def __init__(self, pool: InstrumentedPool, timeout: Optional[float]):
+        self._pool = pool
+        self._timeout = timeout
+
+        self._connection: Optional[PoolConnectionProxy] = None
+
+    async def __aenter__(self) -> PoolConnectionProxy:
+        if self._connection is not None:
+            raise asyncpg.InterfaceError("a connection is already acquired")
+
+        self._connection = await self._pool._acquire_instrumented(
+            self._timeout
+        )
+
+        return self._connection
+
+    async def __aexit__(self, *exc: Any) -> None:
+        connection = self._connection
+        self._connection = None
+
+        assert connection is not None
+
+        await self._pool.release(connection)
+
+    def __await__(self) -> Generator[Any, None, PoolConnectionProxy]:
+        return self._pool._acquire_instrumented(self._timeout).__await__()
+
+
+def create_pool(
+    dsn: Optional[str] = None,
+    *,
+    min_size: int = 10,
+    max_size: int = 10,
+    max_queries: int = 50000,
+    max_inactive_connection_lifetime: float = 300.0,
+    setup: Any = None,
+    init: Any = None,
+    loop: Optional[asyncio.AbstractEventLoop] = None,
+    connection_class: type = asyncpg.Connection,
+    adaptive: bool = False,
+    min_limit: int = 1,
+    wait_target: float = 0.01,
+    **connect_kwargs: Any,
+) -> InstrumentedPool:
+    """
+    Works like asyncpg.create_pool, but creates instrumented pool. Pool
+    should be awaited.
+    """
+
+    return InstrumentedPool(
+        dsn,
+        min_size=min_size,
+        max_size=max_size,
+        max_queries=max_queries,
+        max_inactive_connection_lifetime=max_inactive_connection_lifetime,
+        setup=setup,
+        init=init,
+        loop=loop,
+        connection_class=connection_class,
+        adaptive=adaptive,
+        min_limit=min_limit,
+        wait_target=wait_target,
+        **connect_kwargs,
+    )
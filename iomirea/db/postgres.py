@@ -18,28 +18,106 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
 
-from typing import Dict, Any, Optional, List, Mapping, Tuple, Iterable
+import json
+
+from typing import (
+    Dict,
+    Any,
+    Optional,
+    List,
+    Mapping,
+    Tuple,
+    Iterable,
+    Callable,
+)
 
-import asyncpg
 import aiohttp
 
 from log import server_log
+from db.pool import create_pool
+from db.replicas import ReplicaRouter
+from db.statements import Connection, STATEMENTS
+from utils.singleflight import FLIGHTS
 
 
 async def create_postgres_connection(app: aiohttp.web.Application) -> None:
     server_log.info("Creating postgres connection")
 
-    connection = await asyncpg.create_pool(**app["config"]["postgres"])
+    config = dict(app["config"]["postgres"])
+
+    replicas_config = config.pop("replicas", None) or []
+    window = config.pop("read-your-writes-window", 2000)
+    adaptive_config = config.pop("adaptive-pool", None) or {}
+
+    # statements are registered by db.queries on import
+    connection = await create_pool(
+        **config,
+        connection_class=Connection,
+        init=STATEMENTS.prepare_all,
+        adaptive=adaptive_config.get("enabled", False),
+        min_limit=adaptive_config.get("min-size", 2),
+        wait_target=adaptive_config.get("wait-target", 10) / 1000,
+    )
+    connection.start()
+
+    # replicas inherit missing parameters from primary
+    replicas = [
+        await create_pool(
+            **{**config, **replica_config},
+            connection_class=Connection,
+            init=STATEMENTS.prepare_all,
+        )
+        for replica_config in replicas_config
+    ]
+
+    router = ReplicaRouter(app, connection, replicas, window=window / 1000)
+    await router.start()
 
     app["pg_conn"] = connection
+    app["pg_router"] = router
+    app["statements"] = STATEMENTS
+    app["singleflight"] = FLIGHTS
 
 
 async def close_postgres_connection(app: aiohttp.web.Application) -> None:
     server_log.info("Closing postgres connection")
 
+    await app["pg_router"].close()
+
+    for replica in app["pg_router"].replicas:
+        await replica.close()
+
     await app["pg_conn"].close()
 
 
+_ToJson = Callable[[Mapping[str, Any]], Dict[str, Any]]
+_ToJsonStr = Callable[[Mapping[str, Any]], str]
+_DiffToJson = Callable[[Mapping[str, Any], Mapping[str, Any]], Dict[str, Any]]
+
+
+_encode_json = json.JSONEncoder(
+    ensure_ascii=False, separators=(",", ":")
+).encode
+_encode_json_string = json.encoder.encode_basestring
+
+
+def encode_json_value(value: Any) -> str:
+    """Encodes single value to json. Faster than json.dumps for scalars."""
+
+    cls = value.__class__
+
+    if cls is str:
+        return _encode_json_string(value)
+    if value is None:
+        return "null"
+    if cls is bool:
+        return "true" if value else "false"
+    if cls is int:
+        return int.__repr__(value)
+
+    return _encode_json(value)
+
+
 class IDObject:
     """
     Represents an object from database.
@@ -66,6 +144,16 @@ class IDObject:
         # _diff_reserved. For exaple, message edit snowflake
         self._diff_ignored: Tuple[str, ...] = ()
 
+        # keys that are not stored in object table and are calculated by
+        # view instead
+        self._derived: Tuple[str, ...] = ()
+
+        # specialized converters generated by compile method
+        self._compiled_to_json: Optional[_ToJson] = None
+        self._compiled_diff_to_json: Optional[_DiffToJson] = None
+        self._compiled_to_json_str: Optional[_ToJsonStr] = None
+        self._compiled_update_diff_to_json: Optional[_ToJson] = None
+
     @property
     def keys(self) -> str:
         """
@@ -159,9 +247,88 @@ class IDObject:
             f"RETURNING {self if returning else 1}"
         )
 
-    def to_json(
-        self, record: Mapping[str, Any], *, _embedded: Optional[str] = None
-    ) -> Dict[str, Any]:
+    def update_diff_query_for(
+        self,
+        table_name: str,
+        view_name: str,
+        update_keys: Iterable[str],
+        *,
+        match_keys: Iterable[str] = (),
+    ) -> str:
+        """
+        Generates a postgresql query that locks table row, updates it and
+        returns old and new object in one round trip.
+
+        Row id is the first query parameter, it is followed by values of
+        update_keys and ignored diff keys and then by values of match_keys.
+        Row is updated if any of provided values differ. Embedded and derived
+        keys are taken from view_name, which should contain object keys.
+
+        Query returns new object keys and own keys of old object prefixed
+        with _old_. Unchanged rows are returned with equal old and new
+        values. Nothing is returned (and row is not updated) if row does not
+        exist, does not match match_keys values or is not present in view.
+
+        Example:
+            row = await connection.fetchrow(
+                CHANNEL.update_diff_query_for(
+                    "channels", "channels_with_users", ["name"]
+                ),
+                channel_id,
+                "new funny name",
+            )
+
+            diff = CHANNEL.diff_to_json(row)
+        """
+
+        keys = []
+
+        for key in update_keys:
+            if key not in self._keys or key in self._derived:
+                raise ValueError(f"Unknown key: {key}")
+
+            keys.append(key)
+
+        to_set_keys = keys + list(self._diff_ignored)
+        to_set = ",".join(f"{k}=${i + 2}" for i, k in enumerate(to_set_keys))
+
+        changed = " OR ".join(
+            f"tbl.{k} IS DISTINCT FROM ${i + 2}" for i, k in enumerate(keys)
+        )
+
+        matches = "".join(
+            f" AND {k}=${i + len(to_set_keys) + 2}"
+            for i, k in enumerate(match_keys)
+        )
+
+        own_keys = [k for k in self._keys if k not in self._derived]
+        view_keys = [k for k in self.get_keys() if k not in own_keys]
+
+        columns = [
+            f"CASE WHEN new.id IS NULL THEN old.{k} ELSE new.{k} END AS {k}"
+            for k in own_keys
+        ]
+        columns += [f"extra.{k} AS {k}" for k in view_keys]
+        columns += [f"old.{k} AS _old_{k}" for k in own_keys]
+        columns += [f"extra.{k} AS _old_{k}" for k in self._derived]
+
+        return (
+            f"WITH old AS ("
+            f"SELECT * FROM {table_name} WHERE id=$1{matches} "
+            f"AND id IN (SELECT id FROM {view_name} WHERE id=$1) FOR UPDATE"
+            f"), new AS ("
+            f"UPDATE {table_name} tbl SET {to_set} FROM old "
+            f"WHERE tbl.id=old.id AND ({changed}) RETURNING tbl.*"
+            f"), extra AS ("
+            f"SELECT {','.join(['id', *view_keys])} FROM {view_name} WHERE id=$1"
+            f") "
+            f"SELECT {','.join(columns)} "
+            f"FROM old "
+            f"INNER JOIN extra ON extra.id=old.id "
+            f"LEFT JOIN new ON new.id=old.id"
+        )
+
+    def to_json(self, record: Mapping[str, Any]) -> Dict[str, Any]:
         """
         Converts database record into dictionary managing nested objects.
 
@@ -169,7 +336,6 @@ class IDObject:
 
         Parameters:
             record: object to extract data from.
-            _embedded: internal parameter used for recursion. Do not use it.
 
         Example:
             # str(MESSAGE) tells database which keys to fetch managing all
@@ -183,29 +349,37 @@ class IDObject:
             message = MESSAGE.to_json(record)
         """
 
-        obj: Dict[str, Any] = {}
+        if self._compiled_to_json is None:
+            self.compile()
 
-        for k in self._keys:
-            if _embedded is None:
-                key = k
-            else:
-                key = f"_{_embedded}_{k}"
+        return self._compiled_to_json(record)  # type: ignore
 
-            value = record[key]
+    def to_json_str(self, record: Mapping[str, Any]) -> str:
+        """
+        Encodes database record directly to json string. Result is equal to
+        json encoded to_json output, but intermediate dictionary is not
+        created.
+        """
 
-            # convert all ids to strings
-            if (k == "id" or k.endswith("_id")) and value is not None:
-                obj[k] = str(value)
-            else:
-                obj[k] = value
+        if self._compiled_to_json_str is None:
+            self.compile()
 
-        for e_name, e_cls in self._embedded.items():
-            obj[e_name] = e_cls.to_json(record, _embedded=e_name)
+        return self._compiled_to_json_str(record)  # type: ignore
+
+    def list_to_json_bytes(
+        self, records: Iterable[Mapping[str, Any]]
+    ) -> bytes:
+        """Encodes database records to UTF-8 json array."""
 
-        return obj
+        if self._compiled_to_json_str is None:
+            self.compile()
+
+        return (
+            "[" + ",".join(map(self._compiled_to_json_str, records)) + "]"  # type: ignore
+        ).encode()
 
     def diff_to_json(
-        self, old: Mapping[str, Any], new: Mapping[str, Any]
+        self, old: Mapping[str, Any], new: Optional[Mapping[str, Any]] = None
     ) -> Dict[str, Any]:
         """
         Works similarly to to_json, but returns only different fields between
@@ -216,7 +390,8 @@ class IDObject:
         new mapping.
 
         Parameters:
-            old: old mapping.
+            old: old mapping or row returned by update_diff_query_for query
+                if new mapping is not passed.
             new: new mapping, values are taken from it.
 
         Example:
@@ -241,27 +416,171 @@ class IDObject:
             diff = CHANNEL.diff_to_json(old_row, new_row)
         """
 
-        obj: Dict[str, Any] = {}
+        if self._compiled_diff_to_json is None:
+            self.compile()
 
-        modified = False
+        if new is None:
+            return self._compiled_update_diff_to_json(old)  # type: ignore
 
+        return self._compiled_diff_to_json(old, new)  # type: ignore
+
+    def compile(self) -> None:
+        """
+        Generates to_json, to_json_str and diff_to_json functions specialized
+        for this object: column names, id conversions and embedded objects layout are
+        resolved once instead of on every call.
+
+        Should be called after object keys are final. Singletons are compiled
+        on import.
+        """
+
+        to_json_lines: List[str] = []
+        layout = self._json_layout("", "record", to_json_lines)
+
+        to_json_str_lines: List[str] = []
+        to_json_str_args: List[str] = []
+        template = self._json_str_layout(
+            "", "record", to_json_str_lines, to_json_str_args
+        )
+
+        diff_lines = self._diff_lines("old[{k!r}]")
+
+        # old keys are prefixed in rows of update_diff_query_for queries
+        update_diff_lines = self._diff_lines("new['_old_{k}']")
+
+        source = "\n".join(
+            [
+                "def to_json(record):",
+                *(f"    {line}" for line in to_json_lines),
+                f"    return {layout}",
+                "",
+                "def to_json_str(record):",
+                *(f"    {line}" for line in to_json_str_lines),
+                f"    return {template!r} % ({', '.join(to_json_str_args)},)",
+                "",
+                "def diff_to_json(old, new):",
+                *(f"    {line}" for line in diff_lines),
+                "",
+                "def update_diff_to_json(new):",
+                *(f"    {line}" for line in update_diff_lines),
+            ]
+        )
+
+        namespace: Dict[str, Any] = {"encode": encode_json_value}
+        exec(
+            compile(source, f"<{self.__class__.__name__} converters>", "exec"),
+            namespace,
+        )
+
+        self._compiled_to_json = namespace["to_json"]
+        self._compiled_diff_to_json = namespace["diff_to_json"]
+        self._compiled_to_json_str = namespace["to_json_str"]
+        self._compiled_update_diff_to_json = namespace["update_diff_to_json"]
+
+    def _diff_lines(self, old_getter: str) -> List[str]:
+        """
+        Returns lines of diff function body. Old values are accessed using
+        old_getter template formatted with key, new values are taken from
+        new mapping.
+        """
+
+        lines = ["obj = {}", "modified = False"]
         for k in self._keys:
-            if old[k] == new[k]:
-                if k not in self._diff_reserved:
-                    continue
+            ignored = k in self._diff_ignored
+            old_value = old_getter.format(k=k)
+
+            lines.append(f"value = new[{k!r}]")
+
+            if k in self._diff_reserved:
+                if not ignored:
+                    lines.append(f"if {old_value} != value:")
+                    lines.append("    modified = True")
+
+                lines.append(f"obj[{k!r}] = value")
             else:
-                if k not in self._diff_ignored:
-                    modified = True
+                lines.append(f"if {old_value} != value:")
+                lines.append(f"    obj[{k!r}] = value")
 
-            obj[k] = new[k]
+                if not ignored:
+                    lines.append("    modified = True")
 
-        if not modified:
-            return {}
+        lines.append("if not modified:")
+        lines.append("    return {}")
 
         for e_name, e_cls in self._embedded.items():
-            obj[e_name] = e_cls.to_json(new, _embedded=e_name)
+            e_layout = e_cls._json_layout(f"_{e_name}", "new", lines)
+            lines.append(f"obj[{e_name!r}] = {e_layout}")
+
+        lines.append("return obj")
+
+        return lines
 
-        return obj
+    def _json_layout(
+        self, prefix: str, record_name: str, lines: List[str]
+    ) -> str:
+        """
+        Returns source of dict literal converting record to json. Ids are
+        converted to strings using variables assigned in appended lines.
+        """
+
+        items = []
+
+        for k in self._keys:
+            column = f"{prefix}_{k}" if prefix else k
+            getter = f"{record_name}[{column!r}]"
+
+            # convert all ids to strings
+            if k == "id" or k.endswith("_id"):
+                var = f"v{len(lines)}"
+                lines.append(f"{var} = {getter}")
+
+                items.append(f"{k!r}: None if {var} is None else str({var})")
+            else:
+                items.append(f"{k!r}: {getter}")
+
+        for e_name, e_cls in self._embedded.items():
+            e_layout = e_cls._json_layout(
+                f"{prefix}_{e_name}", record_name, lines
+            )
+            items.append(f"{e_name!r}: {e_layout}")
+
+        return "{" + ", ".join(items) + "}"
+
+    def _json_str_layout(
+        self,
+        prefix: str,
+        record_name: str,
+        lines: List[str],
+        args: List[str],
+    ) -> str:
+        """
+        Returns %-format template of json object. Expressions encoding
+        values are appended to args, id variables are assigned in lines.
+        """
+
+        items = []
+
+        for k in self._keys:
+            column = f"{prefix}_{k}" if prefix else k
+            getter = f"{record_name}[{column!r}]"
+
+            if k == "id" or k.endswith("_id"):
+                var = f"v{len(lines)}"
+                lines.append(f"{var} = {getter}")
+
+                args.append(f"'null' if {var} is None else '\"%s\"' % {var}")
+            else:
+                args.append(f"encode({getter})")
+
+            items.append(f'"{k}":%s')
+
+        for e_name, e_cls in self._embedded.items():
+            e_template = e_cls._json_str_layout(
+                f"{prefix}_{e_name}", record_name, lines, args
+            )
+            items.append(f'"{e_name}":{e_template}')
+
+        return "{" + ",".join(items) + "}"
 
     def __str__(self) -> str:
         """A shortcut for keys property."""
@@ -290,8 +609,11 @@ class Channel(IDObject):
     def __init__(self) -> None:
         super().__init__()
 
+        # user_ids are collected from channel_settings by channels_with_users
+        # view, channels table does not have this column
         self._keys += ("name", "owner_id", "user_ids", "pinned_ids")
         self._diff_reserved += ("owner_id",)
+        self._derived = ("user_ids",)
 
 
 class PlainMessage(IDObject):
@@ -359,3 +681,16 @@ FILE = File()
 BUGREPORT = BugReport()
 PLAIN_APPLICATION = PlainApplication()
 APPLICATION = Application()
+
+for _obj in (
+    USER,
+    SELF_USER,
+    CHANNEL,
+    PLAIN_MESSAGE,
+    MESSAGE,
+    FILE,
+    BUGREPORT,
+    PLAIN_APPLICATION,
+    APPLICATION,
+):
+    _obj.compile()
@@ -0,0 +1,303 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+import re
+import time
+import asyncio
+import functools
+
+from typing import Any, Deque, Dict, List, Optional, Sequence, Set, Tuple
+from collections import deque
+from contextvars import ContextVar
+
+import asyncpg
+
+from aiohttp import web
+
+from log import server_log
+from db.pool import current_route
+
+
+# upper bounds of latency histogram buckets in milliseconds
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf"))
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![\w$])-?\d+(?:\.\d+)?\b")
+_SPACE_RE = re.compile(r"\s+")
+
+# other statements (like DDL) are not explained
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "VALUES", "(")
+
+# only these are executed by EXPLAIN ANALYZE unless flagged as writes
+_ANALYZABLE = ("SELECT", "VALUES", "(")
+
+# set in explain tasks, their queries are not profiled
+_explaining: ContextVar[bool] = ContextVar("explaining", default=False)
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_query(query: str) -> str:
+    """Replaces literals with ? and collapses whitespace."""
+
+    query = _STRING_RE.sub("?", query)
+    query = _NUMBER_RE.sub("?", query)
+
+    return _SPACE_RE.sub(" ", query).strip()
+
+
+class _QueryStats:
+    __slots__ = ("calls", "total_time", "max_time", "buckets")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, duration: float) -> None:
+        self.calls += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+        duration_ms = duration * 1000
+        for i, bound in enumerate(BUCKETS):
+            if duration_ms <= bound:
+                self.buckets[i] += 1
+
+                break
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "avg_ms": round(self.total_time / (self.calls or 1) * 1000, 3),
+            "max_ms": round(self.max_time * 1000, 3),
+            "total_ms": round(self.total_time * 1000, 3),
+            "histogram": {
+                str(bound): count
+                for bound, count in zip(BUCKETS, self.buckets)
+                if count
+            },
+        }
+
+
+class QueryProfiler:
+    """
+    Aggregates query latencies by normalized query and route.
+
+    Queries slower than slow_threshold are sampled. If explain is enabled,
+    sampled query is explained in background on replica (or primary if
+    there are no replicas). Reading queries are explained with EXPLAIN
+    (ANALYZE, BUFFERS) inside read only transaction that is rolled back,
+    writing queries are only planned with EXPLAIN. Every query is explained
+    at most once per explain_interval seconds.
+
+    Profiler is disabled until configured by setup_profiler.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+
+        self.slow_threshold = 0.1
+        self.explain = False
+        self.explain_interval = 60.0
+        self.max_queries = 1000
+
+        self._app: Optional[web.Application] = None
+
+        # maps (normalized query, route) pairs to stats
+        self._queries: Dict[Tuple[str, str], _QueryStats] = {}
+
+        self._slow: Deque[Dict[str, Any]] = deque(maxlen=100)
+
+        # maps normalized queries to time of last explain
+        self._explained_at: Dict[str, float] = {}
+
+        self._tasks: Set[asyncio.Task[None]] = set()
+
+        self.dropped = 0
+
+    @staticmethod
+    async def setup_profiler(app: web.Application) -> None:
+        """
+        Configures global profiler and creates query_profiler property in
+        application.
+        """
+
+        config = app["config"].get("query-profiler", {})
+
+        PROFILER.enabled = config.get("enabled", False)
+        PROFILER.slow_threshold = config.get("slow-threshold", 100) / 1000
+        PROFILER.explain = config.get("explain", False)
+        PROFILER.explain_interval = config.get("explain-interval", 60)
+        PROFILER.max_queries = config.get("max-queries", 1000)
+        PROFILER._slow = deque(maxlen=config.get("max-slow-samples", 100))
+        PROFILER._app = app
+
+        app["query_profiler"] = PROFILER
+        app.on_cleanup.append(PROFILER.close)
+
+    def record(
+        self,
+        query: str,
+        args: Sequence[Any],
+        duration: float,
+        *,
+        writes: bool = False,
+    ) -> None:
+        """
+        Called by connections after every query. Queries that modify data
+        should be flagged with writes, they are not executed by explain.
+        """
+
+        if not self.enabled or _explaining.get():
+            return
+
+        normalized = normalize_query(query)
+        route = current_route.get() or "background"
+
+        key = (normalized, route)
+
+        query_stats = self._queries.get(key)
+        if query_stats is None:
+            if len(self._queries) >= self.max_queries:
+                self.dropped += 1
+
+                return
+
+            query_stats = self._queries[key] = _QueryStats()
+
+        query_stats.add(duration)
+
+        if duration < self.slow_threshold:
+            return
+
+        sample: Dict[str, Any] = {
+            "query": normalized,
+            "route": route,
+            "duration_ms": round(duration * 1000, 3),
+            "time": time.time(),
+            "plan": None,
+        }
+        self._slow.append(sample)
+
+        if not self.explain or self._app is None:
+            return
+
+        upper = normalized.upper()
+        if not upper.startswith(_EXPLAINABLE):
+            return
+
+        now = time.monotonic()
+
+        explained_at = self._explained_at.get(normalized)
+        if (
+            explained_at is not None
+            and now - explained_at < self.explain_interval
+        ):
+            return
+
+        self._explained_at[normalized] = now
+
+        analyze = not writes and upper.startswith(_ANALYZABLE)
+
+        task = asyncio.create_task(self._explain(sample, query, args, analyze))
+
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _explain(
+        self,
+        sample: Dict[str, Any],
+        query: str,
+        args: Sequence[Any],
+        analyze: bool,
+    ) -> None:
+        _explaining.set(True)
+        current_route.set("query_profiler")
+
+        assert self._app is not None
+
+        pool = await self._app["pg_router"].read_pool(None)
+
+        try:
+            async with pool.acquire() as conn:
+                if not analyze:
+                    rows = await conn.fetch(f"EXPLAIN {query}", *args)
+                else:
+                    # functions called by query could still modify data
+                    tr = conn.transaction(readonly=True)
+                    await tr.start()
+
+                    try:
+                        rows = await conn.fetch(
+                            f"EXPLAIN (ANALYZE, BUFFERS) {query}", *args
+                        )
+                    finally:
+                        await tr.rollback()
+        except (OSError, asyncpg.PostgresError) as e:
+            sample["plan"] = f"Unable to explain query: {e}"
+
+            return
+
+        sample["plan"] = "\n".join(r[0] for r in rows)
+
+        server_log.info(
+            f"Query profiler: slow query ({sample['duration_ms']}ms, {sample['route']}): {sample['query']}"
+        )
+
+    async def close(self, app: web.Application) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+    def reset(self) -> None:
+        self._queries.clear()
+        self._slow.clear()
+        self._explained_at.clear()
+
+        self.dropped = 0
+
+    def slow_queries(self) -> List[Dict[str, Any]]:
+        """Returns slow query samples, newest first."""
+
+        return list(reversed(self._slow))
+
+    def stats(self, limit: Optional[int] = None) -> Dict[str, Any]:
+        """Returns stats of queries, sorted by total time."""
+
+        queries = sorted(
+            self._queries.items(), key=lambda i: i[1].total_time, reverse=True
+        )
+
+        return {
+            "enabled": self.enabled,
+            "slow_threshold_ms": self.slow_threshold * 1000,
+            "dropped": self.dropped,
+            "queries": [
+                {"query": query, "route": route, **query_stats.stats()}
+                for (query, route), query_stats in queries[:limit]
+            ],
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} enabled={self.enabled} queries={len(self._queries)}>"
+
+
+# used by db.statements connections
+PROFILER = QueryProfiler()
@@ -0,0 +1,207 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Named statements prepared on every pool connection.
+# Queries with dynamic structure (updates, ensure_existance) are not here.
+# Shared statements are deduplicated when executed using pool, they are
+# used by hot read endpoints. Statements calling data modifying functions
+# are flagged with writes.
+
+from db.postgres import (
+    USER,
+    SELF_USER,
+    CHANNEL,
+    PLAIN_MESSAGE,
+    MESSAGE,
+    FILE,
+    BUGREPORT,
+)
+from db.statements import register_statement
+
+
+# users
+GET_USERS = register_statement(
+    "get_users", f"SELECT {USER} FROM users WHERE id = ANY($1)"
+)
+GET_SELF_USER = register_statement(
+    "get_self_user", f"SELECT {SELF_USER} FROM users WHERE id = $1"
+)
+GET_USER_CHANNEL_IDS = register_statement(
+    "get_user_channel_ids",
+    "SELECT ARRAY(SELECT channel_id FROM channel_settings WHERE user_id = $1)",
+)
+GET_PERMISSIONS = register_statement(
+    "get_permissions",
+    "SELECT permissions FROM channel_settings WHERE user_id = $1 AND channel_id = $2",
+)
+# user, refresh token (if any) and permissions in channel (if any)
+GET_PRINCIPAL = register_statement(
+    "get_principal",
+    "SELECT usr.password, tok.scope, tok.app_id, cs.permissions, "
+    "ARRAY(SELECT channel_id FROM channel_settings WHERE user_id = usr.id) AS channel_ids "
+    "FROM users usr "
+    "LEFT JOIN tokens tok "
+    "ON tok.user_id = usr.id AND tok.hmac_component = $2 "
+    "LEFT JOIN channel_settings cs "
+    "ON cs.user_id = usr.id AND cs.channel_id = $3 "
+    "WHERE usr.id = $1",
+)
+
+# tokens
+VERIFY_TOKEN = register_statement(
+    "verify_token",
+    "SELECT usr.password, tok.scope, tok.app_id "
+    "FROM users usr "
+    "LEFT JOIN tokens tok "
+    "ON tok.user_id = usr.id AND tok.hmac_component = $2 "
+    "WHERE usr.id = $1",
+)
+GET_TOKEN = register_statement(
+    "get_token",
+    "SELECT (scope, app_id) FROM tokens WHERE hmac_component = $1 AND user_id = $2",
+)
+INSERT_TOKEN = register_statement(
+    "insert_token",
+    "INSERT INTO tokens (hmac_component, user_id, app_id, create_offset, scope) "
+    "VALUES ($1, $2, $3, $4, $5)",
+)
+DELETE_TOKEN = register_statement(
+    "delete_token",
+    "DELETE FROM tokens WHERE user_id = $1 AND hmac_component = $2",
+)
+
+# channels
+CREATE_CHANNEL = register_statement(
+    "create_channel",
+    f"SELECT {CHANNEL} FROM create_channel($1, $2, $3, $4)",
+    writes=True,
+)
+GET_CHANNEL = register_statement(
+    "get_channel",
+    f"SELECT {CHANNEL} FROM channels_with_users WHERE id = $1",
+    shared=True,
+)
+GET_CHANNELS = register_statement(
+    "get_channels",
+    f"SELECT {CHANNEL} FROM channels_with_users WHERE id = ANY($1)",
+)
+ADD_CHANNEL_USER = register_statement(
+    "add_channel_user",
+    "SELECT * FROM add_channel_user($1, $2)",
+    writes=True,
+)
+REMOVE_CHANNEL_USER = register_statement(
+    "remove_channel_user",
+    "SELECT * FROM remove_channel_user($1, $2)",
+    writes=True,
+)
+GET_PIN_IDS = register_statement(
+    "get_pin_ids",
+    "SELECT pinned_ids FROM channels WHERE id = $1",
+    shared=True,
+)
+ADD_CHANNEL_PIN = register_statement(
+    "add_channel_pin",
+    "SELECT * FROM add_channel_pin($1, $2)",
+    writes=True,
+)
+REMOVE_CHANNEL_PIN = register_statement(
+    "remove_channel_pin",
+    "SELECT * FROM remove_channel_pin($1, $2)",
+    writes=True,
+)
+
+# messages
+CREATE_MESSAGE = register_statement(
+    "create_message",
+    f"SELECT {MESSAGE} FROM create_message($1, $2, $3, $4, type:=$5)",
+    writes=True,
+)
+# multi row variant of create_message used by message batcher. Inserted rows
+# are not visible to the rest of statement, author is joined to returned rows.
+# create_message function only inserts row and selects it with author, keep
+# them in sync
+CREATE_MESSAGES = register_statement(
+    "create_messages",
+    "WITH msg AS ("
+    "INSERT INTO messages (id, channel_id, author_id, content, type) "
+    "SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[], $3::BIGINT[], $4::TEXT[], $5::SMALLINT[]) "
+    "RETURNING id, edit_id, channel_id, author_id, content, pinned, type"
+    ") "
+    f"SELECT {MESSAGE} FROM ("
+    "SELECT msg.*, usr.id AS _author_id, usr.name AS _author_name, usr.bot AS _author_bot "
+    "FROM msg INNER JOIN users usr ON usr.id = msg.author_id"
+    ") created",
+)
+# message reads below select plain messages, authors are embedded from
+# user cache
+GET_CHANNEL_MESSAGE = register_statement(
+    "get_channel_message",
+    f"SELECT {PLAIN_MESSAGE} FROM existing_messages WHERE channel_id = $1 AND id = $2",
+)
+GET_MESSAGES = register_statement(
+    "get_messages",
+    f"SELECT {PLAIN_MESSAGE} FROM existing_messages WHERE id = ANY($1)",
+    shared=True,
+)
+# message history pages, all use messages_channel_id_index. Pages are
+# ordered from newest to oldest except for GET_MESSAGES_AFTER, which
+# selects oldest messages after cursor
+GET_LATEST_MESSAGES = register_statement(
+    "get_latest_messages",
+    f"SELECT {PLAIN_MESSAGE} FROM existing_messages WHERE channel_id = $1 "
+    "ORDER BY id DESC LIMIT $2",
+)
+GET_MESSAGES_BEFORE = register_statement(
+    "get_messages_before",
+    f"SELECT {PLAIN_MESSAGE} FROM existing_messages WHERE channel_id = $1 AND id < $2 "
+    "ORDER BY id DESC LIMIT $3",
+)
+GET_MESSAGES_AFTER = register_statement(
+    "get_messages_after",
+    f"SELECT {PLAIN_MESSAGE} FROM existing_messages WHERE channel_id = $1 AND id > $2 "
+    "ORDER BY id LIMIT $3",
+)
+GET_MESSAGES_AROUND = register_statement(
+    "get_messages_around",
+    f"(SELECT {PLAIN_MESSAGE} FROM existing_messages WHERE channel_id = $1 AND id >= $2 "
+    "ORDER BY id LIMIT $3) "
+    "UNION ALL "
+    f"(SELECT {PLAIN_MESSAGE} FROM existing_messages WHERE channel_id = $1 AND id < $2 "
+    "ORDER BY id DESC LIMIT $4) "
+    "ORDER BY id DESC",
+)
+DELETE_MESSAGE = register_statement(
+    "delete_message", "SELECT FROM delete_message($1, $2)", writes=True
+)
+
+# files
+GET_FILE = register_statement(
+    "get_file", f"SELECT {FILE} FROM files WHERE id = $1"
+)
+
+# bugreports
+CREATE_BUGREPORT = register_statement(
+    "create_bugreport",
+    "INSERT INTO bugreports (user_id, report_body, device_info, automatic) "
+    f"VALUES ($1, $2, $3, $4) RETURNING {BUGREPORT}",
+)
+GET_BUGREPORTS = register_statement(
+    "get_bugreports",
+    f"SELECT {BUGREPORT} FROM bugreports ORDER BY id LIMIT $1 OFFSET $2",
+)
@@ -1,4 +1,7 @@
+import hashlib
+
 from copy import copy
+from typing import Any, Dict, Sequence
 
 import aioredis
 
@@ -16,6 +19,9 @@ async def create_redis_pool(app: web.Application) -> None:
 
     pool = await aioredis.create_pool((host, port), **config)
 
+    for script in SCRIPTS.values():
+        await script.load(pool)
+
     app["rd_conn"] = pool
 
 
@@ -26,5 +32,65 @@ async def close_redis_pool(app: web.Application) -> None:
     await app["rd_conn"].wait_closed()
 
 
-with open("redis_scripts/remove_expired_cookies.lua") as f:
-    REMOVE_EXPIRED_COOKIES = f.read()
+class Script:
+    """
+    Lua script stored in redis_scripts folder.
+
+    Script is loaded into redis once and called using EVALSHA. If redis
+    script cache was flushed, script is loaded again.
+    """
+
+    __slots__ = ("name", "source", "sha")
+
+    def __init__(self, name: str):
+        self.name = name
+
+        with open(f"redis_scripts/{name}.lua") as f:
+            self.source = f.read()
+
+        self.sha = hashlib.sha1(self.source.encode()).hexdigest()
+
+    async def load(self, conn: aioredis.ConnectionsPool) -> None:
+        await conn.execute("SCRIPT", "LOAD", self.source)
+
+    async def __call__(
+        self,
+        conn: aioredis.ConnectionsPool,
+        keys: Sequence[Any] = (),
+        args: Sequence[Any] = (),
+    ) -> Any:
+        try:
+            return await conn.execute(
+                "EVALSHA", self.sha, len(keys), *keys, *args
+            )
+        except aioredis.ReplyError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+
+        await self.load(conn)
+
+        return await conn.execute("EVALSHA", self.sha, len(keys), *keys, *args)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} name={self.name} sha={self.sha}>"
+
+
+# maps script names to scripts, all of them are loaded on startup
+SCRIPTS: Dict[str, Script] = {}
+
+
+def register_script(name: str) -> Script:
+    script = Script(name)
+    SCRIPTS[name] = script
+
+    return script
+
+
+ADD_SESSION = register_script("add_session")
+CLEAR_SESSIONS = register_script("clear_sessions")
+MEMBERSHIP_POPULATE = register_script("membership_populate")
+PERMISSIONS_POPULATE = register_script("permissions_populate")
+RATE_LIMIT = register_script("rate_limit")
+RECENT_MESSAGES_POPULATE = register_script("recent_messages_populate")
+RECENT_MESSAGES_WRITE = register_script("recent_messages_write")
+USER_PROFILES_POPULATE = register_script("user_profiles_populate")
@@ -0,0 +1,238 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+import asyncio
+
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+import asyncpg
+
+from aiohttp import web
+
+from log import server_log
+from utils.cache import LRUCache
+
+
+def parse_lsn(lsn: str) -> int:
+    """Converts textual WAL location (like 16/B374D848) to integer."""
+
+    high, low = lsn.split("/")
+
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+class ReplicaRouter:
+    """
+    Routes read only queries to replica pools.
+
+    After user writes to primary, WAL location of the write is remembered
+    for read-your-writes window. During this window reads of user go to
+    replicas that already replayed this location or to primary if there
+    are none. Write locations are stored in redis to be visible to other
+    nodes. Without replicas writes are only remembered in process, reads of
+    users with recent writes are not shared (see utils.db.shared_query).
+    Missing writes are cached for NEGATIVE_TTL seconds, so writes from other
+    nodes are noticed with this delay.
+
+    Replay locations of replicas are polled in background. Replicas that
+    fail to respond are not used until next successful poll.
+    """
+
+    POLL_INTERVAL = 0.5
+    POLL_TIMEOUT = 2
+
+    NEGATIVE_TTL = 0.1
+
+    def __init__(
+        self,
+        app: web.Application,
+        primary: asyncpg.pool.Pool,
+        replicas: List[asyncpg.pool.Pool],
+        *,
+        window: float = 2,
+    ):
+        self._app = app
+
+        self.primary = primary
+        self.replicas = replicas
+
+        self.window = window
+
+        # replay locations of replicas, None for unavailable ones
+        self._replayed: List[Optional[int]] = [None] * len(replicas)
+
+        # used for round robin
+        self._next_replica = 0
+
+        # maps user ids to locations of their recent writes
+        self._writes: LRUCache[int, int] = LRUCache(ttl=window)
+
+        # ids of users without recent writes
+        self._no_writes: LRUCache[int, bool] = LRUCache(ttl=self.NEGATIVE_TTL)
+
+        self._task: Optional[asyncio.Task[None]] = None
+
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.writes = 0
+
+    @staticmethod
+    def redis_key(user_id: int) -> str:
+        return f"last_write_lsn:{user_id}"
+
+    async def start(self) -> None:
+        if self.replicas:
+            self._task = asyncio.create_task(self._poll())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    async def read_pool(self, user_id: Optional[int]) -> asyncpg.pool.Pool:
+        """Returns pool for read only queries of user."""
+
+        if not self.replicas:
+            return self.primary
+
+        min_lsn = None
+        if user_id is not None:
+            min_lsn = await self._last_write(user_id)
+
+        for _ in range(len(self.replicas)):
+            i = self._next_replica
+            self._next_replica = (i + 1) % len(self.replicas)
+
+            replayed = self._replayed[i]
+            if replayed is None:
+                continue
+
+            if min_lsn is None or replayed >= min_lsn:
+                self.replica_reads += 1
+
+                return self.replicas[i]
+
+        self.primary_reads += 1
+
+        return self.primary
+
+    async def mark_writes(
+        self,
+        user_ids: Iterable[int],
+        conn: Union[asyncpg.Connection, asyncpg.pool.Pool],
+    ) -> None:
+        """
+        Remembers current WAL location of primary as last write of users.
+        Connection should belong to primary pool or be primary pool.
+        """
+
+        if not self.replicas:
+            # location is only compared with replay locations of replicas
+            for user_id in user_ids:
+                self._writes.set(user_id, 0)
+                self._no_writes.delete(user_id)
+
+                self.writes += 1
+
+            return
+
+        lsn = parse_lsn(
+            await conn.fetchval("SELECT pg_current_wal_lsn()::text")
+        )
+
+        for user_id in user_ids:
+            self._writes.set(user_id, lsn)
+            self._no_writes.delete(user_id)
+
+            await self._app["rd_conn"].execute(
+                "SET",
+                self.redis_key(user_id),
+                lsn,
+                "PX",
+                int(self.window * 1000),
+            )
+
+            self.writes += 1
+
+    async def has_recent_write(self, user_id: int) -> bool:
+        """Returns True if user wrote during read-your-writes window."""
+
+        return await self._last_write(user_id) is not None
+
+    async def _last_write(self, user_id: int) -> Optional[int]:
+        lsn = self._writes.get(user_id)
+        if lsn is not None:
+            return lsn
+
+        if not self.replicas or self._no_writes.get(user_id):
+            return None
+
+        # write could have happened on other node
+        stored = await self._app["rd_conn"].execute(
+            "GET", self.redis_key(user_id)
+        )
+        if stored is None:
+            self._no_writes.set(user_id, True)
+
+            return None
+
+        return int(stored)
+
+    async def _poll(self) -> None:
+        while True:
+            for i, pool in enumerate(self.replicas):
+                try:
+                    replayed = await asyncio.wait_for(
+                        pool.fetchval("SELECT pg_last_wal_replay_lsn()::text"),
+                        self.POLL_TIMEOUT,
+                    )
+                except (
+                    OSError,
+                    asyncio.TimeoutError,
+                    asyncpg.PostgresError,
+                ) as e:
+                    if self._replayed[i] is not None:
+                        server_log.warn(f"Replica {i} is unavailable: {e}")
+
+                    self._replayed[i] = None
+
+                    continue
+
+                if replayed is None:
+                    if self._replayed[i] is not None:
+                        server_log.warn(f"Replica {i} is not in recovery")
+
+                    self._replayed[i] = None
+                else:
+                    self._replayed[i] = parse_lsn(replayed)
+
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "replicas": len(self.replicas),
+            "available": sum(r is not None for r in self._replayed),
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+            "writes": self.writes,
+            "pools": [replica.stats() for replica in self.replicas],
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} replicas={len(self.replicas)} window={self.window}>"
@@ -0,0 +1,324 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import asyncpg
+
+from asyncpg.cursor import CursorFactory
+from asyncpg.prepared_stmt import PreparedStatement
+
+from db.profiler import PROFILER
+from utils.singleflight import FLIGHTS, make_key
+
+
+# queries starting with these keywords modify data
+_WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE", "WITH")
+
+
+def is_write(query: str) -> bool:
+    """Returns True if query modifies data (judging by its first keyword)."""
+
+    return query.lstrip()[:6].upper().startswith(_WRITE_PREFIXES)
+
+
+class Connection(asyncpg.Connection):
+    """
+    Connection holding statements prepared by pool init hook. Queries are
+    reported to query profiler.
+
+    Connection remembers if it modified data, see take_writes.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+
+        # maps statement names to prepared statements
+        self.prepared: Dict[str, PreparedStatement] = {}
+
+        self.wrote = False
+
+    def mark_write(self) -> None:
+        self.wrote = True
+
+    def take_writes(self) -> bool:
+        """
+        Returns True if connection modified data since previous call. Writes
+        are detected by query text and by statements flagged as writing.
+        """
+
+        wrote = self.wrote
+        self.wrote = False
+
+        return wrote
+
+    def _record(
+        self, query: str, args: Sequence[Any], started_at: float
+    ) -> None:
+        writes = is_write(query)
+        if writes:
+            self.wrote = True
+
+        PROFILER.record(
+            query, args, time.perf_counter() - started_at, writes=writes
+        )
+
+    async def execute(
+        self, query: str, *args: Any, timeout: Optional[float] = None
+    ) -> str:
+        started_at = time.perf_counter()
+        try:
+            return await super().execute(query, *args, timeout=timeout)
+        finally:
+            self._record(query, args, started_at)
+
+    async def fetch(
+        self, query: str, *args: Any, timeout: Optional[float] = None
+    ) -> List[asyncpg.Record]:
+        started_at = time.perf_counter()
+        try:
+            return await super().fetch(query, *args, timeout=timeout)
+        finally:
+            self._record(query, args, started_at)
+
+    async def fetchrow(
+        self, query: str, *args: Any, timeout: Optional[float] = None
+    ) -> Optional[asyncpg.Record]:
+        started_at = time.perf_counter()
+        try:
+            return await super().fetchrow(query, *args, timeout=timeout)
+        finally:
+            self._record(query, args, started_at)
+
+    async def fetchval(
+        self,
+        query: str,
+        *args: Any,
+        column: int = 0,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        started_at = time.perf_counter()
+        try:
+            return await super().fetchval(
+                query, *args, column=column, timeout=timeout
+            )
+        finally:
+            self._record(query, args, started_at)
+
+
+_Executor = Union[asyncpg.pool.Pool, asyncpg.Connection]
+
+
+class Statement:
+    """
+    Named SQL statement prepared on every pool connection.
+
+    Statement can be executed using pool or connection. Connections not
+    created by pool (or created before statement was registered) prepare
+    statement on first use.
+
+    Concurrent executions of shared statements using the same pool and
+    arguments are done once and share result. Shared result can predate
+    writes committed while it was fetched, only statements tolerating this
+    should be shared.
+
+    Statements modifying data should be flagged with writes unless they
+    start with data modifying keyword (like INSERT).
+    """
+
+    __slots__ = (
+        "name",
+        "query",
+        "shared",
+        "writes",
+        "calls",
+        "errors",
+        "total_time",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        query: str,
+        *,
+        shared: bool = False,
+        writes: bool = False,
+    ):
+        self.name = name
+        self.query = query
+        self.shared = shared
+        self.writes = writes or is_write(query)
+
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+    async def prepare(self, conn: asyncpg.Connection) -> PreparedStatement:
+        prepared = await conn.prepare(self.query)
+
+        # not all connections are able to store statements
+        if isinstance(getattr(conn, "prepared", None), dict):
+            conn.prepared[self.name] = prepared
+
+        return prepared
+
+    async def _get_prepared(
+        self, conn: asyncpg.Connection
+    ) -> PreparedStatement:
+        try:
+            return conn.prepared[self.name]
+        except (AttributeError, KeyError):
+            return await self.prepare(conn)
+
+    async def _run(self, conn: _Executor, method: str, *args: Any) -> Any:
+        if isinstance(conn, asyncpg.pool.Pool):
+            if self.shared:
+                key = make_key(self.name, method, id(conn), *args)
+                if key is not None:
+                    return await FLIGHTS.do(
+                        key, lambda: self._run_acquired(conn, method, *args)
+                    )
+
+            return await self._run_acquired(conn, method, *args)
+
+        prepared = await self._get_prepared(conn)
+
+        # not all connections track writes
+        if self.writes and hasattr(conn, "mark_write"):
+            conn.mark_write()
+
+        started_at = time.perf_counter()
+        try:
+            try:
+                return await getattr(prepared, method)(*args)
+            except asyncpg.exceptions.InvalidCachedStatementError:
+                # schema was changed, statement should be prepared again
+                prepared = await self.prepare(conn)
+
+                return await getattr(prepared, method)(*args)
+        except Exception:
+            self.errors += 1
+
+            raise
+        finally:
+            duration = time.perf_counter() - started_at
+
+            self.calls += 1
+            self.total_time += duration
+
+            PROFILER.record(self.query, args, duration, writes=self.writes)
+
+    async def _run_acquired(
+        self, pool: asyncpg.pool.Pool, method: str, *args: Any
+    ) -> Any:
+        async with pool.acquire() as acquired:
+            return await self._run(acquired, method, *args)
+
+    async def fetch(self, conn: _Executor, *args: Any) -> Any:
+        return await self._run(conn, "fetch", *args)
+
+    async def fetchrow(self, conn: _Executor, *args: Any) -> Any:
+        return await self._run(conn, "fetchrow", *args)
+
+    async def fetchval(self, conn: _Executor, *args: Any) -> Any:
+        return await self._run(conn, "fetchval", *args)
+
+    async def cursor(
+        self, conn: asyncpg.Connection, *args: Any
+    ) -> CursorFactory:
+        """Returns cursor factory. Should be used inside transaction."""
+
+        prepared = await self._get_prepared(conn)
+        self.calls += 1
+
+        return prepared.cursor(*args)
+
+    def stats(self) -> Dict[str, Any]:
+        calls = self.calls or 1
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_ms": round(self.total_time / calls * 1000, 3),
+            "total_ms": round(self.total_time * 1000, 3),
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} name={self.name} calls={self.calls}>"
+
+
+class StatementRegistry:
+    """
+    Named statements prepared eagerly on every pool connection. If any of
+    statements does not compile against schema, pool creation fails.
+    """
+
+    def __init__(self) -> None:
+        # maps statement names to statements
+        self._statements: Dict[str, Statement] = {}
+
+    def register(
+        self,
+        name: str,
+        query: str,
+        *,
+        shared: bool = False,
+        writes: bool = False,
+    ) -> Statement:
+        if name in self._statements:
+            raise ValueError(f"Statement {name} is already registered")
+
+        statement = Statement(name, query, shared=shared, writes=writes)
+        self._statements[name] = statement
+
+        return statement
+
+    async def prepare_all(self, conn: asyncpg.Connection) -> None:
+        """Pool init hook."""
+
+        for statement in self._statements.values():
+            try:
+                await statement.prepare(conn)
+            except asyncpg.PostgresError as e:
+                raise RuntimeError(
+                    f"Unable to prepare statement {statement.name}: {e}"
+                ) from e
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            name: statement.stats()
+            for name, statement in self._statements.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self._statements)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} statements={len(self)}>"
+
+
+# statements are defined in db.queries
+STATEMENTS = StatementRegistry()
+
+
+def register_statement(
+    name: str, query: str, *, shared: bool = False, writes: bool = False
+) -> Statement:
+    return STATEMENTS.register(name, query, shared=shared, writes=writes)
@@ -20,12 +20,15 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
 import binascii
 
-from typing import Callable, Awaitable
+from typing import Callable, Awaitable, Dict
 from aiohttp import web
 
 from log import server_log
 from models import converters
 from models.access_token import Token
+from db.pool import current_route
+from utils.db import release_connection
+from utils import ratelimit
 
 HandlerType = Callable[[web.Request], Awaitable[web.Response]]
 
@@ -93,3 +96,72 @@ async def match_info_validator(
             raise web.HTTPNotFound
 
     return await handler(req)
+
+
+@web.middleware
+async def rate_limiter(
+    req: web.Request, handler: HandlerType
+) -> web.Response:
+    limits = getattr(req.match_info.handler, "rate_limits", None)
+    if not limits:
+        return await handler(req)
+
+    user_limits = []
+
+    for limit in limits:
+        if limit.by == "token":
+            # user is not known yet, enforced by ratelimit.hit_user_limits
+            user_limits.append(limit)
+
+            continue
+
+        result = await req.config_dict["rate_limiter"].hit(req, limit)
+
+        if not result.allowed:
+            return ratelimit.limited_response(result)
+
+        ratelimit.report(req, result)
+
+    req["user_rate_limits"] = user_limits
+
+    try:
+        response = await handler(req)
+    except web.HTTPException as e:
+        e.headers.update(_rate_limit_headers(req))
+
+        raise
+
+    response.headers.update(_rate_limit_headers(req))
+
+    return response
+
+
+@web.middleware
+async def db_connection(
+    req: web.Request, handler: HandlerType
+) -> web.Response:
+    """
+    Releases request connection acquired with utils.db.connection. Sets
+    route used in pool statistics.
+    """
+
+    resource = req.match_info.route.resource
+    token = current_route.set(
+        f"{req.method} {'unknown' if resource is None else resource.canonical}"
+    )
+
+    try:
+        return await handler(req)
+    finally:
+        await release_connection(req)
+
+        current_route.reset(token)
+
+
+def _rate_limit_headers(req: web.Request) -> Dict[str, str]:
+    # the most restrictive limit is reported in headers
+    reported = req.get("rate_limit")
+    if reported is None:  # token limits, token was not verified
+        return {}
+
+    return ratelimit.rate_limit_headers(reported)
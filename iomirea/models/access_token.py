@@ -23,11 +23,84 @@ import codecs
 import base64
 import binascii
 
-from typing import List, Optional
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import asyncpg
+import aioredis
 
+from db import queries
 from constants import EPOCH_OFFSET
+from utils.cache import LRUCache
+from models.cache_invalidator import CacheInvalidator
+
+
+class TokenCache:
+    """
+    In-process cache of verified tokens shared by REST and gateway.
+
+    Maps (user_id, hmac_component) pairs to token scope and application id.
+    Invalidations are delivered to all nodes using CacheInvalidator.
+    """
+
+    NAME = "tokens"
+
+    def __init__(
+        self,
+        invalidator: CacheInvalidator,
+        *,
+        max_size: int = 10000,
+        ttl: float = 300,
+    ):
+        self._cache: LRUCache[
+            Tuple[int, str], Tuple[List[str], int]
+        ] = LRUCache(max_size=max_size, ttl=ttl)
+
+        self._invalidator = invalidator
+        self._invalidator.register(self.NAME, self._invalidate_local)
+
+    def get(
+        self, user_id: int, hmac_component: str
+    ) -> Optional[Tuple[List[str], int]]:
+        """Returns (scope, app_id) pair of verified token if cached."""
+
+        return self._cache.get((user_id, hmac_component))
+
+    def set(
+        self, user_id: int, hmac_component: str, scope: List[str], app_id: int
+    ) -> None:
+        self._cache.set((user_id, hmac_component), (scope, app_id))
+
+    async def invalidate(
+        self, user_id: int, hmac_component: Optional[str] = None
+    ) -> None:
+        """
+        Removes token from cache on all nodes. If hmac_component is not
+        passed, removes all user tokens.
+        """
+
+        await self._invalidator.invalidate(
+            self.NAME, [user_id, hmac_component]
+        )
+
+    def _invalidate_local(self, data: List[Any]) -> None:
+        user_id, hmac_component = data
+
+        if hmac_component is None:
+            self._cache.delete_where(lambda k: k[0] == user_id)
+        else:
+            self._cache.delete((user_id, hmac_component))
+
+    def stats(self) -> Mapping[str, Any]:
+        return self._cache.stats()
 
 
 class Token:
@@ -38,6 +111,7 @@ class Token:
         "_app_id",
         "_parts",
         "_conn",
+        "_cache",
     )
 
     def __init__(
@@ -48,6 +122,7 @@ class Token:
         conn: asyncpg.Connection,
         scope: Optional[List[str]] = None,
         app_id: Optional[int] = None,
+        cache: Optional[TokenCache] = None,
     ):
         self.user_id = user_id
         self.create_offset = create_offset
@@ -58,9 +133,15 @@ class Token:
         self._parts = parts
 
         self._conn = conn
+        self._cache = cache
 
     @classmethod
-    def from_string(cls, input_str: str, conn: asyncpg.Connection) -> "Token":
+    def from_string(
+        cls,
+        input_str: str,
+        conn: asyncpg.Connection,
+        cache: Optional[TokenCache] = None,
+    ) -> "Token":
         if input_str.lower().startswith("bearer "):
             input_str = input_str[7:]
 
@@ -78,7 +159,7 @@ class Token:
         except (ValueError, binascii.Error) as e:
             raise ValueError(f"Unable to decode token base64 parts: {e}")
 
-        return cls(user_id, create_offset, parts, conn)
+        return cls(user_id, create_offset, parts, conn, cache=cache)
 
     @classmethod
     async def from_data(
@@ -107,9 +188,8 @@ class Token:
         return token
 
     async def _write_db(self) -> None:
-        await self._conn.fetch(
-            "INSERT INTO tokens (hmac_component, user_id, app_id, create_offset, scope)"
-            "   VALUES ($1, $2, $3, $4, $5)",
+        await queries.INSERT_TOKEN.fetch(
+            self._conn,
             self._parts[2],
             self.user_id,
             self._app_id,
@@ -117,25 +197,74 @@ class Token:
             self._scope,
         )
 
-    async def verify(self) -> bool:
-        password = await self._conn.fetchval(
-            "SELECT password FROM users WHERE id = $1", self.user_id
+    async def verify(self, conn: Optional[asyncpg.Connection] = None) -> bool:
+        """
+        Verifies token using cache or database. Connection passed to
+        constructor is used unless conn is passed.
+        """
+
+        if self.verify_cached():
+            return True
+
+        # password and token are fetched together to avoid second round trip
+        record = await queries.VERIFY_TOKEN.fetchrow(
+            self._conn if conn is None else conn,
+            self.user_id,
+            self.hmac_component,
         )
 
-        if password is None:
+        if record is None:
             raise ValueError("User does not exist in db")
 
+        return self.verify_record(record)
+
+    def verify_cached(self) -> bool:
+        """Verifies token using cache only. Returns False on cache miss."""
+
+        if self._cache is None:
+            return False
+
+        cached = self._cache.get(self.user_id, self.hmac_component)
+        if cached is None:
+            return False
+
+        self._scope, self._app_id = cached
+
+        return True
+
+    def verify_record(self, record: Mapping[str, Any]) -> bool:
+        """
+        Verifies token using fetched user password and token scope and
+        app_id. Missing token should be represented with None scope.
+        """
+
         hmac_calculated = self.encode_hmac_component(
-            password, self.user_id, self.create_offset
+            record["password"], self.user_id, self.create_offset
         )
 
-        return hmac_calculated == self._parts[2] and await self.exists()
+        if not hmac.compare_digest(hmac_calculated, self.hmac_component):
+            return False
+
+        if record["scope"] is None:  # token does not exist
+            return False
+
+        self._scope = record["scope"]
+        self._app_id = record["app_id"]
+
+        if self._cache is not None:
+            self._cache.set(
+                self.user_id, self.hmac_component, self._scope, self._app_id
+            )
+
+        return True
+
+    @property
+    def hmac_component(self) -> str:
+        return self._parts[2]
 
     async def exists(self) -> bool:
-        record = await self._conn.fetchval(
-            "SELECT (scope, app_id) FROM tokens WHERE hmac_component = $1 AND user_id = $2",
-            self._parts[2],
-            self.user_id,
+        record = await queries.GET_TOKEN.fetchval(
+            self._conn, self._parts[2], self.user_id
         )
 
         if record is None:
@@ -163,12 +292,13 @@ class Token:
         return self._app_id  # type: ignore
 
     async def revoke(self) -> None:
-        await self._conn.fetchval(
-            "DELETE FROM Tokens WHERE user_id = $1 AND hmac_component = $2",
-            self.user_id,
-            self._parts[2],
+        await queries.DELETE_TOKEN.fetchval(
+            self._conn, self.user_id, self._parts[2]
         )
 
+        if self._cache is not None:
+            await self._cache.invalidate(self.user_id, self._parts[2])
+
     @staticmethod
     def encode_user_id(user_id: int) -> str:
         return base64.urlsafe_b64encode(str(user_id).encode()).decode()
@@ -179,7 +309,13 @@ class Token:
 
     @staticmethod
     def encode_create_offset(offset: int) -> str:
-        hex_bytes = codecs.decode(f"{offset:x}".encode(), "hex")
+        hex_str = f"{offset:x}"
+
+        # hex codec does not accept odd length strings
+        if len(hex_str) % 2:
+            hex_str = f"0{hex_str}"
+
+        hex_bytes = codecs.decode(hex_str.encode(), "hex")
 
         # weird mypy behaviour, bytes and str type conflict
         return base64.urlsafe_b64encode(hex_bytes).decode()  # type: ignore
@@ -209,3 +345,297 @@ class Token:
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} user_id={self.user_id} app_id={self._app_id} scope={self._scope}>"
+
+
+class TokenEpochs:
+    """
+    Access token revocation epochs.
+
+    Epochs are counters stored in redis and embedded into every issued access
+    token: one per user and one per (user, application) pair. Incrementing
+    pair epoch revokes access tokens of user issued to application,
+    incrementing user epoch revokes all access tokens of user. Values are
+    cached in process, changes are delivered to all nodes using
+    CacheInvalidator.
+    """
+
+    NAME = "token_epochs"
+
+    def __init__(
+        self,
+        conn: aioredis.ConnectionsPool,
+        invalidator: CacheInvalidator,
+        *,
+        max_size: int = 10000,
+        ttl: float = 60,
+    ):
+        self._conn = conn
+
+        # maps (user id, app id) pairs to (user epoch, app epoch) pairs
+        self._cache: LRUCache[Tuple[int, int], Tuple[int, int]] = LRUCache(
+            max_size=max_size, ttl=ttl
+        )
+
+        self._invalidator = invalidator
+        self._invalidator.register(self.NAME, self._invalidate_local)
+
+    @staticmethod
+    def redis_key(user_id: int, app_id: Optional[int] = None) -> str:
+        if app_id is None:
+            return f"token_epoch:{user_id}"
+
+        return f"token_epoch:{user_id}:{app_id}"
+
+    async def get(self, user_id: int, app_id: int) -> Tuple[int, int]:
+        """Returns current user epoch and epoch of user in application."""
+
+        epochs = self._cache.get((user_id, app_id))
+        if epochs is None:
+            stored = await self._conn.execute(
+                "MGET",
+                self.redis_key(user_id),
+                self.redis_key(user_id, app_id),
+            )
+            epochs = (int(stored[0] or 0), int(stored[1] or 0))
+
+            self._cache.set((user_id, app_id), epochs)
+
+        return epochs
+
+    async def bump(self, user_id: int, app_id: Optional[int] = None) -> None:
+        """
+        Revokes issued access tokens of user in application. If app_id is
+        not passed, revokes all access tokens of user.
+        """
+
+        await self._conn.execute("INCR", self.redis_key(user_id, app_id))
+        await self._invalidator.invalidate(self.NAME, [user_id, app_id])
+
+    def _invalidate_local(self, data: Tuple[int, Optional[int]]) -> None:
+        user_id, app_id = data
+
+        if app_id is None:
+            self._cache.delete_where(lambda k: k[0] == user_id)
+        else:
+            self._cache.delete((user_id, app_id))
+
+    def stats(self) -> Mapping[str, Any]:
+        return self._cache.stats()
+
+
+class AccessToken:
+    """
+    Short living signed access token.
+
+    Unlike Token, is verified without database lookups: signature is made
+    with server secret and token contains all required data. Consists of 4
+    parts separated by dots: user id, create offset, payload
+    (life time, revocation epochs, application id and scope) and signature.
+
+    Access tokens are obtained using refresh tokens (Token objects) and can
+    only be revoked all at once: per application by bumping application
+    epoch of user or for all applications by bumping user epoch.
+    """
+
+    __slots__ = (
+        "user_id",
+        "create_offset",
+        "life_time",
+        "epochs",
+        "_scope",
+        "_app_id",
+        "_parts",
+        "_epochs",
+    )
+
+    def __init__(
+        self,
+        user_id: int,
+        create_offset: int,
+        life_time: int,
+        epochs: Tuple[int, int],
+        app_id: int,
+        scope: List[str],
+        parts: List[str],
+        token_epochs: TokenEpochs,
+    ):
+        self.user_id = user_id
+        self.create_offset = create_offset
+        self.life_time = life_time
+
+        # user epoch and epoch of user in application
+        self.epochs = epochs
+
+        self._app_id = app_id
+        self._scope = scope
+
+        self._parts = parts
+
+        self._epochs = token_epochs
+
+    @classmethod
+    def from_string(cls, input_str: str, epochs: TokenEpochs) -> "AccessToken":
+        if input_str.lower().startswith("bearer "):
+            input_str = input_str[7:]
+
+        parts = input_str.split(".")
+        if len(parts) != 4:
+            raise ValueError("Wrong number of token parts")
+
+        try:
+            user_id = Token.decode_user_id(parts[0])
+            create_offset = Token.decode_create_offset(parts[1])
+
+            payload = base64.urlsafe_b64decode(parts[2].encode()).decode()
+            life_time, user_epoch, app_epoch, app_id, scope = payload.split(
+                ":", 4
+            )
+
+            return cls(
+                user_id,
+                create_offset,
+                int(life_time),
+                (int(user_epoch), int(app_epoch)),
+                int(app_id),
+                scope.split(" "),
+                parts,
+                epochs,
+            )
+        except (ValueError, binascii.Error) as e:
+            raise ValueError(f"Unable to decode token parts: {e}")
+
+    @classmethod
+    async def from_data(
+        cls,
+        user_id: int,
+        app_id: int,
+        scope: List[str],
+        app: Mapping[str, Any],
+    ) -> "AccessToken":
+        token_epochs = app["token_epochs"]
+        epochs = await token_epochs.get(user_id, app_id)
+
+        life_time = app["access_token_life_time"]
+        create_offset = math.floor(time.time()) - EPOCH_OFFSET
+
+        payload = (
+            f"{life_time}:{epochs[0]}:{epochs[1]}:{app_id}:{' '.join(scope)}"
+        )
+
+        parts = [
+            Token.encode_user_id(user_id),
+            Token.encode_create_offset(create_offset),
+            base64.urlsafe_b64encode(payload.encode()).decode(),
+        ]
+        parts.append(cls.sign(app["access_token_secret"], parts))
+
+        return cls(
+            user_id,
+            create_offset,
+            life_time,
+            epochs,
+            app_id,
+            scope,
+            parts,
+            token_epochs,
+        )
+
+    @property
+    def expires_in(self) -> int:
+        """Number of seconds left before token expiration."""
+
+        return (
+            self.create_offset
+            + self.life_time
+            - (math.floor(time.time()) - EPOCH_OFFSET)
+        )
+
+    async def verify(self, secret: bytes) -> bool:
+        if not hmac.compare_digest(
+            self.sign(secret, self._parts[:3]), self._parts[3]
+        ):
+            return False
+
+        if self.expires_in <= 0:
+            return False
+
+        return self.epochs == await self._epochs.get(
+            self.user_id, self._app_id
+        )
+
+    async def get_scope(self) -> List[str]:
+        return self._scope
+
+    async def get_app_id(self) -> int:
+        return self._app_id
+
+    async def revoke(self) -> None:
+        """Revokes this and all other access tokens of user in application."""
+
+        await self._epochs.bump(self.user_id, self._app_id)
+
+    @staticmethod
+    def sign(secret: bytes, parts: List[str]) -> str:
+        signature = hmac.new(
+            secret, msg=".".join(parts).encode(), digestmod="sha256"
+        ).digest()
+
+        return base64.urlsafe_b64encode(signature).decode().rstrip("=")
+
+    def __str__(self) -> str:
+        return ".".join(self._parts)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} user_id={self.user_id} app_id={self._app_id} scope={self._scope} epochs={self.epochs}>"
+
+
+AnyToken = Union[Token, AccessToken]
+
+
+async def verify_token(
+    input_str: str,
+    app: Mapping[str, Any],
+    get_conn: Optional[Callable[[], Awaitable[asyncpg.Connection]]] = None,
+) -> AnyToken:
+    """
+    Parses and verifies token string. Signed access tokens are verified
+    without database lookups, refresh tokens are checked using token cache.
+    Raises ValueError if token is invalid.
+
+    Parameters:
+        input_str: token string, might be prefixed with Bearer.
+        app: application or request config_dict.
+        get_conn: returns connection to use instead of application pool,
+            only called if token is not cached.
+    """
+
+    token: AnyToken
+
+    if input_str.count(".") == 3:
+        token = AccessToken.from_string(input_str, app["token_epochs"])
+        verified = await token.verify(app["access_token_secret"])
+    else:
+        token = Token.from_string(
+            input_str, app["pg_conn"], cache=app["token_cache"]
+        )
+
+        verified = token.verify_cached()
+        if not verified:
+            verified = await token.verify(
+                None if get_conn is None else await get_conn()
+            )
+
+    if not verified:
+        raise ValueError("Token verification failed")
+
+    return token
+
+
+async def revoke_user_tokens(user_id: int, app: Mapping[str, Any]) -> None:
+    """
+    Invalidates all cached refresh tokens and revokes all access tokens of
+    user. Should be called after password change or user deletion.
+    """
+
+    await app["token_cache"].invalidate(user_id)
+    await app["token_epochs"].bump(user_id)
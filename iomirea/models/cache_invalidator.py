@@ -0,0 +1,134 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+import json
+import uuid
+import asyncio
+
+from typing import Any, Callable, Dict, Optional
+
+import aioredis
+
+from aiohttp import web
+
+from log import server_log
+
+
+_Handler = Callable[[Any], None]
+
+
+class CacheInvalidator:
+    """
+    Delivers in-process cache invalidations to all server nodes.
+
+    Invalidations are applied locally right away and then published to redis
+    channel. Other nodes receive them and call handler registered with the
+    same name.
+    """
+
+    CHANNEL = "cache_invalidation"
+
+    def __init__(self, app: web.Application):
+        self._app = app
+
+        # maps cache names to their invalidation handlers
+        self._handlers: Dict[str, _Handler] = {}
+
+        # used to skip own messages
+        self._node = uuid.uuid4().hex
+
+        self._task: Optional[asyncio.Task[None]] = None
+
+    @staticmethod
+    async def setup_invalidator(app: web.Application) -> None:
+        """Creates cache_invalidator property in application."""
+
+        invalidator = CacheInvalidator(app)
+        await invalidator.start()
+
+        app["cache_invalidator"] = invalidator
+        app.on_cleanup.append(invalidator.close)
+
+    def register(self, name: str, handler: _Handler) -> None:
+        """
+        Registers invalidation handler. Handler is called with data passed
+        to invalidate and should not block.
+        """
+
+        if name in self._handlers:
+            raise ValueError(f"Handler for {name} is already registered")
+
+        self._handlers[name] = handler
+
+    async def invalidate(self, name: str, data: Any) -> None:
+        """
+        Applies invalidation locally and broadcasts it to other nodes.
+        Data should be json serializable.
+        """
+
+        self._handlers[name](data)
+
+        await self._app["rd_conn"].execute(
+            "PUBLISH",
+            self.CHANNEL,
+            json.dumps({"node": self._node, "name": name, "data": data}),
+        )
+
+    async def start(self) -> None:
+        """Subscribes to invalidation channel."""
+
+        channel = aioredis.Channel(self.CHANNEL, is_pattern=False)
+
+        await self._app["rd_conn"].execute_pubsub("SUBSCRIBE", channel)
+
+        self._task = asyncio.create_task(self._read(channel))
+
+    async def _read(self, channel: aioredis.Channel) -> None:
+        while await channel.wait_message():
+            message = await channel.get()
+
+            try:
+                decoded = json.loads(message)
+
+                if decoded["node"] == self._node:
+                    continue
+
+                handler = self._handlers[decoded["name"]]
+            except (ValueError, KeyError) as e:
+                server_log.warn(f"Invalidator: bad message {message}: {e}")
+
+                continue
+
+            try:
+                handler(decoded["data"])
+            except Exception as e:
+                # not using exception level: error reporter expects request
+                server_log.warn(
+                    f"Invalidator: error in {decoded['name']} handler: {e}"
+                )
+
+    async def close(self, app: web.Application) -> None:
+        """Stops receiving invalidations."""
+
+        if self._task is not None:
+            self._task.cancel()
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} node={self._node} handlers={list(self._handlers)}>"
@@ -28,8 +28,14 @@ from typing import Any, Dict, Optional, Set
 from aiohttp import web
 
 from log import server_log
-from models.access_token import Token
-from models.events import Event, LocalEvent, OuterEvent, GlobalEvent
+from models.access_token import verify_token
+from models.events import (
+    Event,
+    LocalEvent,
+    OuterEvent,
+    GlobalEvent,
+    USER_UPDATE,
+)
 
 
 HEARTBEAT_INTERVAL = 30000
@@ -90,12 +96,8 @@ class Listener:
         """Sends dispatch message to websocket with event payload."""
 
         try:
-            await self.ws.send_json(
-                {
-                    "op": Opcode.DISPATCH.value,
-                    "d": event.payload,
-                    "t": event.name,
-                }
+            await self.ws.send_str(
+                event.dispatch_frame(Opcode.DISPATCH.value)
             )
         except RuntimeError:  # ws closed (dirty)
             server_log.debug("WS closed by user (dirty)")
@@ -133,11 +135,9 @@ class Listener:
 
         elif op == Opcode.IDENTIFY.value:
             try:
-                token = Token.from_string(
-                    data["d"]["token"], self._emitter._app["pg_conn"]
+                token = await verify_token(
+                    data["d"]["token"], self._emitter._app
                 )
-                if not await token.verify():  # ValueError possible
-                    raise ValueError
             except (ValueError, RuntimeError):
                 await self.notify(opcode=Opcode.INVALIDATE_SESSION)
                 await self.close(code=CloseCode.BAD_TOKEN)
@@ -235,6 +235,12 @@ class EventEmitter:
         # TODO: use self.app.loop.ensure_future() ?
         asyncio.create_task(task)
 
+        if isinstance(event, USER_UPDATE):
+            # cached profile of user is outdated
+            asyncio.create_task(
+                self._app["user_cache"].invalidate([event.user_id])
+            )
+
     async def notify_channel(self, event: LocalEvent) -> None:
         """Dispatches event for all users in channel of event."""
 
@@ -309,8 +315,8 @@ class EventEmitter:
             )
             return
 
-        channels = await self._app["pg_conn"].fetchval(
-            "SELECT channel_ids FROM users WHERE id = $1", listener.user_id
+        channels = await self._app["membership_cache"].get_channels(
+            listener.user_id
         )
 
         async with self._lock:
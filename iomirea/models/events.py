@@ -18,16 +18,32 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
 
-from typing import Any, Dict
+import json
 
+from typing import Any, Dict, Optional
 
-class Event:
-    """A base event."""
-
-    __slots__ = ("_payload",)
 
-    def __init__(self, *, payload: Dict[str, Any]):
+class Event:
+    """
+    A base event.
+
+    Payload can be passed already encoded to json if it is encoded for
+    response anyway. Dispatch frame is encoded once and shared by all
+    listeners.
+    """
+
+    __slots__ = ("_payload", "_encoded_payload", "_frame")
+
+    def __init__(
+        self,
+        *,
+        payload: Dict[str, Any],
+        encoded_payload: Optional[str] = None,
+    ):
         self._payload = payload
+        self._encoded_payload = encoded_payload
+        self._frame: Optional[str] = None
+
         self._parse_payload()
 
     def _parse_payload(self) -> None:
@@ -43,6 +59,21 @@ class Event:
     def payload(self) -> Dict[str, Any]:
         return self._payload
 
+    @property
+    def encoded_payload(self) -> str:
+        if self._encoded_payload is None:
+            self._encoded_payload = json.dumps(self._payload)
+
+        return self._encoded_payload
+
+    def dispatch_frame(self, opcode: int) -> str:
+        """Returns encoded gateway dispatch message."""
+
+        if self._frame is None:
+            self._frame = f'{{"op":{opcode},"d":{self.encoded_payload},"t":"{self.name}"}}'
+
+        return self._frame
+
 
 class LocalEvent(Event):
     """Event that is sent to all users in channel."""
@@ -0,0 +1,182 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional
+
+import asyncpg
+import aioredis
+
+from db import queries
+from db.redis import MEMBERSHIP_POPULATE
+from utils.cache import LRUCache
+from models.cache_invalidator import CacheInvalidator
+
+
+class MembershipCache:
+    """
+    Two level cache of user channels.
+
+    First level is in-process LRU cache, second level is redis set per user.
+    Sets of users without channels contain EMPTY_MARKER only, so they are
+    not confused with missing keys. Invalidations are delivered to all nodes
+    using CacheInvalidator.
+
+    Every invalidation increments user version, channels fetched from
+    database are stored only if version did not change while they were
+    fetched. Set ttl is not extended by reads.
+    """
+
+    NAME = "membership"
+
+    REDIS_TTL = 3600
+
+    # channel ids are positive snowflakes
+    EMPTY_MARKER = -1
+
+    def __init__(
+        self,
+        pg_conn: asyncpg.pool.Pool,
+        rd_conn: aioredis.ConnectionsPool,
+        invalidator: CacheInvalidator,
+        *,
+        max_size: int = 10000,
+        ttl: float = 60,
+    ):
+        self._pg_conn = pg_conn
+        self._rd_conn = rd_conn
+        self._redis = aioredis.Redis(rd_conn)
+
+        # maps user ids to sets of channel ids
+        self._cache: LRUCache[int, FrozenSet[int]] = LRUCache(
+            max_size=max_size, ttl=ttl
+        )
+
+        # number of local invalidations, values fetched before invalidation
+        # are not cached
+        self.generation = 0
+
+        self._invalidator = invalidator
+        self._invalidator.register(self.NAME, self._invalidate_local)
+
+        self.redis_hits = 0
+        self.db_hits = 0
+
+    @staticmethod
+    def redis_key(user_id: int) -> str:
+        return f"user_channels:{user_id}"
+
+    @staticmethod
+    def version_key(user_id: int) -> str:
+        return f"user_channels_version:{user_id}"
+
+    async def get_channels(self, user_id: int) -> FrozenSet[int]:
+        """Returns ids of user channels."""
+
+        channels = self._cache.get(user_id)
+        if channels is not None:
+            return channels
+
+        generation = self.generation
+
+        key = self.redis_key(user_id)
+
+        # version must be read before channels are fetched from database
+        pipe = self._redis.pipeline()
+        pipe.smembers(key)
+        pipe.get(self.version_key(user_id))
+        stored, version = await pipe.execute()
+
+        if stored:
+            self.redis_hits += 1
+
+            channels = frozenset(int(i) for i in stored) - {self.EMPTY_MARKER}
+        else:
+            self.db_hits += 1
+
+            channel_ids = await queries.GET_USER_CHANNEL_IDS.fetchval(
+                self._pg_conn, user_id
+            )
+            channels = frozenset(channel_ids or ())
+
+            if not await MEMBERSHIP_POPULATE(
+                self._rd_conn,
+                keys=[key, self.version_key(user_id)],
+                args=[
+                    (version or b"0").decode(),
+                    self.REDIS_TTL,
+                    *(channels or (self.EMPTY_MARKER,)),
+                ],
+            ):
+                # invalidated while fetched or stored by concurrent request,
+                # returned but not cached
+                return channels
+
+        self.set_local(user_id, channels, generation)
+
+        return channels
+
+    async def is_member(self, user_id: int, channel_id: int) -> bool:
+        return channel_id in await self.get_channels(user_id)
+
+    def get_local(self, user_id: int) -> Optional[FrozenSet[int]]:
+        """Returns user channels from in-process cache only."""
+
+        return self._cache.get(user_id)
+
+    def set_local(
+        self, user_id: int, channels: FrozenSet[int], generation: int
+    ) -> None:
+        """
+        Stores user channels fetched elsewhere in in-process cache. Values
+        fetched before cache generation changed are ignored.
+        """
+
+        if generation == self.generation:
+            self._cache.set(user_id, channels)
+
+    async def invalidate(self, user_ids: Iterable[int]) -> None:
+        """Drops cached channels of users. Should be called after commit."""
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+
+        tr = self._redis.multi_exec()
+        tr.delete(*(self.redis_key(i) for i in user_ids))
+        for user_id in user_ids:
+            tr.incr(self.version_key(user_id))
+            tr.expire(self.version_key(user_id), self.REDIS_TTL)
+        await tr.execute()
+
+        await self._invalidator.invalidate(self.NAME, user_ids)
+
+    def _invalidate_local(self, user_ids: List[int]) -> None:
+        self.generation += 1
+
+        for user_id in user_ids:
+            self._cache.delete(user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._cache.stats(),
+            "redis_hits": self.redis_hits,
+            "db_hits": self.db_hits,
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} size={len(self._cache)}>"
@@ -0,0 +1,242 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+import asyncio
+
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+import asyncpg
+import aioredis
+
+from aiohttp import web
+
+from db import queries
+from log import server_log
+
+
+# message id, channel id, author id, content, type
+_MessageArgs = Tuple[int, int, int, str, int]
+_Pending = Tuple[_MessageArgs, "asyncio.Future[asyncpg.Record]"]
+
+
+class MessageBatcher:
+    """
+    Groups concurrently created messages into multi-row inserts.
+
+    Messages are collected for max_delay seconds or until max_size messages
+    or max_bytes of content are pending, then inserted by single statement
+    and committed together. Batches are inserted one at a time in order of
+    creation, so messages become visible in order of their ids.
+
+    If batch insert fails, messages are inserted one by one and only
+    failing ones get an error. Results are returned after writes of authors
+    are marked.
+    """
+
+    def __init__(
+        self,
+        app: web.Application,
+        *,
+        max_delay: float = 0.002,
+        max_size: int = 100,
+        max_bytes: int = 262144,
+    ):
+        self._app = app
+
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+
+        self._pending: List[_Pending] = []
+        self._pending_bytes = 0
+
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        # batches are inserted sequentially to preserve message order
+        self._lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task[None]] = set()
+
+        self.batches = 0
+        self.messages = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    async def setup_batcher(app: web.Application) -> None:
+        """
+        Creates message_batcher property in application if batching is
+        enabled.
+        """
+
+        config = app["config"].get("message-batching", {})
+        if not config.get("enabled", False):
+            return
+
+        batcher = MessageBatcher(
+            app,
+            max_delay=config.get("max-delay", 2) / 1000,
+            max_size=config.get("max-size", 100),
+            max_bytes=config.get("max-bytes", 262144),
+        )
+
+        app["message_batcher"] = batcher
+        app.on_cleanup.append(batcher.close)
+
+    async def create(
+        self,
+        message_id: int,
+        channel_id: int,
+        author_id: int,
+        content: str,
+        type: int,
+    ) -> asyncpg.Record:
+        """
+        Creates message. Returns the same record as create_message
+        statement.
+        """
+
+        future = asyncio.get_event_loop().create_future()
+
+        self._pending.append(
+            ((message_id, channel_id, author_id, content, type), future)
+        )
+        self._pending_bytes += len(content.encode())
+
+        if (
+            len(self._pending) >= self.max_size
+            or self._pending_bytes >= self.max_bytes
+        ):
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.max_delay, self._flush
+            )
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._pending:
+            return
+
+        batch = self._pending
+        self._pending = []
+        self._pending_bytes = 0
+
+        task = asyncio.create_task(self._insert(batch))
+
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _insert(self, batch: List[_Pending]) -> None:
+        batch.sort(key=lambda p: p[0][0])
+
+        # statement takes array of values for every column
+        columns = [list(c) for c in zip(*(args for args, _ in batch))]
+        author_ids = set(columns[2])
+
+        async with self._lock:
+            try:
+                async with self._app["pg_conn"].acquire() as conn:
+                    try:
+                        records = await queries.CREATE_MESSAGES.fetch(
+                            conn, *columns
+                        )
+                    except asyncpg.PostgresError as e:
+                        server_log.info(
+                            f"Message batcher: batch of {len(batch)} failed, inserting separately: {e}"
+                        )
+                        self.fallbacks += 1
+
+                        results = await self._insert_separately(conn, batch)
+                    else:
+                        by_id = {r["id"]: r for r in records}
+
+                        results = [by_id[args[0]] for args, _ in batch]
+
+                    # authors could read from replica right after response
+                    await self._mark_writes(author_ids, conn)
+
+                    for (_, future), result in zip(batch, results):
+                        if future.done():
+                            continue
+
+                        if isinstance(result, Exception):
+                            future.set_exception(result)
+                        else:
+                            future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+                return
+
+        self.batches += 1
+        self.messages += len(batch)
+
+    async def _mark_writes(
+        self, user_ids: Set[int], conn: asyncpg.Connection
+    ) -> None:
+        """Request connections are not used, writes are marked here."""
+
+        try:
+            await self._app["pg_router"].mark_writes(user_ids, conn)
+        except (OSError, asyncpg.PostgresError, aioredis.RedisError) as e:
+            server_log.warn(f"Message batcher: unable to mark writes: {e}")
+
+    async def _insert_separately(
+        self, conn: asyncpg.Connection, batch: List[_Pending]
+    ) -> List[Union[asyncpg.Record, Exception]]:
+        """Returns created records or errors in order of batch."""
+
+        results: List[Union[asyncpg.Record, Exception]] = []
+
+        for args, _ in batch:
+            try:
+                results.append(
+                    await queries.CREATE_MESSAGE.fetchrow(conn, *args)
+                )
+            except asyncpg.PostgresError as e:
+                results.append(e)
+
+        return results
+
+    async def close(self, app: web.Application) -> None:
+        """Inserts pending messages."""
+
+        self._flush()
+
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": round(self.messages / (self.batches or 1), 2),
+            "fallbacks": self.fallbacks,
+            "pending": len(self._pending),
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} max_delay={self.max_delay} max_size={self.max_size} max_bytes={self.max_bytes}>"
@@ -0,0 +1,192 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Any, Dict, Optional, Tuple
+
+import asyncpg
+import aioredis
+
+from db import queries
+from db.redis import PERMISSIONS_POPULATE
+from utils.cache import LRUCache
+from models.cache_invalidator import CacheInvalidator
+
+
+class PermissionCache:
+    """
+    Two level cache of user permissions in channels.
+
+    First level is in-process LRU cache, second level is redis hash per
+    channel mapping user ids to permissions. Hash layout allows dropping all
+    channel entries at once. Invalidations are delivered to all nodes using
+    CacheInvalidator.
+
+    Every invalidation increments channel version, permissions fetched from
+    database are stored only if version did not change while they were
+    fetched. Hash ttl is not extended by reads.
+
+    Users not present in channel have no permissions.
+    """
+
+    NAME = "permissions"
+
+    REDIS_TTL = 3600
+
+    def __init__(
+        self,
+        pg_conn: asyncpg.pool.Pool,
+        rd_conn: aioredis.ConnectionsPool,
+        invalidator: CacheInvalidator,
+        *,
+        max_size: int = 10000,
+        ttl: float = 60,
+    ):
+        self._pg_conn = pg_conn
+        self._rd_conn = rd_conn
+        self._redis = aioredis.Redis(rd_conn)
+
+        # maps (channel id, user id) pairs to permissions
+        self._cache: LRUCache[Tuple[int, int], int] = LRUCache(
+            max_size=max_size, ttl=ttl
+        )
+
+        # number of local invalidations, values fetched before invalidation
+        # are not cached
+        self.generation = 0
+
+        self._invalidator = invalidator
+        self._invalidator.register(self.NAME, self._invalidate_local)
+
+        self.redis_hits = 0
+        self.db_hits = 0
+
+    @staticmethod
+    def redis_key(channel_id: int) -> str:
+        return f"permissions:{channel_id}"
+
+    @staticmethod
+    def version_key(channel_id: int) -> str:
+        return f"permissions_version:{channel_id}"
+
+    async def get(self, channel_id: int, user_id: int) -> int:
+        """Returns user permissions in channel as integer."""
+
+        permissions = self._cache.get((channel_id, user_id))
+        if permissions is not None:
+            return permissions
+
+        generation = self.generation
+
+        key = self.redis_key(channel_id)
+
+        # version must be read before permissions are fetched from database
+        pipe = self._redis.pipeline()
+        pipe.hget(key, user_id)
+        pipe.get(self.version_key(channel_id))
+        stored, version = await pipe.execute()
+
+        if stored is not None:
+            self.redis_hits += 1
+
+            permissions = int(stored)
+        else:
+            self.db_hits += 1
+
+            db_permissions = await queries.GET_PERMISSIONS.fetchval(
+                self._pg_conn, user_id, channel_id
+            )
+
+            if db_permissions is None:
+                permissions = 0
+            else:
+                permissions = asyncpg.BitString(db_permissions).to_int()
+
+            if not await PERMISSIONS_POPULATE(
+                self._rd_conn,
+                keys=[key, self.version_key(channel_id)],
+                args=[
+                    (version or b"0").decode(),
+                    user_id,
+                    permissions,
+                    self.REDIS_TTL,
+                ],
+            ):
+                # invalidated while fetched, returned but not cached
+                return permissions
+
+        self.set_local(channel_id, user_id, permissions, generation)
+
+        return permissions
+
+    def get_local(self, channel_id: int, user_id: int) -> Optional[int]:
+        """Returns permissions from in-process cache only."""
+
+        return self._cache.get((channel_id, user_id))
+
+    def set_local(
+        self, channel_id: int, user_id: int, permissions: int, generation: int
+    ) -> None:
+        """
+        Stores permissions fetched elsewhere in in-process cache. Values
+        fetched before cache generation changed are ignored.
+        """
+
+        if generation == self.generation:
+            self._cache.set((channel_id, user_id), permissions)
+
+    async def invalidate(
+        self, channel_id: int, user_id: Optional[int] = None
+    ) -> None:
+        """
+        Drops cached permissions of user in channel. If user_id is not
+        passed, permissions of all channel users are dropped.
+        """
+
+        key = self.redis_key(channel_id)
+        version_key = self.version_key(channel_id)
+
+        tr = self._redis.multi_exec()
+        if user_id is None:
+            tr.delete(key)
+        else:
+            tr.hdel(key, user_id)
+        tr.incr(version_key)
+        tr.expire(version_key, self.REDIS_TTL)
+        await tr.execute()
+
+        await self._invalidator.invalidate(self.NAME, [channel_id, user_id])
+
+    def _invalidate_local(self, data: Tuple[int, Optional[int]]) -> None:
+        channel_id, user_id = data
+
+        self.generation += 1
+
+        if user_id is None:
+            self._cache.delete_where(lambda key: key[0] == channel_id)
+        else:
+            self._cache.delete((channel_id, user_id))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._cache.stats(),
+            "redis_hits": self.redis_hits,
+            "db_hits": self.db_hits,
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} size={len(self._cache)}>"
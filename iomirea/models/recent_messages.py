@@ -0,0 +1,277 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import asyncpg
+import aioredis
+
+from db import queries
+from db.redis import RECENT_MESSAGES_POPULATE, RECENT_MESSAGES_WRITE
+from db.postgres import MESSAGE
+from log import server_log
+from utils.cache import LRUCache
+from utils.singleflight import FLIGHTS, make_key
+from models.user_cache import UserCache
+from models.cache_invalidator import CacheInvalidator
+
+
+# encoded messages from newest to oldest and flag telling if they are all
+# channel messages
+_Entry = Tuple[List[str], bool]
+
+
+class RecentMessagesCache:
+    """
+    Two level cache of latest encoded messages of channels.
+
+    Second level is redis hash per channel mapping message ids to encoded
+    messages, it is populated on first read and then updated on every
+    message change (write-through). Hash is populated only if channel
+    version did not change while messages were fetched, so concurrent
+    changes are not lost. First level is in-process LRU cache invalidated on
+    every change using CacheInvalidator, entries loaded while invalidation
+    happened are not stored in it.
+
+    Encoded messages include author, profile changes become visible after
+    REDIS_TTL seconds of channel inactivity.
+    """
+
+    NAME = "recent_messages"
+
+    REDIS_TTL = 600
+
+    def __init__(
+        self,
+        pg_conn: asyncpg.pool.Pool,
+        rd_conn: aioredis.ConnectionsPool,
+        invalidator: CacheInvalidator,
+        user_cache: UserCache,
+        *,
+        size: int = 200,
+        max_size: int = 1000,
+        ttl: float = 10,
+    ):
+        self._pg_conn = pg_conn
+        self._rd_conn = rd_conn
+        self._redis = aioredis.Redis(rd_conn)
+
+        self._user_cache = user_cache
+
+        # number of messages cached per channel
+        self.size = size
+
+        # maps channel ids to entries
+        self._cache: LRUCache[int, _Entry] = LRUCache(
+            max_size=max_size, ttl=ttl
+        )
+
+        # number of local invalidations, values fetched before invalidation
+        # are not cached
+        self.generation = 0
+
+        self._invalidator = invalidator
+        self._invalidator.register(self.NAME, self._invalidate_local)
+
+        self.redis_hits = 0
+        self.db_hits = 0
+        self.uncached_reads = 0
+        self.errors = 0
+
+    @staticmethod
+    def redis_key(channel_id: int) -> str:
+        return f"recent_messages:{channel_id}"
+
+    @staticmethod
+    def version_key(channel_id: int) -> str:
+        return f"recent_messages_version:{channel_id}"
+
+    async def get_latest(
+        self, channel_id: int, limit: int
+    ) -> Optional[List[str]]:
+        """
+        Returns up to limit latest encoded channel messages, newest first.
+        Returns None if limit exceeds cache size or cache is unavailable.
+        """
+
+        if limit > self.size:
+            self.uncached_reads += 1
+
+            return None
+
+        entry = self._cache.get(channel_id)
+        if entry is None:
+            try:
+                # version is read by loader, concurrent loads are merged
+                # together with it
+                entry = await FLIGHTS.do(
+                    make_key(self.NAME, channel_id),
+                    lambda: self._load(channel_id),
+                )
+            except (OSError, aioredis.RedisError) as e:
+                server_log.warn(f"Recent messages: unable to load: {e}")
+                self.errors += 1
+
+                return None
+
+        messages, complete = entry
+
+        # some of cached messages were deleted
+        if limit > len(messages) and not complete:
+            self.uncached_reads += 1
+
+            return None
+
+        return messages[:limit]
+
+    async def _load(self, channel_id: int) -> _Entry:
+        generation = self.generation
+
+        key = self.redis_key(channel_id)
+
+        stored = await self._redis.hgetall(key)
+        if stored:
+            self.redis_hits += 1
+
+            complete = stored.pop(b"complete") == b"1"
+            messages = [
+                v.decode()
+                for _, v in sorted(
+                    stored.items(), key=lambda i: int(i[0]), reverse=True
+                )
+            ]
+
+            entry = (messages, complete)
+            self._set_local(channel_id, entry, generation)
+
+            return entry
+
+        self.db_hits += 1
+
+        # must be read before messages
+        version = await self._redis.get(self.version_key(channel_id))
+
+        records = await self._user_cache.embed(
+            await queries.GET_LATEST_MESSAGES.fetch(
+                self._pg_conn, channel_id, self.size
+            )
+        )
+
+        messages = [MESSAGE.to_json_str(r) for r in records]
+        complete = len(messages) < self.size
+
+        args: List[Any] = [
+            (version or b"0").decode(),
+            int(complete),
+            self.REDIS_TTL,
+        ]
+        for record, encoded in zip(records, messages):
+            args.extend((record["id"], encoded))
+
+        stored = await RECENT_MESSAGES_POPULATE(
+            self._rd_conn,
+            keys=[key, self.version_key(channel_id)],
+            args=args,
+        )
+
+        entry = (messages, complete)
+
+        # messages could be changed while they were fetched
+        if stored:
+            self._set_local(channel_id, entry, generation)
+
+        return entry
+
+    async def add(
+        self, message: Mapping[str, Any], *, encoded: Optional[str] = None
+    ) -> None:
+        """Adds created message. Should be called after commit."""
+
+        if encoded is None:
+            encoded = MESSAGE.to_json_str(message)
+
+        await self._write("add", message["channel_id"], message["id"], encoded)
+
+    async def update(self, message: Mapping[str, Any]) -> None:
+        """Replaces changed message. Should be called after commit."""
+
+        await self._write(
+            "update",
+            message["channel_id"],
+            message["id"],
+            MESSAGE.to_json_str(message),
+        )
+
+    async def delete(self, channel_id: int, message_id: int) -> None:
+        """Removes deleted message. Should be called after commit."""
+
+        await self._write("delete", channel_id, message_id, "")
+
+    async def _write(
+        self, operation: str, channel_id: int, message_id: int, encoded: str
+    ) -> None:
+        try:
+            await RECENT_MESSAGES_WRITE(
+                self._rd_conn,
+                keys=[
+                    self.redis_key(channel_id),
+                    self.version_key(channel_id),
+                ],
+                args=[
+                    operation,
+                    message_id,
+                    encoded,
+                    self.size,
+                    self.REDIS_TTL,
+                ],
+            )
+
+            await self._invalidator.invalidate(self.NAME, [channel_id])
+        except (OSError, aioredis.RedisError) as e:
+            # change is already committed, failing request does not help
+            server_log.warn(
+                f"Recent messages: unable to {operation} {message_id}: {e}"
+            )
+            self.errors += 1
+
+            self._invalidate_local([channel_id])
+
+    def _set_local(
+        self, channel_id: int, entry: _Entry, generation: int
+    ) -> None:
+        # entries read before channel change are outdated
+        if generation == self.generation:
+            self._cache.set(channel_id, entry)
+
+    def _invalidate_local(self, channel_ids: List[int]) -> None:
+        self.generation += 1
+
+        for channel_id in channel_ids:
+            self._cache.delete(channel_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._cache.stats(),
+            "redis_hits": self.redis_hits,
+            "db_hits": self.db_hits,
+            "uncached_reads": self.uncached_reads,
+            "errors": self.errors,
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} size={self.size} channels={len(self._cache)}>"
@@ -0,0 +1,104 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Any, List, Mapping
+
+import aioredis
+
+from aiohttp import web
+from aiohttp_session import Session
+from aiohttp_session.redis_storage import RedisStorage
+
+from utils.cache import LRUCache
+from models.cache_invalidator import CacheInvalidator
+
+
+class CachedRedisStorage(RedisStorage):
+    """
+    aiohttp_session RedisStorage with in-process cache of sessions.
+
+    Sessions are cached encoded for a short time, every request decodes its
+    own copy, so unsaved changes are not visible to other requests. Changed
+    and deleted sessions are removed from caches of all nodes using
+    CacheInvalidator.
+    """
+
+    NAME = "sessions"
+
+    def __init__(
+        self,
+        redis_pool: aioredis.ConnectionsPool,
+        invalidator: CacheInvalidator,
+        *,
+        cache_size: int = 10000,
+        cache_ttl: float = 60,
+        **kwargs: Any,
+    ):
+        super().__init__(redis_pool, **kwargs)
+
+        # maps session identities to encoded session data
+        self._cache: LRUCache[str, str] = LRUCache(
+            max_size=cache_size, ttl=cache_ttl
+        )
+
+        self._invalidator = invalidator
+        self._invalidator.register(self.NAME, self._invalidate_local)
+
+    async def load_session(self, request: web.Request) -> Session:
+        cookie = self.load_cookie(request)
+        if cookie is not None:
+            encoded = self._cache.get(str(cookie))
+            if encoded is not None:
+                return Session(
+                    str(cookie),
+                    data=self._decoder(encoded),
+                    new=False,
+                    max_age=self.max_age,
+                )
+
+        session = await super().load_session(request)
+
+        if not session.new:  # loaded from redis
+            self._cache.set(
+                session.identity,
+                self._encoder(self._get_session_data(session)),
+            )
+
+        return session
+
+    async def save_session(
+        self, request: web.Request, response: web.StreamResponse, session: Session
+    ) -> None:
+        await super().save_session(request, response, session)
+
+        # new sessions are not cached anywhere yet
+        if not session.new and session.identity is not None:
+            await self.invalidate([session.identity])
+
+    async def invalidate(self, identities: List[str]) -> None:
+        """Removes sessions from caches of all nodes."""
+
+        if identities:
+            await self._invalidator.invalidate(self.NAME, identities)
+
+    def _invalidate_local(self, identities: List[str]) -> None:
+        for identity in identities:
+            self._cache.delete(identity)
+
+    def stats(self) -> Mapping[str, Any]:
+        return self._cache.stats()
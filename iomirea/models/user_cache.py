@@ -0,0 +1,229 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+
+from typing import Any, Dict, Iterable, List, Mapping, Optional
+
+import asyncpg
+import aioredis
+
+from db import queries
+from db.redis import USER_PROFILES_POPULATE
+from db.postgres import USER
+from utils.cache import LRUCache
+from models.cache_invalidator import CacheInvalidator
+
+
+_User = Dict[str, Any]
+
+_USER_KEYS = USER.get_keys()
+
+
+class UserCache:
+    """
+    Two level cache of public user profiles (USER keys).
+
+    First level is in-process LRU cache, second level is redis string with
+    json encoded profile per user. Missing profiles are fetched in bulk.
+    Invalidations are delivered to all nodes using CacheInvalidator, users
+    should be invalidated after every change of their rows.
+
+    Every invalidation increments user version, profiles fetched from
+    database are stored only if version did not change while they were
+    fetched.
+    """
+
+    NAME = "users"
+
+    REDIS_TTL = 3600
+
+    def __init__(
+        self,
+        pg_conn: asyncpg.pool.Pool,
+        rd_conn: aioredis.ConnectionsPool,
+        invalidator: CacheInvalidator,
+        *,
+        max_size: int = 10000,
+        ttl: float = 60,
+    ):
+        self._pg_conn = pg_conn
+        self._rd_conn = rd_conn
+        self._redis = aioredis.Redis(rd_conn)
+
+        # maps user ids to profiles
+        self._cache: LRUCache[int, _User] = LRUCache(
+            max_size=max_size, ttl=ttl
+        )
+
+        # number of local invalidations, values fetched before invalidation
+        # are not cached
+        self.generation = 0
+
+        self._invalidator = invalidator
+        self._invalidator.register(self.NAME, self._invalidate_local)
+
+        self.redis_hits = 0
+        self.db_hits = 0
+
+    @staticmethod
+    def redis_key(user_id: int) -> str:
+        return f"user_profile:{user_id}"
+
+    @staticmethod
+    def version_key(user_id: int) -> str:
+        return f"user_profile_version:{user_id}"
+
+    async def get(self, user_id: int) -> Optional[_User]:
+        """Returns profile of user or None if user does not exist."""
+
+        return (await self.get_many([user_id])).get(user_id)
+
+    async def get_many(self, user_ids: Iterable[int]) -> Dict[int, _User]:
+        """Returns profiles of existing users from user_ids."""
+
+        users: Dict[int, _User] = {}
+        missing = []
+
+        for user_id in set(user_ids):
+            user = self._cache.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                users[user_id] = user
+
+        if not missing:
+            return users
+
+        generation = self.generation
+
+        # versions must be read before profiles are fetched from database
+        stored = await self._redis.mget(
+            *(self.redis_key(i) for i in missing),
+            *(self.version_key(i) for i in missing),
+        )
+
+        # maps ids of users missing in redis to their versions
+        not_stored: Dict[int, bytes] = {}
+        for user_id, value, version in zip(
+            missing, stored, stored[len(missing) :]
+        ):
+            if value is None:
+                not_stored[user_id] = version or b"0"
+
+                continue
+
+            self.redis_hits += 1
+
+            user = json.loads(value)
+            users[user_id] = user
+
+            self.set_local(user_id, user, generation)
+
+        if not not_stored:
+            return users
+
+        self.db_hits += len(not_stored)
+
+        records = await queries.GET_USERS.fetch(
+            self._pg_conn, list(not_stored)
+        )
+
+        keys: List[str] = []
+        args: List[Any] = [self.REDIS_TTL]
+
+        for record in records:
+            user = dict(record)
+            users[user["id"]] = user
+
+            self.set_local(user["id"], user, generation)
+
+            keys.extend(
+                (self.redis_key(user["id"]), self.version_key(user["id"]))
+            )
+            args.extend((not_stored[user["id"]].decode(), json.dumps(user)))
+
+        if keys:
+            await USER_PROFILES_POPULATE(self._rd_conn, keys=keys, args=args)
+
+        return users
+
+    async def embed(
+        self, records: Iterable[Mapping[str, Any]], name: str = "author"
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns copies of records with user from {name}_id column embedded
+        the same way views do, as _{name}_{key} columns.
+        """
+
+        records = list(records)
+
+        users = await self.get_many(r[f"{name}_id"] for r in records)
+
+        embedded = []
+        for record in records:
+            user = users.get(record[f"{name}_id"], {})
+
+            obj = dict(record)
+            for k in _USER_KEYS:
+                obj[f"_{name}_{k}"] = user.get(k)
+
+            embedded.append(obj)
+
+        return embedded
+
+    def set_local(self, user_id: int, user: _User, generation: int) -> None:
+        """
+        Stores user profile in in-process cache. Values fetched before cache
+        generation changed are ignored.
+        """
+
+        if generation == self.generation:
+            self._cache.set(user_id, user)
+
+    async def invalidate(self, user_ids: Iterable[int]) -> None:
+        """Drops cached profiles of users. Should be called after commit."""
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+
+        tr = self._redis.multi_exec()
+        tr.delete(*(self.redis_key(i) for i in user_ids))
+        for user_id in user_ids:
+            tr.incr(self.version_key(user_id))
+            tr.expire(self.version_key(user_id), self.REDIS_TTL)
+        await tr.execute()
+
+        await self._invalidator.invalidate(self.NAME, user_ids)
+
+    def _invalidate_local(self, user_ids: List[int]) -> None:
+        self.generation += 1
+
+        for user_id in user_ids:
+            self._cache.delete(user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._cache.stats(),
+            "redis_hits": self.redis_hits,
+            "db_hits": self.db_hits,
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} size={len(self._cache)}>"
@@ -24,12 +24,21 @@ from aiohttp import web
 import asyncpg
 
 from routes.api import v0_endpoints_public as endpoints_public
-from db.postgres import USER, SELF_USER, CHANNEL, MESSAGE, FILE, BUGREPORT
-from utils import helpers
-from utils.db import ensure_existance
+from db import queries
+from db.postgres import (
+    USER,
+    SELF_USER,
+    CHANNEL,
+    MESSAGE,
+    FILE,
+    BUGREPORT,
+    User,
+)
+from utils import helpers, ratelimit
+from utils.db import connection, ensure_existance, shared_query
 from models import converters, checks
 from models import events
-from security import access
+from security import access, principal
 from enums import Permissions, MessageTypes
 
 
@@ -37,6 +46,7 @@ routes = web.RouteTableDef()
 
 
 @routes.post(endpoints_public.CHANNELS)
+@ratelimit.limit(10, 60, by="token")
 @helpers.parse_token
 @helpers.body_params(
     {
@@ -57,35 +67,41 @@ async def create_channel(req: web.Request) -> web.Response:
 
     channel_id = req.config_dict["sf_gen"].gen_id()
 
-    async with req.config_dict["pg_conn"].acquire() as conn:
-        async with conn.transaction():
-            channel = await conn.fetchrow(
-                f"SELECT {CHANNEL} FROM create_channel($1, $2, $3, $4)",
-                channel_id,
-                user_id,
-                query["name"],
-                recipients,
-            )
+    conn = await connection(req)
 
-            message = await conn.fetchrow(
-                f"SELECT {MESSAGE} FROM create_message($1, $2, $3, $4, type:=$5)",
-                req.config_dict["sf_gen"].gen_id(),
-                channel_id,
-                user_id,
-                "",
-                MessageTypes.CHANNEL_CREATE.value,
-            )
+    async with conn.transaction():
+        channel = await queries.CREATE_CHANNEL.fetchrow(
+            conn,
+            channel_id,
+            user_id,
+            query["name"],
+            recipients,
+        )
+
+        message = await queries.CREATE_MESSAGE.fetchrow(
+            conn,
+            req.config_dict["sf_gen"].gen_id(),
+            channel_id,
+            user_id,
+            "",
+            MessageTypes.CHANNEL_CREATE.value,
+        )
+
+    await req.config_dict["membership_cache"].invalidate(
+        recipients | {user_id}
+    )
 
     req.config_dict["emitter"].emit(
         events.MESSAGE_CREATE(payload=MESSAGE.to_json(message))
     )
 
+    await req.config_dict["recent_messages"].add(message)
+
     return web.json_response(CHANNEL.to_json(channel))
 
 
 @routes.put(endpoints_public.CHANNEL)
-@helpers.parse_token
-@access.channel
+@principal.requires(permissions=[Permissions.MODIFY_CHANNEL])
 @helpers.body_params(
     {
         "name": converters.String(
@@ -94,53 +110,52 @@ async def create_channel(req: web.Request) -> web.Response:
     }
 )
 async def edit_channel(req: web.Request) -> web.Response:
-    await helpers.ensure_permissions(Permissions.MODIFY_CHANNEL, request=req)
-
     channel_id = req["match_info"]["channel_id"]
 
-    async with req.config_dict["pg_conn"].acquire() as conn:
-        async with conn.transaction():
-            old_channel = await conn.fetchrow(
-                f"SELECT {CHANNEL} FROM channels WHERE id = $1", channel_id
-            )
+    conn = await connection(req)
 
-            channel = await req.config_dict["pg_conn"].fetchrow(
-                CHANNEL.update_query_for(
-                    "channels", channel_id, req["body"].keys()
-                ),
-                req["body"]["name"],
-            )
+    async with conn.transaction():
+        record = await conn.fetchrow(
+            CHANNEL.update_diff_query_for(
+                "channels", "channels_with_users", req["body"].keys()
+            ),
+            channel_id,
+            req["body"]["name"],
+        )
 
-            if channel is None:
-                raise web.HTTPNotModified
+        if record is None:
+            raise web.HTTPNotFound(reason="Channel not found")
 
-            message = await conn.fetchrow(
-                f"SELECT {MESSAGE} FROM create_message($1, $2, $3, $4, type:=$5)",
-                req.config_dict["sf_gen"].gen_id(),
-                channel_id,
-                req["access_token"].user_id,
-                "",
-                MessageTypes.CHANNEL_NAME_UPDATE.value,
-            )
+        diff = CHANNEL.diff_to_json(record)
+        if not diff:
+            raise web.HTTPNotModified
 
-    diff = CHANNEL.diff_to_json(old_channel, channel)
+        message = await queries.CREATE_MESSAGE.fetchrow(
+            conn,
+            req.config_dict["sf_gen"].gen_id(),
+            channel_id,
+            req["access_token"].user_id,
+            "",
+            MessageTypes.CHANNEL_NAME_UPDATE.value,
+        )
 
     req.config_dict["emitter"].emit(events.CHANNEL_UPDATE(payload=diff))
     req.config_dict["emitter"].emit(
         events.MESSAGE_CREATE(payload=MESSAGE.to_json(message))
     )
 
+    await req.config_dict["recent_messages"].add(message)
+
     return web.json_response(diff)
 
 
 @routes.get(endpoints_public.CHANNEL)
-@helpers.parse_token
-@access.channel
+@principal.requires(channel_member=True)
 async def get_channel(req: web.Request) -> web.Response:
     channel_id = req["match_info"]["channel_id"]
 
-    record = await req.config_dict["pg_conn"].fetchrow(
-        f"SELECT {CHANNEL} FROM channels WHERE id=$1", channel_id
+    record = await shared_query(
+        req, queries.GET_CHANNEL, "fetchrow", channel_id, readonly=True
     )
 
     if record is None:
@@ -150,183 +165,210 @@ async def get_channel(req: web.Request) -> web.Response:
 
 
 @routes.put(endpoints_public.CHANNEL_RECIPIENT)
-@helpers.parse_token
-@access.channel
+@principal.requires(permissions=[Permissions.INVITE_MEMBERS])
 async def add_channel_recipient(req: web.Request) -> web.Response:
-    await helpers.ensure_permissions(Permissions.INVITE_MEMBERS, request=req)
-
     channel_id = req["match_info"]["channel_id"]
     user_id = req["match_info"]["user_id"]
 
-    await ensure_existance(req, "users", user_id, "User")
+    # rechecked by channel user functions, deduplicated result is enough
+    await ensure_existance(req, "users", user_id, "User", shared=True)
 
-    async with req.config_dict["pg_conn"].acquire() as conn:
-        async with conn.transaction():
-            success = await conn.fetchval(
-                "SELECT * FROM add_channel_user($1, $2)", channel_id, user_id
-            )
+    conn = await connection(req)
 
-            if not success:
-                raise web.HTTPNotModified(reason="Is user already in channel?")
+    async with conn.transaction():
+        success = await queries.ADD_CHANNEL_USER.fetchval(
+            conn, channel_id, user_id
+        )
 
-            message = await conn.fetchrow(
-                f"SELECT {MESSAGE} FROM create_message($1, $2, $3, $4, type:=$5)",
-                req.config_dict["sf_gen"].gen_id(),
-                channel_id,
-                user_id,
-                "",
-                MessageTypes.RECIPIENT_ADD.value,
-            )
+        if not success:
+            raise web.HTTPNotModified(reason="Is user already in channel?")
+
+        message = await queries.CREATE_MESSAGE.fetchrow(
+            conn,
+            req.config_dict["sf_gen"].gen_id(),
+            channel_id,
+            user_id,
+            "",
+            MessageTypes.RECIPIENT_ADD.value,
+        )
+
+    await req.config_dict["membership_cache"].invalidate([user_id])
+    # negative entry could be cached for user
+    await req.config_dict["permission_cache"].invalidate(channel_id, user_id)
 
     req.config_dict["emitter"].emit(
         events.MESSAGE_CREATE(payload=MESSAGE.to_json(message))
     )
 
+    await req.config_dict["recent_messages"].add(message)
+
     raise web.HTTPNoContent()
 
 
 @routes.delete(endpoints_public.CHANNEL_RECIPIENT)
-@helpers.parse_token
-@access.channel
+@principal.requires(channel_member=True)
 async def remove_channel_recipient(req: web.Request) -> web.Response:
     channel_id = req["match_info"]["channel_id"]
     user_id = req["match_info"]["user_id"]
 
-    await ensure_existance(req, "users", user_id, "User")
+    # rechecked by channel user functions, deduplicated result is enough
+    await ensure_existance(req, "users", user_id, "User", shared=True)
 
-    async with req.config_dict["pg_conn"].acquire() as conn:
-        async with conn.transaction():
-            if req["access_token"].user_id != user_id:  # user kicks other user
-                await helpers.ensure_permissions(
-                    Permissions.KICK_MEMBERS, request=req
-                )
+    conn = await connection(req)
 
-            success = await conn.fetchval(
-                "SELECT * FROM remove_channel_user($1, $2)",
-                channel_id,
-                user_id,
+    async with conn.transaction():
+        if req["access_token"].user_id != user_id:  # user kicks other user
+            await helpers.ensure_permissions(
+                Permissions.KICK_MEMBERS, request=req
             )
 
-            if not success:
-                raise web.HTTPNotModified(reason="Is user in channel?")
+        success = await queries.REMOVE_CHANNEL_USER.fetchval(
+            conn, channel_id, user_id
+        )
 
-            message = await conn.fetchrow(
-                f"SELECT {MESSAGE} FROM create_message($1, $2, $3, $4, type:=$5)",
-                req.config_dict["sf_gen"].gen_id(),
-                channel_id,
-                user_id,
-                "",
-                MessageTypes.RECIPIENT_REMOVE.value,
-            )
+        if not success:
+            raise web.HTTPNotModified(reason="Is user in channel?")
+
+        message = await queries.CREATE_MESSAGE.fetchrow(
+            conn,
+            req.config_dict["sf_gen"].gen_id(),
+            channel_id,
+            user_id,
+            "",
+            MessageTypes.RECIPIENT_REMOVE.value,
+        )
+
+    await req.config_dict["membership_cache"].invalidate([user_id])
+    await req.config_dict["permission_cache"].invalidate(channel_id, user_id)
 
     req.config_dict["emitter"].emit(
         events.MESSAGE_CREATE(payload=MESSAGE.to_json(message))
     )
 
+    await req.config_dict["recent_messages"].add(message)
+
     raise web.HTTPNoContent()
 
 
 @routes.get(endpoints_public.CHANNEL_PINS)
-@helpers.parse_token
-@access.channel
+@principal.requires(channel_member=True)
 async def get_pins(req: web.Request) -> web.Response:
     channel_id = req["match_info"]["channel_id"]
 
-    async with req.config_dict["pg_conn"].acquire() as conn:
-        async with conn.transaction():
-            pin_ids = await conn.fetchval(
-                "SELECT pinned_ids FROM channels WHERE id = $1", channel_id
-            )
+    pin_ids = await shared_query(
+        req, queries.GET_PIN_IDS, "fetchval", channel_id, readonly=True
+    )
 
-        records = await conn.fetch(
-            f"SELECT {MESSAGE} FROM messages_with_author WHERE id = ANY($1)",
-            pin_ids,
+    records = await req.config_dict["user_cache"].embed(
+        await shared_query(
+            req, queries.GET_MESSAGES, "fetch", pin_ids, readonly=True
         )
+    )
 
-    return web.json_response([MESSAGE.to_json(record) for record in records])
+    return helpers.json_bytes_response(MESSAGE.list_to_json_bytes(records))
 
 
 @routes.put(endpoints_public.CHANNEL_PIN)
-@helpers.parse_token
-@access.channel
+@principal.requires(channel_member=True)
 async def add_pin(req: web.Request) -> web.Response:
     channel_id = req["match_info"]["channel_id"]
     message_id = req["match_info"]["message_id"]
 
-    async with req.config_dict["pg_conn"].acquire() as conn:
-        async with conn.transaction():
-            pins_ids = await conn.fetchval(
-                "SELECT pinned_ids FROM channels WHERE id = $1", channel_id
-            )
-            if len(pins_ids) >= 50:
-                raise web.HTTPBadRequest(reason="Too many pins (>= 50)")
+    conn = await connection(req)
 
-            if message_id in pins_ids:
-                raise web.HTTPNotModified(reason="Already pinned")
+    async with conn.transaction():
+        pins_ids = await queries.GET_PIN_IDS.fetchval(conn, channel_id)
+        if len(pins_ids) >= 50:
+            raise web.HTTPBadRequest(reason="Too many pins (>= 50)")
 
-            pin_success = await conn.fetchval(
-                "SELECT * FROM add_channel_pin($1, $2)", message_id, channel_id
-            )
-            if not pin_success:
-                raise web.HTTPBadRequest(
-                    reason="Failed to pin message. Does it belong to channel?"
-                )
-
-            message = await conn.fetchrow(
-                f"SELECT {MESSAGE} FROM create_message($1, $2, $3, $4, type:=$5)",
-                req.config_dict["sf_gen"].gen_id(),
-                channel_id,
-                req["access_token"].user_id,
-                "",
-                MessageTypes.CHANNEL_PIN_ADD.value,
+        if message_id in pins_ids:
+            raise web.HTTPNotModified(reason="Already pinned")
+
+        pin_success = await queries.ADD_CHANNEL_PIN.fetchval(
+            conn, message_id, channel_id
+        )
+        if not pin_success:
+            raise web.HTTPBadRequest(
+                reason="Failed to pin message. Does it belong to channel?"
             )
 
+        message = await queries.CREATE_MESSAGE.fetchrow(
+            conn,
+            req.config_dict["sf_gen"].gen_id(),
+            channel_id,
+            req["access_token"].user_id,
+            "",
+            MessageTypes.CHANNEL_PIN_ADD.value,
+        )
+
     req.config_dict["emitter"].emit(
         events.MESSAGE_CREATE(payload=MESSAGE.to_json(message))
     )
 
+    await update_pinned_message(req, conn)
+    await req.config_dict["recent_messages"].add(message)
+
     raise web.HTTPNoContent()
 
 
+async def update_pinned_message(
+    req: web.Request, conn: asyncpg.Connection
+) -> None:
+    """Replaces message with changed pinned flag in recent messages."""
+
+    pinned = await queries.GET_CHANNEL_MESSAGE.fetchrow(
+        conn, req["match_info"]["channel_id"], req["match_info"]["message_id"]
+    )
+
+    # message could be deleted concurrently
+    if pinned is None:
+        return
+
+    (pinned,) = await req.config_dict["user_cache"].embed([pinned])
+
+    await req.config_dict["recent_messages"].update(pinned)
+
+
 # FIXME: pin remove events are always fired
 @routes.delete(endpoints_public.CHANNEL_PIN)
-@helpers.parse_token
-@access.channel
+@principal.requires(channel_member=True)
 async def remove_pin(req: web.Request) -> web.Response:
     channel_id = req["match_info"]["channel_id"]
     message_id = req["match_info"]["message_id"]
 
-    async with req.config_dict["pg_conn"].acquire() as conn:
-        async with conn.transaction():
-            unpin_success = await conn.fetchval(
-                "SELECT * FROM remove_channel_pin($1, $2)",
-                message_id,
-                channel_id,
-            )
-            if not unpin_success:
-                raise web.HTTPBadRequest(
-                    reason="Failed to unpin message. Does it belong to channel?"
-                )
-
-            message = await conn.fetchrow(
-                f"SELECT {MESSAGE} FROM create_message($1, $2, $3, $4, type:=$5)",
-                req.config_dict["sf_gen"].gen_id(),
-                channel_id,
-                req["access_token"].user_id,
-                "",
-                MessageTypes.CHANNEL_PIN_REMOVE.value,
+    conn = await connection(req)
+
+    async with conn.transaction():
+        unpin_success = await queries.REMOVE_CHANNEL_PIN.fetchval(
+            conn, message_id, channel_id
+        )
+        if not unpin_success:
+            raise web.HTTPBadRequest(
+                reason="Failed to unpin message. Does it belong to channel?"
             )
 
+        message = await queries.CREATE_MESSAGE.fetchrow(
+            conn,
+            req.config_dict["sf_gen"].gen_id(),
+            channel_id,
+            req["access_token"].user_id,
+            "",
+            MessageTypes.CHANNEL_PIN_REMOVE.value,
+        )
+
     req.config_dict["emitter"].emit(
         events.MESSAGE_CREATE(payload=MESSAGE.to_json(message))
     )
 
+    await update_pinned_message(req, conn)
+    await req.config_dict["recent_messages"].add(message)
+
     raise web.HTTPNoContent()
 
 
 @routes.post(endpoints_public.MESSAGES)
-@helpers.parse_token
-@access.channel
+@ratelimit.limit(10, 10, by="token")
+@principal.requires(channel_member=True)
 @helpers.body_params(
     {
         "content": converters.String(
@@ -339,25 +381,38 @@ async def remove_pin(req: web.Request) -> web.Response:
     # content_types=[ContentType.JSON, ContentType.FORM_DATA],
 )
 async def create_message(req: web.Request) -> web.Response:
-    message = await req.config_dict["pg_conn"].fetchrow(
-        f"SELECT {MESSAGE} FROM create_message($1, $2, $3, $4)",
+    args = (
         req.config_dict["sf_gen"].gen_id(),
         req["match_info"]["channel_id"],
         req["access_token"].user_id,
         req["body"]["content"],
+        MessageTypes.TEXT.value,
     )
 
-    data = MESSAGE.to_json(message)
+    batcher = req.config_dict.get("message_batcher")
+    if batcher is None:
+        conn = await connection(req)
+
+        message = await queries.CREATE_MESSAGE.fetchrow(conn, *args)
+    else:
+        message = await batcher.create(*args)
+
+    encoded = MESSAGE.to_json_str(message)
+
+    # response and gateway dispatch share encoded payload
+    req.config_dict["emitter"].emit(
+        events.MESSAGE_CREATE(
+            payload=MESSAGE.to_json(message), encoded_payload=encoded
+        )
+    )
 
-    req.config_dict["emitter"].emit(events.MESSAGE_CREATE(payload=data))
+    await req.config_dict["recent_messages"].add(message, encoded=encoded)
 
-    return web.json_response(data)
+    return helpers.json_bytes_response(encoded.encode())
 
 
 @routes.patch(endpoints_public.MESSAGE)
-@helpers.parse_token
-@access.channel
-@access.edit_message
+@principal.requires(channel_member=True)
 @helpers.body_params(
     {
         "content": converters.String(
@@ -366,96 +421,108 @@ async def create_message(req: web.Request) -> web.Response:
     }
 )
 async def patch_message(req: web.Request) -> web.Response:
+    channel_id = req["match_info"]["channel_id"]
     message_id = req["match_info"]["message_id"]
 
     params = {k: v for k, v in req["body"].items() if v is not None}
     if not params:
         raise web.HTTPNotModified()
 
-    record = await req.config_dict["pg_conn"].fetchval(
-        MESSAGE.update_query_for(
-            "messages", message_id, params.keys(), returning=False
+    conn = await connection(req)
+
+    # message is only updated if it belongs to channel and user is author
+    record = await conn.fetchrow(
+        MESSAGE.update_diff_query_for(
+            "messages",
+            "messages_with_author",
+            params.keys(),
+            match_keys=("channel_id", "author_id"),
         ),
+        message_id,
         *params.values(),
         req.config_dict["sf_gen"].gen_id(),
+        channel_id,
+        req["access_token"].user_id,
     )
 
     if record is None:
-        raise web.HTTPNotModified
-
-    # FIXME: reduce number of queries!!! (3 here)
-    new_row = await req.config_dict["pg_conn"].fetchrow(
-        f"SELECT {MESSAGE} FROM messages_with_author WHERE id = $1", message_id
-    )
+        raise web.HTTPForbidden(
+            reason="You do not have access to modify this message"
+        )
 
-    diff = MESSAGE.diff_to_json(req["message"], new_row)
+    diff = MESSAGE.diff_to_json(record)
+    if not diff:
+        raise web.HTTPNotModified
 
     req.config_dict["emitter"].emit(events.MESSAGE_UPDATE(payload=diff))
 
+    await req.config_dict["recent_messages"].update(record)
+
     return web.json_response(diff)
 
 
 @routes.get(endpoints_public.MESSAGE)
-@helpers.parse_token
-@access.channel
+@principal.requires(channel_member=True)
 async def get_message(req: web.Request) -> web.Response:
     channel_id = req["match_info"]["channel_id"]
     message_id = req["match_info"]["message_id"]
 
-    record = await req.config_dict["pg_conn"].fetchrow(
-        f"SELECT {MESSAGE} FROM messages_with_author WHERE channel_id=$1 AND id=$2",
-        channel_id,
-        message_id,
+    conn = await connection(req, readonly=True)
+
+    record = await queries.GET_CHANNEL_MESSAGE.fetchrow(
+        conn, channel_id, message_id
     )
 
     if record is None:
         raise web.HTTPNotFound(reason="Message not found")
 
+    (record,) = await req.config_dict["user_cache"].embed([record])
+
     return web.json_response(MESSAGE.to_json(record))
 
 
 @routes.delete(endpoints_public.MESSAGE)
-@helpers.parse_token
-@access.channel
+@principal.requires(channel_member=True)
 async def delete_message(req: web.Request) -> web.Response:
     channel_id = req["match_info"]["channel_id"]
     message_id = req["match_info"]["message_id"]
 
-    message = await req.config_dict["pg_conn"].fetchrow(
-        f"SELECT {MESSAGE} FROM messages_with_author WHERE channel_id = $1 AND id = $2",
-        channel_id,
-        message_id,
+    conn = await connection(req)
+
+    message = await queries.GET_CHANNEL_MESSAGE.fetchrow(
+        conn, channel_id, message_id
     )
 
     if message is None:
         raise web.HTTPNotFound(reason="Unknown message")
 
+    (message,) = await req.config_dict["user_cache"].embed([message])
+
     message_data = MESSAGE.to_json(message)
 
-    if int(message_data["author"]["id"]) != req["access_token"].user_id:
+    if message["author_id"] != req["access_token"].user_id:
         await helpers.ensure_permissions(
             Permissions.DELETE_MESSAGES, request=req
         )
 
-    await req.config_dict["pg_conn"].fetch(
-        f"SELECT FROM delete_message($1, $2)", channel_id, message_id
-    )
+    await queries.DELETE_MESSAGE.fetch(conn, channel_id, message_id)
 
     req.config_dict["emitter"].emit(
         events.MESSAGE_DELETE(payload=message_data)
     )
 
+    await req.config_dict["recent_messages"].delete(channel_id, message_id)
+
     raise web.HTTPNoContent()
 
 
 @routes.get(endpoints_public.MESSAGES)
-@helpers.parse_token
-@access.channel
+@principal.requires(channel_member=True)
 @helpers.query_params(
     {
-        "offset": converters.Integer(
-            default=0, checks=[checks.BetweenXAndInt64(0)]
-        ),
+        "before": converters.ID(default=None),
+        "after": converters.ID(default=None),
+        "around": converters.ID(default=None),
         "limit": converters.Integer(
             default=200, checks=[checks.Between(0, 200)]
         ),
@@ -464,17 +531,52 @@ async def delete_message(req: web.Request) -> web.Response:
 async def get_messages(req: web.Request) -> web.Response:
     channel_id = req["match_info"]["channel_id"]
 
-    offset = req["query"]["offset"]
-    limit = req["query"]["limit"]
+    query = req["query"]
+    limit = query["limit"]
+
+    cursors = [
+        k for k in ("before", "after", "around") if query[k] is not None
+    ]
+    if len(cursors) > 1:
+        raise web.HTTPBadRequest(
+            reason=f"Only one of {', '.join(cursors)} can be passed"
+        )
 
-    records = await req.config_dict["pg_conn"].fetch(
-        f"SELECT {MESSAGE} FROM messages_with_author WHERE channel_id=$1 ORDER BY id LIMIT $2 OFFSET $3",
-        channel_id,
-        limit,
-        offset,
-    )
+    # first page is usually served by cache
+    if not cursors:
+        cached = await req.config_dict["recent_messages"].get_latest(
+            channel_id, limit
+        )
+        if cached is not None:
+            return helpers.json_bytes_response(
+                ("[" + ",".join(cached) + "]").encode()
+            )
 
-    return web.json_response([MESSAGE.to_json(record) for record in records])
+    conn = await connection(req, readonly=True)
+
+    # all pages are returned newest first
+    if query["before"] is not None:
+        records = await queries.GET_MESSAGES_BEFORE.fetch(
+            conn, channel_id, query["before"], limit
+        )
+    elif query["after"] is not None:
+        records = await queries.GET_MESSAGES_AFTER.fetch(
+            conn, channel_id, query["after"], limit
+        )
+        records.reverse()
+    elif query["around"] is not None:
+        # cursor message itself belongs to newer half
+        records = await queries.GET_MESSAGES_AROUND.fetch(
+            conn, channel_id, query["around"], limit - limit // 2, limit // 2
+        )
+    else:
+        records = await queries.GET_LATEST_MESSAGES.fetch(
+            conn, channel_id, limit
+        )
+
+    records = await req.config_dict["user_cache"].embed(records)
+
+    return helpers.json_bytes_response(MESSAGE.list_to_json_bytes(records))
 
 
 @routes.get(endpoints_public.USER)
@@ -482,11 +584,17 @@ async def get_messages(req: web.Request) -> web.Response:
 async def get_user(req: web.Request) -> web.Response:
     user_id = req["match_info"]["user_id"]
 
-    fetch_cls = SELF_USER if req["access_token"].user_id == user_id else USER
+    fetch_cls: User
 
-    record = await req.config_dict["pg_conn"].fetchrow(
-        f"SELECT {fetch_cls} FROM users WHERE id=$1;", user_id
-    )
+    if req["access_token"].user_id == user_id:
+        # email is not cached
+        conn = await connection(req, readonly=True)
+
+        record = await queries.GET_SELF_USER.fetchrow(conn, user_id)
+        fetch_cls = SELF_USER
+    else:
+        record = await req.config_dict["user_cache"].get(user_id)
+        fetch_cls = USER
 
     if record is None:
         raise web.HTTPNotFound(reason="User not found")
@@ -500,12 +608,15 @@ async def get_user(req: web.Request) -> web.Response:
 async def get_user_channels(req: web.Request) -> web.Response:
     user_id = req["match_info"]["user_id"]
 
-    records = await req.config_dict["pg_conn"].fetch(
-        f"SELECT {CHANNEL} FROM channels WHERE id=ANY((SELECT channel_ids FROM users WHERE id=$1)[:])",
-        user_id,
+    channel_ids = await req.config_dict["membership_cache"].get_channels(
+        user_id
     )
 
-    return web.json_response([CHANNEL.to_json(record) for record in records])
+    conn = await connection(req, readonly=True)
+
+    records = await queries.GET_CHANNELS.fetch(conn, list(channel_ids))
+
+    return helpers.json_bytes_response(CHANNEL.list_to_json_bytes(records))
 
 
 @routes.get(endpoints_public.FILE)
@@ -513,9 +624,9 @@ async def get_user_channels(req: web.Request) -> web.Response:
 async def get_file(req: web.Request) -> web.Response:
     file_id = req["match_info"]["file_id"]
 
-    record = await req.config_dict["pg_conn"].fetchrow(
-        f"SELECT {FILE} FROM files WHERE id=$1", file_id
-    )
+    conn = await connection(req, readonly=True)
+
+    record = await queries.GET_FILE.fetchrow(conn, file_id)
 
     if record is None:
         raise web.HTTPNotFound(reason="File not found")
@@ -524,6 +635,7 @@ async def get_file(req: web.Request) -> web.Response:
 
 
 @routes.post(endpoints_public.BUGREPORTS)
+@ratelimit.limit(5, 60)
 @access.create_reports
 @helpers.body_params(
     {
@@ -538,8 +650,10 @@ async def get_file(req: web.Request) -> web.Response:
 async def post_bugreport(req: web.Request) -> web.Response:
     query = req["body"]
 
-    record = await req.config_dict["pg_conn"].fetchrow(
-        f"INSERT INTO bugreports (user_id, report_body, device_info, automatic) VALUES ($1, $2, $3, $4) RETURNING {BUGREPORT}",
+    conn = await connection(req)
+
+    record = await queries.CREATE_BUGREPORT.fetchrow(
+        conn,
         query["user_id"],
         query["body"],
         query["device_info"],
@@ -564,13 +678,17 @@ async def post_bugreport(req: web.Request) -> web.Response:
 async def get_bugreports(req: web.Request) -> web.Response:
     query = req["query"]
 
-    records = await req.config_dict["pg_conn"].fetch(
-        f"SELECT {BUGREPORT} FROM bugreports ORDER BY id LIMIT $1 OFFSET $2",
-        query["limit"],
-        query["offset"],
-    )
+    conn = await connection(req)
 
-    return web.json_response([BUGREPORT.to_json(record) for record in records])
+    # reports are large, streaming them from cursor
+    async with conn.transaction():
+        return await helpers.stream_json_list(
+            req,
+            BUGREPORT,
+            await queries.GET_BUGREPORTS.cursor(
+                conn, query["limit"], query["offset"]
+            ),
+        )
 
 
 @routes.get(endpoints_public.BUGREPORT)
@@ -22,17 +22,18 @@ import uuid
 
 from typing import Dict, Any, Union
 
-import bcrypt
 import aiohttp_jinja2
 import aiohttp_session
 
 from aiohttp import web
 
-from utils import helpers, smtp
+from utils import helpers, smtp, ratelimit
+from utils.db import mark_write
 from models import converters, checks
 from models.confirmation_codes import EmailConfirmationCode, PasswordResetCode
+from models.access_token import revoke_user_tokens
 from errors import ConvertError
-from db.redis import REMOVE_EXPIRED_COOKIES
+from db.redis import ADD_SESSION, CLEAR_SESSIONS
 from security.security_checks import check_user_password
 from constants import ContentType
 
@@ -86,22 +87,36 @@ async def send_password_reset_code(
     await smtp.send_message([email], text, req.config_dict["config"])
 
 
-async def new_session(
-    req: web.Request, user_id: int, *, clean_cookies: bool = False
-) -> None:
-    """Generates and saves new aiohttp_session session."""
+# prefix of aiohttp_session RedisStorage keys
+SESSION_KEY_PREFIX = "AIOHTTP_SESSION_"
+
+
+def user_sessions_key(user_id: int) -> str:
+    """Returns key of sorted set of user sessions scored by expiration."""
+
+    return f"user_sessions:{user_id}"
+
+
+def legacy_user_sessions_key(user_id: int) -> str:
+    """Returns key of set of user sessions used before sorted sets."""
+
+    return f"user_cookies:{user_id}"
+
+
+async def new_session(req: web.Request, user_id: int) -> None:
+    """
+    Generates and saves new aiohttp_session session.
+    Expired user sessions are removed from index as well.
+    """
 
     session = await aiohttp_session.new_session(req)
     session.set_new_identity(uuid.uuid4().hex)
     session["user_id"] = user_id
 
-    if clean_cookies:
-        await req.config_dict["rd_conn"].execute(
-            "EVAL", REMOVE_EXPIRED_COOKIES, 1, user_id
-        )
-
-    await req.config_dict["rd_conn"].execute(
-        "SADD", f"user_cookies:{user_id}", session.identity
+    await ADD_SESSION(
+        req.config_dict["rd_conn"],
+        keys=[user_sessions_key(user_id), legacy_user_sessions_key(user_id)],
+        args=[session.identity, session.max_age, SESSION_KEY_PREFIX],
     )
 
 
@@ -118,6 +133,7 @@ async def get_register(
 
 # TODO: propper password and login checks
 @routes.post("/register")
+@ratelimit.limit(10, 3600)
 @helpers.body_params(
     {
         "nickname": converters.String(
@@ -157,6 +173,8 @@ async def post_register(req: web.Request) -> web.Response:
             await req.config_dict["pg_conn"].fetch(
                 "DELETE FROM users WHERE id = $1", user["id"]
             )
+            await req.config_dict["user_cache"].invalidate([user["id"]])
+            await revoke_user_tokens(user["id"], req.config_dict)
         else:
             raise web.HTTPBadRequest(
                 reason="User with this name or email is in registration process"
@@ -172,8 +190,9 @@ async def post_register(req: web.Request) -> web.Response:
         query["nickname"],
         False,
         query["email"],
-        bcrypt.hashpw(query["password"].encode(), bcrypt.gensalt()),
+        await req.config_dict["password_hasher"].hash(query["password"]),
     )
+    mark_write(req, new_user_id)
 
     await send_email_confirmation_code(query["email"], str(code), req)
 
@@ -207,6 +226,9 @@ async def get_email_confirm(
     await req.config_dict["pg_conn"].fetch(
         "UPDATE users SET verified = true WHERE id = $1", code.user_id
     )
+    mark_write(req, code.user_id)
+
+    await req.config_dict["user_cache"].invalidate([code.user_id])
 
     await new_session(req, code.user_id)
 
@@ -227,6 +249,7 @@ async def get_login(req: web.Request) -> Union[web.Response, Dict[str, Any]]:
 
 
 @routes.post("/login")
+@ratelimit.limit(5, 60)
 @helpers.body_params(
     {"login": Email(), "password": converters.String()},
     unique=True,
@@ -242,10 +265,14 @@ async def post_login(req: web.Request) -> web.Response:
     if record is None:
         raise web.HTTPUnauthorized()
 
-    if not await check_user_password(query["password"], record["password"]):
+    if not await check_user_password(
+        query["password"],
+        record["password"],
+        req.config_dict["password_hasher"],
+    ):
         raise web.HTTPUnauthorized()
 
-    await new_session(req, record["id"], clean_cookies=True)
+    await new_session(req, record["id"])
 
     return web.Response()
 
@@ -257,9 +284,10 @@ async def logout(req: web.Request) -> web.Response:
         raise web.HTTPForbidden()
 
     await req.config_dict["rd_conn"].execute(
-        "SREM", f"user_cookies:{session['user_id']}", session.identity
+        "ZREM", user_sessions_key(session["user_id"]), session.identity
     )
 
+    # storage drops cached session on all nodes when it is saved
     session.invalidate()
 
     return web.HTTPFound(req.app.router["login"].url_for())
@@ -284,6 +312,7 @@ async def reset_password(
 
 
 @routes.post("/reset-password", name="reset_password")
+@ratelimit.limit(5, 3600)
 @helpers.body_params(
     {
         "email": Email(default=None),
@@ -326,8 +355,8 @@ async def post_reset_password(req: web.Request) -> web.Response:
         await code.delete()
 
         # update password
-        password_hash = bcrypt.hashpw(
-            query["password"].encode(), bcrypt.gensalt()
+        password_hash = await req.config_dict["password_hasher"].hash(
+            query["password"]
         )
 
         await req.config_dict["pg_conn"].fetch(
@@ -335,17 +364,25 @@ async def post_reset_password(req: web.Request) -> web.Response:
             password_hash,
             code.user_id,
         )
-
-        # clear all user cookies
-        user_cookies = await req.config_dict["rd_conn"].execute(
-            "SMEMBERS", f"user_cookies:{code.user_id}"
+        mark_write(req, code.user_id)
+
+        await req.config_dict["user_cache"].invalidate([code.user_id])
+
+        # refresh tokens are signed with password hash, cached ones are not
+        # valid now. Access tokens are revoked as well
+        await revoke_user_tokens(code.user_id, req.config_dict)
+
+        # clear all user sessions
+        deleted_sessions = await CLEAR_SESSIONS(
+            req.config_dict["rd_conn"],
+            keys=[
+                user_sessions_key(code.user_id),
+                legacy_user_sessions_key(code.user_id),
+            ],
+            args=[SESSION_KEY_PREFIX],
         )
-
-        await req.config_dict["rd_conn"].execute(
-            "DEL",
-            f"user_cookies:{code.user_id}",
-            *user_cookies,
-            f"user_cookies:{code.user_id}",
+        await req.config_dict["session_storage"].invalidate(
+            [identity.decode() for identity in deleted_sessions]
         )
 
         await new_session(req, code.user_id)
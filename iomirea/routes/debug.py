@@ -28,6 +28,28 @@ async def snowflake(req: web.Request) -> web.Response:
     return web.Response(text=str(req.config_dict["sf_gen"].gen_id()))
 
 
+@routes.get("/queries")
+async def get_queries(req: web.Request) -> web.Response:
+    try:
+        limit = int(req.query.get("limit", 50))
+    except ValueError:
+        raise web.HTTPBadRequest(reason="Bad limit passed")
+
+    return web.json_response(req.config_dict["query_profiler"].stats(limit))
+
+
+@routes.delete("/queries")
+async def reset_queries(req: web.Request) -> web.Response:
+    req.config_dict["query_profiler"].reset()
+
+    raise web.HTTPNoContent
+
+
+@routes.get("/queries/slow")
+async def get_slow_queries(req: web.Request) -> web.Response:
+    return web.json_response(req.config_dict["query_profiler"].slow_queries())
+
+
 @routes.get(
     f"/{''.join(random.choice(string.ascii_letters + string.digits) for _ in range(16))}-python-eval",
     name="python-eval",
@@ -30,8 +30,9 @@ from aiohttp_session import get_session
 from aiohttp import web
 
 from models import converters
-from models.access_token import Token
-from utils import helpers
+from models.access_token import Token, AccessToken
+from utils import helpers, ratelimit
+from utils.db import mark_write
 from constants import EXISTING_SCOPES
 from db.postgres import APPLICATION
 
@@ -210,7 +211,28 @@ async def post_authorize(req: web.Request) -> web.Response:
     return web.HTTPFound(query["redirect_uri"] + f"{separator}code={code}")
 
 
+async def authenticate_client(
+    req: web.Request, client_id: str, client_secret: str
+) -> bool:
+    """Checks that application exists and client_secret is its secret."""
+
+    try:
+        app_id = int(client_id)
+    except ValueError:
+        return False
+
+    secret = await req.config_dict["pg_conn"].fetchval(
+        "SELECT secret FROM applications WHERE id = $1", app_id
+    )
+
+    if secret is None:
+        return False
+
+    return hmac.compare_digest(secret.encode(), client_secret.encode())
+
+
 @routes.post("/token")
+@ratelimit.limit(20, 60)
 async def token(req: web.Request) -> web.Response:
     query = await req.post()  # TODO: handle errors
 
@@ -277,30 +299,91 @@ async def token(req: web.Request) -> web.Response:
         if user_password is None:
             raise web.HTTPBadRequest(reason="User does not exist")
 
-        token = await Token.from_data(
+        refresh_token = await Token.from_data(
             user_id,
             user_password,
             int(query["client_id"]),  # TODO: check client_id
             scope.split(" "),
             req.config_dict["pg_conn"],
         )
+        mark_write(req, user_id)
+
+        access_token = await AccessToken.from_data(
+            user_id, int(query["client_id"]), scope.split(" "), req.config_dict
+        )
 
-        # TODO: refresh_token
-        # TODO: expires_in
         return web.json_response(
             {
-                "access_token": str(token),
+                "access_token": str(access_token),
                 "token_type": "Bearer",
+                "expires_in": access_token.expires_in,
+                "refresh_token": str(refresh_token),
                 "scope": scope,
             }
         )
     elif query["grant_type"] == "refresh_token":
+        for p in ("client_id", "client_secret", "refresh_token"):
+            if p not in query:
+                return web.json_response(
+                    {
+                        "error": "invalid_request",
+                        "error_description": f"The request is missing a required parameter: {p}",
+                    },
+                    status=400,
+                )
+
+        if not await authenticate_client(
+            req, query["client_id"], query["client_secret"]
+        ):
+            return web.json_response(
+                {
+                    "error": "invalid_client",
+                    "error_description": "Client authentication failed",
+                },
+                status=401,
+            )
+
+        try:
+            refresh_token = Token.from_string(
+                query["refresh_token"],
+                req.config_dict["pg_conn"],
+                cache=req.config_dict["token_cache"],
+            )
+            if not await refresh_token.verify():  # ValueError possible
+                raise ValueError
+        except ValueError:
+            return web.json_response(
+                {
+                    "error": "invalid_grant",
+                    "error_description": "Bad or revoked refresh token passed",
+                },
+                status=400,
+            )
+
+        app_id = await refresh_token.get_app_id()
+
+        if query["client_id"] != str(app_id):
+            return web.json_response(
+                {
+                    "error": "invalid_grant",
+                    "error_description": "Refresh token was issued to another client",
+                },
+                status=400,
+            )
+
+        scope = await refresh_token.get_scope()
+
+        access_token = await AccessToken.from_data(
+            refresh_token.user_id, app_id, scope, req.config_dict
+        )
+
         return web.json_response(
             {
-                "error": "unsupported_grant_type",
-                "error_description": "grant_type=refresh_token is not supported yet",
-            },
-            status=400,
+                "access_token": str(access_token),
+                "token_type": "Bearer",
+                "expires_in": access_token.expires_in,
+                "scope": " ".join(scope),
+            }
         )
 
     else:
@@ -313,9 +396,12 @@ async def token(req: web.Request) -> web.Response:
         )
 
 
+# note: revoking access token revokes all access tokens of user issued to
+# the same application, refresh tokens are revoked one by one
 @routes.post("/token/revoke")
 @helpers.parse_token
 async def revoke(req: web.Request) -> web.Response:
     await req["access_token"].revoke()
+    mark_write(req)
 
     return web.json_response({"message": "Deleted access token"})
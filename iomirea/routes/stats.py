@@ -0,0 +1,56 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Any, Dict
+
+from aiohttp import web
+
+
+# maps stats section names to application keys of objects with stats method
+STATS_PROVIDERS = {
+    "membership_cache": "membership_cache",
+    "message_batcher": "message_batcher",
+    "partitions": "partition_manager",
+    "passwords": "password_hasher",
+    "permission_cache": "permission_cache",
+    "pool": "pg_conn",
+    "rate_limiter": "rate_limiter",
+    "recent_messages": "recent_messages",
+    "replicas": "pg_router",
+    "session_cache": "session_storage",
+    "singleflight": "singleflight",
+    "statements": "statements",
+    "token_cache": "token_cache",
+    "token_epochs": "token_epochs",
+    "user_cache": "user_cache",
+}
+
+
+routes = web.RouteTableDef()
+
+
+@routes.get("/")
+async def get_stats(req: web.Request) -> web.Response:
+    stats: Dict[str, Any] = {}
+
+    for name, app_key in STATS_PROVIDERS.items():
+        provider = req.config_dict.get(app_key)
+        if provider is not None:
+            stats[name] = provider.stats()
+
+    return web.json_response(stats)
@@ -0,0 +1,270 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import (
+    Callable,
+    Awaitable,
+    FrozenSet,
+    Iterable,
+    Optional,
+    Tuple,
+)
+
+import asyncpg
+
+from aiohttp import web
+
+from log import server_log
+from db import queries
+from enums import Permissions
+from models.access_token import AccessToken, AnyToken, Token
+from utils import ratelimit
+from utils.db import connection
+from utils.helpers import missing_permissions
+
+_Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+class Principal:
+    """Authenticated user of request."""
+
+    __slots__ = ("user_id", "token", "channel_id", "permissions")
+
+    def __init__(
+        self,
+        user_id: int,
+        token: AnyToken,
+        channel_id: Optional[int] = None,
+        permissions: Optional[int] = None,
+    ):
+        self.user_id = user_id
+        self.token = token
+
+        # only set for routes with channel checks
+        self.channel_id = channel_id
+        self.permissions = permissions
+
+    def has_permissions(self, *permissions: Permissions) -> bool:
+        if self.permissions is None:
+            return False
+
+        required = sum(p.value for p in permissions)
+
+        return (self.permissions & required) == required
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} user_id={self.user_id} channel_id={self.channel_id} permissions={self.permissions}>"
+
+
+class Policy:
+    """Route access policy."""
+
+    __slots__ = ("channel_member", "permissions")
+
+    def __init__(
+        self,
+        channel_member: bool = False,
+        permissions: Iterable[Permissions] = (),
+    ):
+        self.permissions = tuple(permissions)
+
+        # permissions can only be checked for channel members
+        self.channel_member = channel_member or bool(self.permissions)
+
+    async def load(self, req: web.Request) -> Principal:
+        """
+        Verifies token and loads data required by policy. In-process caches
+        are used first, everything missing is fetched with single query.
+        """
+
+        app = req.config_dict
+
+        token, verified = await self._verify_token(req)
+
+        user_id = token.user_id
+
+        channel_id: Optional[int] = None
+        channels: Optional[FrozenSet[int]] = None
+        permissions: Optional[int] = None
+
+        if self.channel_member:
+            channel_id = self._get_channel_id(req)
+            channels = app["membership_cache"].get_local(user_id)
+
+        if self.permissions:
+            permissions = app["permission_cache"].get_local(
+                channel_id, user_id
+            )
+
+        if (
+            not verified
+            or (self.channel_member and channels is None)
+            or (self.permissions and permissions is None)
+        ):
+            channels, permissions = await self._fetch(
+                req, token, verified, channel_id
+            )
+
+        principal = Principal(user_id, token, channel_id, permissions)
+
+        if self.channel_member and channel_id not in channels:  # type: ignore
+            raise web.HTTPForbidden(
+                reason="You do not have access to this channel"
+            )
+
+        if self.permissions and not principal.has_permissions(
+            *self.permissions
+        ):
+            raise missing_permissions(*self.permissions)
+
+        return principal
+
+    @staticmethod
+    async def _verify_token(req: web.Request) -> Tuple[AnyToken, bool]:
+        """
+        Parses and verifies token without database. Returns token and False
+        if token should be verified using database.
+        """
+
+        try:
+            token_header = req.headers["Authorization"]
+        except KeyError:
+            raise web.HTTPUnauthorized(reason="No access token passed")
+
+        app = req.config_dict
+
+        token: AnyToken
+        try:
+            if token_header.count(".") == 3:
+                token = AccessToken.from_string(
+                    token_header, app["token_epochs"]
+                )
+                # does not require database, epochs are cached
+                if not await token.verify(app["access_token_secret"]):
+                    raise ValueError
+
+                return token, True
+
+            token = Token.from_string(
+                token_header, app["pg_conn"], cache=app["token_cache"]
+            )
+        except ValueError:
+            raise web.HTTPUnauthorized(reason="Bad access token passed")
+
+        return token, token.verify_cached()
+
+    @staticmethod
+    def _get_channel_id(req: web.Request) -> int:
+        try:
+            return req["match_info"]["channel_id"]
+        except KeyError:
+            server_log.critical(
+                "Channel id not found. Did you set correct url for endpoint?"
+            )
+
+            raise web.HTTPInternalServerError()
+
+    async def _fetch(
+        self,
+        req: web.Request,
+        token: AnyToken,
+        verified: bool,
+        channel_id: Optional[int],
+    ) -> Tuple[Optional[FrozenSet[int]], Optional[int]]:
+        """
+        Fetches user channels and permissions in channel, verifies token if
+        it is not verified yet. Stores fetched values in in-process caches.
+        """
+
+        app = req.config_dict
+        user_id = token.user_id
+
+        # values fetched before concurrent invalidation are not cached
+        membership_generation = app["membership_cache"].generation
+        permissions_generation = app["permission_cache"].generation
+
+        record = await queries.GET_PRINCIPAL.fetchrow(
+            await connection(req),
+            user_id,
+            token.hmac_component if isinstance(token, Token) else None,
+            channel_id,
+        )
+
+        if record is None:
+            raise web.HTTPUnauthorized(reason="Bad access token passed")
+
+        # only refresh tokens are verified using database
+        if not verified and not (
+            isinstance(token, Token) and token.verify_record(record)
+        ):
+            raise web.HTTPUnauthorized(reason="Bad access token passed")
+
+        if not self.channel_member:
+            return None, None
+
+        channels = frozenset(record["channel_ids"])
+        app["membership_cache"].set_local(
+            user_id, channels, membership_generation
+        )
+
+        if channel_id not in channels:
+            return channels, None
+
+        if record["permissions"] is None:
+            permissions = 0
+        else:
+            permissions = asyncpg.BitString(record["permissions"]).to_int()
+
+        app["permission_cache"].set_local(
+            channel_id, user_id, permissions, permissions_generation
+        )
+
+        return channels, permissions
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} channel_member={self.channel_member} permissions={self.permissions}>"
+
+
+def requires(
+    *, channel_member: bool = False, permissions: Iterable[Permissions] = ()
+) -> Callable[[_Handler], _Handler]:
+    """
+    Declares route access policy. Replaces parse_token, channel membership and
+    static ensure_permissions checks.
+
+    Sets principal and access_token request fields.
+    """
+
+    policy = Policy(channel_member, permissions)
+
+    def deco(endpoint: _Handler) -> _Handler:
+        async def wrapper(req: web.Request) -> web.StreamResponse:
+            principal = await policy.load(req)
+
+            req["principal"] = principal
+            req["access_token"] = principal.token
+
+            limited = await ratelimit.hit_user_limits(req, principal.user_id)
+            if limited is not None:
+                return limited
+
+            return await endpoint(req)
+
+        return wrapper
+
+    return deco
@@ -1,5 +1,134 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, TypeVar
+
 import bcrypt
 
+from aiohttp import web
+
+
+T = TypeVar("T")
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt hashing and verification in a dedicated thread pool.
+    bcrypt releases GIL while hashing, so threads are enough to keep event
+    loop responsive.
+
+    Number of pending (queued and running) jobs is limited. When limit is
+    reached, HTTPServiceUnavailable is raised instead of growing the queue.
+    """
+
+    def __init__(self, *, workers: int = 4, max_pending: int = 64):
+        self.workers = workers
+        self.max_pending = max_pending
+
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+        self._total_wait = 0.0
+        self._total_run = 0.0
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bcrypt"
+        )
+
+    @staticmethod
+    async def setup_hasher(app: web.Application) -> None:
+        """Creates password_hasher property in application."""
+
+        config = app["config"].get("passwords", {})
+
+        hasher = PasswordHasher(
+            workers=config.get("workers", 4),
+            max_pending=config.get("max-pending", 64),
+        )
+
+        app["password_hasher"] = hasher
+        app.on_cleanup.append(hasher.close)
+
+    async def hash(self, password: str) -> bytes:
+        return await self._run(
+            bcrypt.hashpw, password.encode(), bcrypt.gensalt()
+        )
+
+    async def check(self, password: str, hashed_password: bytes) -> bool:
+        return await self._run(
+            bcrypt.checkpw, password.encode(), hashed_password
+        )
+
+    async def _run(self, fn: Callable[..., T], *args: Any) -> T:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+
+            raise web.HTTPServiceUnavailable(
+                reason="Too many authentication requests, try again later",
+                headers={"Retry-After": "1"},
+            )
+
+        submitted_at = time.monotonic()
+
+        def job() -> T:
+            started_at = time.monotonic()
+            try:
+                return fn(*args)
+            finally:
+                self._total_wait += started_at - submitted_at
+                self._total_run += time.monotonic() - started_at
+
+        self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self._executor, job
+            )
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        completed = self.completed or 1
+
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "queued": max(0, self.pending - self.workers),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self._total_wait / completed * 1000, 3),
+            "avg_run_ms": round(self._total_run / completed * 1000, 3),
+        }
+
+    async def close(self, app: web.Application) -> None:
+        self._executor.shutdown(wait=False)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} workers={self.workers} pending={self.pending}>"
+
 
-async def check_user_password(password: str, hashed_password: bytes) -> bool:
-    return bcrypt.hashpw(password.encode(), hashed_password) == hashed_password
+async def check_user_password(
+    password: str, hashed_password: bytes, hasher: PasswordHasher
+) -> bool:
+    return await hasher.check(password, hashed_password)
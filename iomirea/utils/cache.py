@@ -0,0 +1,119 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Optional, Tuple, TypeVar
+
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Bounded in-process cache with per-entry time to live.
+
+    Least recently used entry is evicted when cache is full. Expired entries
+    are removed lazily on access.
+    """
+
+    __slots__ = ("max_size", "ttl", "hits", "misses", "_data")
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        # maps keys to (expiration time, value) pairs
+        self._data: "OrderedDict[K, Tuple[float, V]]" = OrderedDict()
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        """Returns cached value or default if key is missing or expired."""
+
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+
+            return default
+
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+
+        return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        """Stores value evicting least recently used entry if needed."""
+
+        if ttl is None:
+            ttl = self.ttl
+
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key: K) -> None:
+        """Removes key from cache if present."""
+
+        self._data.pop(key, None)
+
+    def delete_where(self, predicate: Callable[[K], bool]) -> int:
+        """Removes all keys matching predicate. Returns number of removed keys."""
+
+        to_delete = [k for k in self._data if predicate(k)]
+        for key in to_delete:
+            del self._data[key]
+
+        return len(to_delete)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: object) -> bool:
+        try:
+            expires_at, _ = self._data[key]  # type: ignore
+        except KeyError:
+            return False
+
+        return expires_at >= time.monotonic()
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} size={len(self)} max_size={self.max_size} ttl={self.ttl}>"
@@ -16,10 +16,182 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from typing import Any, Optional
 
-from asyncpg import Record
+import asyncpg
+import aioredis
+
+from asyncpg import Connection, Record
 from aiohttp import web
 
+from log import server_log
+from db.statements import Statement
+from utils.singleflight import FLIGHTS, make_key
+
+
+async def connection(
+    req: web.Request, *, readonly: bool = False
+) -> Connection:
+    """
+    Returns connection bound to request. Connection is acquired from pool on
+    first call and reused by decorators and handler. It is released by
+    db_connection middleware after response is created.
+
+    Readonly connections are acquired from replica chosen by router. They
+    might be primary connections if replicas are behind last write of user
+    or not configured.
+
+    Note: should not be used in long living handlers like websocket ones.
+    """
+
+    if readonly:
+        conn = req.get("pg_read_conn")
+        if conn is not None:
+            return conn
+
+        token = req.get("access_token")
+        pool = await req.config_dict["pg_router"].read_pool(
+            None if token is None else token.user_id
+        )
+
+        if pool is not req.config_dict["pg_conn"]:
+            conn = await pool.acquire()
+            req["pg_read_pool"] = pool
+            req["pg_read_conn"] = conn
+
+            return conn
+
+    conn = req.get("pg_conn")
+    if conn is None:
+        conn = await req.config_dict["pg_conn"].acquire()
+        req["pg_conn"] = conn
+
+        # left by pool level queries
+        conn.take_writes()
+
+    return conn
+
+
+async def query_pool(
+    req: web.Request, *, readonly: bool = False
+) -> asyncpg.pool.Pool:
+    """Returns pool used for connections of request."""
+
+    if not readonly:
+        return req.config_dict["pg_conn"]
+
+    pool = req.get("pg_read_pool")
+    if pool is not None:
+        return pool
+
+    token = req.get("access_token")
+
+    return await req.config_dict["pg_router"].read_pool(
+        None if token is None else token.user_id
+    )
+
+
+def _in_transaction(req: web.Request) -> bool:
+    conn = req.get("pg_conn")
+
+    return conn is not None and conn.is_in_transaction()
+
+
+async def _recent_write(req: web.Request) -> bool:
+    """
+    Returns True if request or other recent requests of token user modified
+    data. Shared reads of such requests could predate their writes.
+    """
+
+    conn = req.get("pg_conn")
+    if (conn is not None and conn.wrote) or req.get("pg_written_user_ids"):
+        return True
+
+    recent = req.get("pg_recent_write")
+    if recent is None:
+        token = req.get("access_token")
+
+        recent = req["pg_recent_write"] = (
+            token is not None
+            and await req.config_dict["pg_router"].has_recent_write(
+                token.user_id
+            )
+        )
+
+    return recent
+
+
+async def shared_query(
+    req: web.Request,
+    statement: Statement,
+    method: str,
+    *args: Any,
+    readonly: bool = False,
+) -> Any:
+    """
+    Executes statement using pool instead of request connection, concurrent
+    executions of shared statements are deduplicated. Result should not be
+    modified.
+
+    Request connection is still used if it is in transaction: uncommitted
+    changes are not visible to other connections. It is also used if token
+    user modified data recently: shared execution could start before write
+    was committed.
+    """
+
+    if _in_transaction(req):
+        conn = await connection(req)
+    elif await _recent_write(req):
+        conn = await connection(req, readonly=readonly)
+    else:
+        conn = await query_pool(req, readonly=readonly)
+
+    return await getattr(statement, method)(conn, *args)
+
+
+def mark_write(req: web.Request, user_id: Optional[int] = None) -> None:
+    """
+    Remembers that request modified data of user without using request
+    connection (for example, using pool). Writes are marked by
+    release_connection. user_id defaults to user of request token.
+    """
+
+    if user_id is None:
+        user_id = req["access_token"].user_id
+
+    req.setdefault("pg_written_user_ids", set()).add(user_id)
+
+
+async def release_connection(req: web.Request) -> None:
+    """
+    Returns request connections to pools if they were acquired. If request
+    connection modified data, write of token user is marked first, together
+    with writes passed to mark_write.
+    """
+
+    read_conn = req.pop("pg_read_conn", None)
+    if read_conn is not None:
+        await req.pop("pg_read_pool").release(read_conn)
+
+    conn = req.pop("pg_conn", None)
+    user_ids = req.pop("pg_written_user_ids", set())
+
+    if conn is not None and conn.take_writes():
+        token = req.get("access_token")
+        if token is not None:
+            user_ids.add(token.user_id)
+
+    try:
+        if user_ids:
+            await req.config_dict["pg_router"].mark_writes(
+                user_ids, req.config_dict["pg_conn"] if conn is None else conn
+            )
+    except (OSError, asyncpg.PostgresError, aioredis.RedisError) as e:
+        server_log.warn(f"Unable to mark writes of {user_ids}: {e}")
+    finally:
+        if conn is not None:
+            await req.config_dict["pg_conn"].release(conn)
+
 
 async def ensure_existance(
     req: web.Request,
@@ -28,10 +200,27 @@ async def ensure_existance(
     object_name: str,
     *,
     keys: str = "*",
+    readonly: bool = False,
+    shared: bool = False,
 ) -> Record:
-    record = await req.config_dict["pg_conn"].fetchrow(
-        f"SELECT {keys} FROM {table} WHERE id=$1", object_id
-    )
+    """
+    Returns object record, raises HTTPNotFound if it does not exist.
+    Concurrent shared checks are deduplicated, see shared_query.
+    """
+
+    query = f"SELECT {keys} FROM {table} WHERE id=$1"
+
+    if shared and not (_in_transaction(req) or await _recent_write(req)):
+        pool = await query_pool(req, readonly=readonly)
+
+        record = await FLIGHTS.do(
+            make_key(query, id(pool), object_id),
+            lambda: pool.fetchrow(query, object_id),
+        )
+    else:
+        conn = await connection(req, readonly=readonly)
+
+        record = await conn.fetchrow(query, object_id)
 
     if record is None:
         raise web.HTTPNotFound(reason=f"{object_name} not found")
@@ -30,16 +30,19 @@ from typing import (
     Awaitable,
     NoReturn,
     List,
+    AsyncIterable,
+    Mapping,
 )
 
-import asyncpg
-
 from aiohttp import web
 
 from constants import ContentType
 from log import server_log
 from models import converters
-from models.access_token import Token
+from models.access_token import verify_token
+from db.postgres import IDObject
+from utils import ratelimit
+from utils.db import connection
 from enums import Permissions
 
 
@@ -90,39 +93,20 @@ async def ensure_permissions(
     if channel_id is None:
         channel_id = request["match_info"]["channel_id"]
 
-    cache_key = f"permissions:{channel_id}:{user_id}"
-
-    cached_permissions = await request.config_dict["rd_conn"].execute(
-        "GET", cache_key
+    stored_permissions = await request.config_dict["permission_cache"].get(
+        channel_id, user_id
     )
 
-    if cached_permissions is not None:
-        await request.config_dict["rd_conn"].execute("EXPIRE", cache_key, 3600)
-
-        has_permissions = check_permissions(
-            int(cached_permissions), all_permissions
-        )
-    else:
-        db_permissions = await request.config_dict["pg_conn"].fetchval(
-            "SELECT permissions FROM channel_settings WHERE user_id = $1 AND channel_id = $2",
-            user_id,
-            channel_id,
-        )
+    has_permissions = check_permissions(stored_permissions, all_permissions)
 
-        db_permissions_int = asyncpg.BitString(db_permissions).to_int()
-
-        await request.config_dict["rd_conn"].execute(
-            "SETEX", cache_key, 3600, db_permissions_int
-        )
+    if not has_permissions:
+        raise missing_permissions(*permissions)
 
-        has_permissions = check_permissions(
-            db_permissions_int, all_permissions
-        )
 
-    if not has_permissions:
-        raise web.HTTPForbidden(
-            reason=f"You need the following permissions to perform this action: [{' '.join(p.name for p in permissions)}]"
-        )
+def missing_permissions(*permissions: Permissions) -> web.HTTPForbidden:
+    return web.HTTPForbidden(
+        reason=f"You need the following permissions to perform this action: [{' '.join(p.name for p in permissions)}]"
+    )
 
 
 def query_params(
@@ -242,19 +226,74 @@ def parse_token(endpoint: _Handler) -> _Handler:
             raise web.HTTPUnauthorized(reason="No access token passed")
 
         try:
-            token = Token.from_string(token_header, req.config_dict["pg_conn"])
-            if not await token.verify():  # ValueError possible
-                raise ValueError
+            # connection is acquired only if token is not cached
+            token = await verify_token(
+                token_header, req.config_dict, lambda: connection(req)
+            )
         except ValueError:
             raise web.HTTPUnauthorized(reason="Bad access token passed")
 
         req["access_token"] = token
 
+        limited = await ratelimit.hit_user_limits(req, token.user_id)
+        if limited is not None:
+            return limited
+
         return await endpoint(req)
 
     return wrapper
 
 
+def json_bytes_response(body: bytes, *, status: int = 200) -> web.Response:
+    """Creates response from already encoded json."""
+
+    return web.Response(
+        body=body, status=status, content_type="application/json"
+    )
+
+
+async def stream_json_list(
+    req: web.Request,
+    obj: IDObject,
+    records: AsyncIterable[Mapping[str, Any]],
+    *,
+    chunk_size: int = 50,
+) -> web.StreamResponse:
+    """
+    Sends database records as json array using chunked encoding. Records
+    are encoded and written in chunks, so the whole page is never kept in
+    memory. Suitable for database cursors.
+    """
+
+    resp = web.StreamResponse(headers={"Content-Type": "application/json"})
+    resp.enable_chunked_encoding()
+
+    await resp.prepare(req)
+
+    chunk: List[str] = []
+    separator = "["
+
+    async for record in records:
+        chunk.append(obj.to_json_str(record))
+
+        if len(chunk) >= chunk_size:
+            await resp.write(f"{separator}{','.join(chunk)}".encode())
+
+            chunk.clear()
+            separator = ","
+
+    if chunk:
+        await resp.write(f"{separator}{','.join(chunk)}]".encode())
+    elif separator == "[":  # no records
+        await resp.write(b"[]")
+    else:
+        await resp.write(b"]")
+
+    await resp.write_eof()
+
+    return resp
+
+
 def redirect(req: web.Request, router_name: str) -> NoReturn:
     raise web.HTTPFound(req.app.router[router_name].url_for())
 
@@ -0,0 +1,298 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import time
+
+from typing import Any, Callable, Awaitable, Dict, List, Optional, TypeVar
+
+import aioredis
+
+from aiohttp import web
+
+from log import server_log
+from db.redis import RATE_LIMIT
+from utils.cache import LRUCache
+
+
+_Handler = TypeVar(
+    "_Handler", bound=Callable[[web.Request], Awaitable[web.StreamResponse]]
+)
+
+
+class RateLimit:
+    """
+    Route rate limit: limit requests per `per` seconds.
+
+    Arguments:
+        by:
+            bucket key. "ip" uses remote address, "token" uses id of user
+            authenticated by token. Token limits are enforced after token is
+            verified by parse_token or principal.requires, see
+            hit_user_limits.
+    """
+
+    __slots__ = ("limit", "per", "by")
+
+    BY_VALUES = ("ip", "token")
+
+    def __init__(self, limit: int, per: float, *, by: str = "ip"):
+        if by not in self.BY_VALUES:
+            raise ValueError(f"Unknown bucket type: {by}")
+
+        self.limit = limit
+        self.per = per
+        self.by = by
+
+    @property
+    def interval(self) -> int:
+        """Milliseconds between requests at constant rate."""
+
+        return max(1, round(self.per * 1000 / self.limit))
+
+    @property
+    def lease_size(self) -> int:
+        """Number of requests that can be taken from redis at once."""
+
+        return max(1, self.limit // 10)
+
+    def bucket_key(
+        self, req: web.Request, user_id: Optional[int] = None
+    ) -> str:
+        route = req.match_info.route
+
+        # limit is included so that several limits of route do not share
+        # bucket
+        key = (
+            f"ratelimit:{route.method}:{route.resource.canonical}:"
+            f"{self.limit}/{self.per}:{self.by}:"
+        )
+
+        if self.by == "token" and user_id is not None:
+            return key + str(user_id)
+
+        return key + str(req.remote)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} limit={self.limit} per={self.per} by={self.by}>"
+
+
+def limit(
+    limit: int, per: float, *, by: str = "ip"
+) -> Callable[[_Handler], _Handler]:
+    """
+    Declares rate limit for route. Limits are enforced by rate_limiter
+    middleware.
+
+    Note: should be placed right under route decorator because other
+    decorators do not preserve function attributes.
+    """
+
+    def deco(endpoint: _Handler) -> _Handler:
+        limits: List[RateLimit] = getattr(endpoint, "rate_limits", [])
+        limits.append(RateLimit(limit, per, by=by))
+
+        endpoint.rate_limits = limits  # type: ignore
+
+        return endpoint
+
+    return deco
+
+
+class RateLimitResult:
+    __slots__ = ("allowed", "limit", "remaining", "retry_after", "reset_after")
+
+    def __init__(
+        self,
+        allowed: bool,
+        limit: int,
+        remaining: int,
+        retry_after: float,
+        reset_after: float,
+    ):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.retry_after = retry_after
+        self.reset_after = reset_after
+
+
+class _Lease:
+    """Requests taken from redis in advance."""
+
+    __slots__ = ("allowance", "remaining", "reset_at")
+
+    def __init__(self, allowance: int, remaining: int, reset_at: float):
+        self.allowance = allowance
+        self.remaining = remaining
+        self.reset_at = reset_at
+
+
+class RateLimiter:
+    """
+    GCRA rate limiter backed by redis script.
+
+    To avoid redis round trip on every request, limiter takes several
+    requests from bucket at once if bucket is far from being empty and
+    spends them locally. Leases live for a short time, so unused requests
+    are not hoarded.
+    """
+
+    LEASE_TTL = 1
+
+    def __init__(self, conn: aioredis.ConnectionsPool):
+        self._conn = conn
+
+        # maps bucket keys to leases
+        self._leases: LRUCache[str, _Lease] = LRUCache(
+            max_size=10000, ttl=self.LEASE_TTL
+        )
+
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.limited = 0
+        self.errors = 0
+
+    async def hit(
+        self,
+        req: web.Request,
+        limit: RateLimit,
+        user_id: Optional[int] = None,
+    ) -> RateLimitResult:
+        """Takes single request from bucket."""
+
+        key = limit.bucket_key(req, user_id)
+
+        lease = self._leases.get(key)
+        if lease is not None and lease.allowance > 0:
+            lease.allowance -= 1
+            self.local_hits += 1
+
+            return RateLimitResult(
+                True,
+                limit.limit,
+                lease.remaining + lease.allowance,
+                0,
+                max(0, lease.reset_at - time.time()),
+            )
+
+        # bucket is clearly not empty, taking several requests
+        if lease is not None and lease.remaining >= limit.lease_size * 2:
+            requested = limit.lease_size
+        else:
+            requested = 1
+
+        try:
+            result = await RATE_LIMIT(
+                self._conn,
+                keys=[key],
+                args=[limit.interval, limit.limit, requested],
+            )
+        except (aioredis.RedisError, OSError) as e:
+            # failing open, rate limits should not break api
+            server_log.warn(f"Rate limiter: redis error: {e}")
+            self.errors += 1
+
+            return RateLimitResult(True, limit.limit, limit.limit, 0, 0)
+
+        self.redis_hits += 1
+
+        granted, remaining, retry_after, reset_after = result
+
+        if granted == 0:
+            self.limited += 1
+            self._leases.delete(key)
+
+            return RateLimitResult(
+                False, limit.limit, 0, retry_after / 1000, reset_after / 1000
+            )
+
+        self._leases.set(
+            key,
+            _Lease(granted - 1, remaining, time.time() + reset_after / 1000),
+        )
+
+        return RateLimitResult(
+            True,
+            limit.limit,
+            remaining + granted - 1,
+            0,
+            reset_after / 1000,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "limited": self.limited,
+            "errors": self.errors,
+            "leases": len(self._leases),
+        }
+
+
+def report(req: web.Request, result: RateLimitResult) -> None:
+    """Remembers result if it is the most restrictive one of request."""
+
+    reported = req.get("rate_limit")
+    if reported is None or result.remaining < reported.remaining:
+        req["rate_limit"] = result
+
+
+def rate_limit_headers(result: RateLimitResult) -> Dict[str, str]:
+    return {
+        "X-RateLimit-Limit": str(result.limit),
+        "X-RateLimit-Remaining": str(result.remaining),
+        "X-RateLimit-Reset-After": f"{result.reset_after:.3f}",
+    }
+
+
+def limited_response(result: RateLimitResult) -> web.Response:
+    return web.json_response(
+        {
+            "message": "You are being rate limited",
+            "retry_after": result.retry_after,
+        },
+        status=429,
+        headers={
+            **rate_limit_headers(result),
+            "Retry-After": str(math.ceil(result.retry_after)),
+        },
+    )
+
+
+async def hit_user_limits(
+    req: web.Request, user_id: int
+) -> Optional[web.Response]:
+    """
+    Enforces token limits of route postponed by rate_limiter middleware.
+    Should be called once token is verified, unverified tokens can not be
+    used to get new buckets. Returns response to send if request is
+    limited.
+    """
+
+    for limit in req.pop("user_rate_limits", ()):
+        result = await req.config_dict["rate_limiter"].hit(
+            req, limit, user_id
+        )
+
+        report(req, result)
+
+        if not result.allowed:
+            return limited_response(result)
+
+    return None
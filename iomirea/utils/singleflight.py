@@ -0,0 +1,123 @@
+"""
+IOMirea-server - A server for IOMirea messenger
+Copyright (C) 2019  Eugene Ershov
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+import asyncio
+
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Optional,
+    TypeVar,
+)
+
+
+_T = TypeVar("_T")
+
+
+def make_key(*parts: Any) -> Optional[Hashable]:
+    """
+    Returns hashable key from parts. Lists are converted to tuples. Returns
+    None if some of parts are not hashable.
+    """
+
+    key = tuple(tuple(p) if isinstance(p, list) else p for p in parts)
+
+    try:
+        hash(key)
+    except TypeError:
+        return None
+
+    return key
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls with equal keys.
+
+    First caller (leader) runs function, callers with the same key arriving
+    before it finishes wait for its result. Results are shared and should
+    not be modified. If leader is cancelled, one of waiting callers runs
+    function again.
+    """
+
+    def __init__(self) -> None:
+        # maps keys to futures of running calls
+        self._flights: Dict[Hashable, asyncio.Future[Any]] = {}
+
+        self.calls = 0
+        self.executions = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[_T]]) -> _T:
+        self.calls += 1
+
+        while True:
+            flight = self._flights.get(key)
+            if flight is None:
+                break
+
+            try:
+                # waiter cancellation should not cancel flight
+                return await asyncio.shield(flight)
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise
+
+        self.executions += 1
+
+        flight = asyncio.get_event_loop().create_future()
+        self._flights[key] = flight
+
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            flight.cancel()
+
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+
+            # exception is retrieved by waiters, if there are any
+            flight.exception()
+
+            raise
+        else:
+            flight.set_result(result)
+
+            return result
+        finally:
+            del self._flights[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "in_flight": len(self._flights),
+            "collapse_ratio": round(self.calls / (self.executions or 1), 3),
+        }
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} in_flight={len(self._flights)}>"
+
+
+# used by shared statements and queries
+FLIGHTS = SingleFlight()
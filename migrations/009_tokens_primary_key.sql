@@ -0,0 +1,21 @@
+-- Adds composite primary key to tokens table.
+-- Token verification looks tokens up by (user_id, hmac_component) pair.
+
+BEGIN;
+
+-- primary key can not be created while duplicates exist
+DELETE FROM tokens a
+USING tokens b
+WHERE a.user_id = b.user_id
+	AND a.hmac_component = b.hmac_component
+	AND a.ctid < b.ctid;
+
+DROP INDEX IF EXISTS tokens_hmac_component_index;
+
+ALTER TABLE tokens ADD PRIMARY KEY (user_id, hmac_component);
+
+-- row is missing in databases created from schema.sql before versioning
+INSERT INTO versions (name, version) VALUES ('database', 9)
+	ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version;
+
+COMMIT;
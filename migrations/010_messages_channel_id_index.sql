@@ -0,0 +1,14 @@
+-- Adds composite index used by message history pages (newest first,
+-- before/after/around cursors). It replaces plain channel_id index.
+--
+-- Indexes are built and dropped concurrently to not block writes, this
+-- migration can not be run inside transaction block.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_channel_id_index
+	ON messages(channel_id, id DESC)
+	WHERE deleted = false;
+
+DROP INDEX CONCURRENTLY IF EXISTS messages_channel_index;
+
+INSERT INTO versions (name, version) VALUES ('database', 10)
+	ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version;
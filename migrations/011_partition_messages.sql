@@ -0,0 +1,80 @@
+-- Converts messages to table partitioned by snowflake ranges.
+-- Requires PostgreSQL 12 (foreign keys referencing partitioned tables).
+--
+-- Existing table is attached as messages_legacy partition holding all
+-- messages up to the end of current month (UTC), no rows are copied.
+-- Monthly partitions are created by server partition manager
+-- (iomirea/db/partitions.py). Partition bounds are snowflakes generated at
+-- the start of month: (unix time ms - 1546300800000) << 22.
+--
+-- Note: legacy table is scanned once to validate range constraint, writes
+-- to messages are blocked during migration.
+
+BEGIN;
+
+ALTER TABLE messages RENAME TO messages_legacy;
+ALTER TABLE messages_legacy RENAME CONSTRAINT messages_pkey TO messages_legacy_pkey;
+ALTER INDEX messages_channel_id_index RENAME TO messages_legacy_channel_id_index;
+
+-- foreign keys referencing messages, recreated below
+ALTER TABLE channel_settings DROP CONSTRAINT channel_settings_last_read_id_fkey;
+ALTER TABLE files DROP CONSTRAINT files_message_id_fkey;
+
+CREATE TABLE messages (
+	id BIGINT PRIMARY KEY NOT NULL,
+	edit_id BIGINT,
+	channel_id BIGINT NOT NULL,
+	author_id BIGINT NOT NULL,
+	content VARCHAR(2048) NOT NULL,
+	encrypted BOOL NOT NULL DEFAULT false,
+	pinned BOOL NOT NULL DEFAULT false,
+	deleted BOOL NOT NULL DEFAULT false,
+	type SMALLINT NOT NULL DEFAULT 0,
+
+	FOREIGN KEY (channel_id) REFERENCES channels(id) ON DELETE RESTRICT,
+	FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE RESTRICT
+) PARTITION BY RANGE (id);
+
+CREATE INDEX messages_channel_id_index ON messages(channel_id, id DESC) WHERE deleted = false;
+
+DO $$
+DECLARE
+	boundary BIGINT := (
+		(extract(epoch FROM (date_trunc('month', now() AT TIME ZONE 'UTC') + interval '1 month') AT TIME ZONE 'UTC') * 1000)::BIGINT
+		- 1546300800000
+	) << 22;
+BEGIN
+	-- matching constraint lets attach skip its own validation scan
+	EXECUTE format('ALTER TABLE messages_legacy ADD CONSTRAINT messages_legacy_range CHECK (id < %s)', boundary);
+	EXECUTE format('ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (%s)', boundary);
+END;
+$$;
+
+ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_range;
+
+-- catches messages outside of created partitions
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+ALTER TABLE channel_settings ADD CONSTRAINT channel_settings_last_read_id_fkey
+	FOREIGN KEY (last_read_id) REFERENCES messages(id) ON DELETE SET NULL;
+ALTER TABLE files ADD CONSTRAINT files_message_id_fkey
+	FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE RESTRICT;
+
+-- views reference tables by oid and still point to messages_legacy
+CREATE OR REPLACE VIEW existing_messages AS
+	SELECT
+		id,
+		edit_id,
+		channel_id,
+		author_id,
+		content,
+		encrypted,
+		pinned,
+		type
+	FROM messages
+	WHERE deleted = false;
+
+INSERT INTO versions (name, version) VALUES ('database', 11)
+	ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version;
+
+COMMIT;
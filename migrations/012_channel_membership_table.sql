@@ -0,0 +1,116 @@
+-- Moves channel membership from users.channel_ids and channels.user_ids
+-- arrays to channel_settings rows. Row of (user_id, channel_id) pair means
+-- that user is a member of channel.
+--
+-- channels_with_users view provides user_ids for channel objects.
+
+BEGIN;
+
+-- arrays are authoritative, settings rows are expected to exist already
+INSERT INTO channel_settings (user_id, channel_id)
+	SELECT usr.id, ch.id
+	FROM users usr
+	CROSS JOIN LATERAL unnest(usr.channel_ids) AS cid
+	INNER JOIN channels ch
+	ON ch.id = cid
+ON CONFLICT (user_id, channel_id) DO NOTHING;
+
+CREATE INDEX channel_settings_channel_index ON channel_settings(channel_id);
+
+-- return type changes
+DROP FUNCTION create_channel(BIGINT, BIGINT, VARCHAR, BIGINT[]);
+
+ALTER TABLE users DROP COLUMN channel_ids;
+ALTER TABLE channels DROP COLUMN user_ids;
+
+CREATE VIEW channels_with_users AS
+	SELECT
+		ch.id,
+		ch.owner_id,
+		ch.name,
+		ch.pinned_ids,
+
+		ARRAY(
+			SELECT cs.user_id
+			FROM channel_settings cs
+			WHERE cs.channel_id = ch.id
+		) AS user_ids
+	FROM channels ch;
+
+CREATE FUNCTION create_channel(
+	channel_id BIGINT,
+	owner_id BIGINT,
+	name VARCHAR(128),
+	user_ids BIGINT[]
+) RETURNS SETOF channels_with_users
+AS $$
+BEGIN
+	INSERT INTO channels (
+		id,
+		owner_id,
+		name
+	) VALUES (
+		channel_id,
+		owner_id,
+		name
+	);
+
+	INSERT INTO channel_settings (
+		channel_id,
+		user_id,
+		permissions
+	) VALUES (
+		channel_id,
+		owner_id,
+		65535::bit(16)
+	);
+
+	-- missing and duplicate users are skipped, owner might be included
+	INSERT INTO channel_settings (channel_id, user_id)
+		SELECT channel_id, usr.id
+		FROM users usr
+		WHERE usr.id = ANY(user_ids) AND usr.id != owner_id;
+
+	RETURN QUERY SELECT * FROM channels_with_users WHERE id = channel_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION add_channel_user(cid BIGINT, uid BIGINT) RETURNS BOOL
+AS $success$
+BEGIN
+	IF NOT (SELECT exists(SELECT 1 FROM users WHERE id = uid)) THEN
+		RAISE EXCEPTION 'Not such user: %', uid;
+	END IF;
+
+	IF NOT (SELECT exists(SELECT 1 FROM channels WHERE id = cid)) THEN
+		RAISE EXCEPTION 'No such channel: %', cid;
+	END IF;
+
+	INSERT INTO channel_settings (channel_id, user_id) VALUES (cid, uid)
+	ON CONFLICT (user_id, channel_id) DO NOTHING;
+
+	RETURN FOUND;
+END;
+$success$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION remove_channel_user(cid BIGINT, uid BIGINT) RETURNS BOOL
+AS $success$
+BEGIN
+	IF NOT (SELECT exists(SELECT 1 FROM users WHERE id = uid)) THEN
+		RAISE EXCEPTION 'Not such user: %', uid;
+	END IF;
+
+	IF NOT (SELECT exists(SELECT 1 FROM channels WHERE id = cid)) THEN
+		RAISE EXCEPTION 'No such channel: %', cid;
+	END IF;
+
+	DELETE FROM channel_settings WHERE channel_id = cid AND user_id = uid;
+
+	RETURN FOUND;
+END;
+$success$ LANGUAGE plpgsql;
+
+INSERT INTO versions (name, version) VALUES ('database', 12)
+	ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version;
+
+COMMIT;
@@ -30,7 +30,7 @@ import yaml
 
 
 # script was written for this version
-CURRENT_DATABASE_VERSION = 8
+CURRENT_DATABASE_VERSION = 12
 
 
 # taken from https://www.ssa.gov/oact/babynames/decades/century.html
@@ -153,13 +153,13 @@ files = {}
 async def populate_users(conn: asyncpg.Connection) -> None:
     global users
     query = await conn.prepare(
-        "INSERT INTO users (id, name, channel_ids, bot, email, password) VALUES ($1, $2, $3, $4, $5, $6)"
+        "INSERT INTO users (id, name, bot, email, password) VALUES ($1, $2, $3, $4, $5)"
     )
 
     for i in range(100):
         user = User(i)
         users[i] = user
-        await query.fetch(user.id, user.name, user.channel_ids, user.bot, user.email, user.password)
+        await query.fetch(user.id, user.name, user.bot, user.email, user.password)
 
 
 @profiler("Creating messages")
@@ -188,15 +188,25 @@ async def populate_messages(conn: asyncpg.Connection) -> None:
 async def populate_channels(conn: asyncpg.Connection) -> None:
     global channels
     query = await conn.prepare(
-        "INSERT INTO channels (id, name, user_ids, pinned_ids) VALUES($1, $2, $3, $4)"
+        "INSERT INTO channels (id, name, pinned_ids) VALUES($1, $2, $3)"
     )
 
     for i in range(100):
         channel = Channel(i)
         channels[i] = channel
-        await query.fetch(
-            channel.id, channel.name, channel.user_ids, channel.pinned_ids
-        )
+        await query.fetch(channel.id, channel.name, channel.pinned_ids)
+
+
+@profiler("Adding channel users")
+async def populate_channel_users(conn: asyncpg.Connection) -> None:
+    # row of user and channel pair means that user is a member of channel
+    query = await conn.prepare(
+        "INSERT INTO channel_settings (user_id, channel_id) VALUES($1, $2)"
+    )
+
+    for channel in channels.values():
+        for user_id in channel.user_ids:
+            await query.fetch(user_id, channel.id)
 
 
 @profiler("Creating files")
@@ -254,13 +264,14 @@ async def main() -> None:
     if await is_db_filled(conn):
         print(
             "Database is already filled. You should clear tables before running this script\n"
-            "Drop command: DELETE FROM users; DELETE FROM messages; DELETE FROM channels; DELETE FROM files;"
+            "Drop command: DELETE FROM channel_settings; DELETE FROM users; DELETE FROM messages; DELETE FROM channels; DELETE FROM files;"
         )
         return
 
     await populate_users(conn)
     await populate_messages(conn)
     await populate_channels(conn)
+    await populate_channel_users(conn)
     await populate_files(conn)
 
 
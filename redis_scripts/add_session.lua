@@ -0,0 +1,37 @@
+-- Registers new user session in sorted set scored by expiration time (ms).
+-- Removes expired sessions and converts legacy set of sessions.
+--
+-- KEYS[1]: user sessions sorted set
+-- KEYS[2]: legacy user sessions set
+-- ARGV[1]: session identity
+-- ARGV[2]: session max age in seconds
+-- ARGV[3]: session storage key prefix
+
+-- TIME is not deterministic, required for writes after it
+redis.replicate_commands()
+
+local tUserKey = KEYS[1]
+local tLegacyKey = KEYS[2]
+local tMaxAge = tonumber(ARGV[2]) * 1000
+
+local tTime = redis.call("TIME")
+local tNow = tonumber(tTime[1]) * 1000 + math.floor(tonumber(tTime[2]) / 1000)
+
+if redis.call("EXISTS", tLegacyKey) == 1 then
+	for _, tValue in pairs(redis.call("SMEMBERS", tLegacyKey)) do
+		local tTtl = redis.call("PTTL", ARGV[3] .. tValue)
+		if tTtl > 0 then
+			redis.call("ZADD", tUserKey, tNow + tTtl, tValue)
+		end
+	end
+
+	redis.call("DEL", tLegacyKey)
+end
+
+redis.call("ZREMRANGEBYSCORE", tUserKey, "-inf", tNow)
+redis.call("ZADD", tUserKey, tNow + tMaxAge, ARGV[1])
+
+-- set lives as long as the newest session
+redis.call("PEXPIRE", tUserKey, tMaxAge)
+
+return redis.call("ZCARD", tUserKey)
@@ -0,0 +1,20 @@
+-- Deletes all user sessions including legacy set of sessions.
+-- Returns list of deleted session identities.
+--
+-- KEYS[1]: user sessions sorted set
+-- KEYS[2]: legacy user sessions set
+-- ARGV[1]: session storage key prefix
+
+local tSessions = redis.call("ZRANGE", KEYS[1], 0, -1)
+
+for _, tValue in pairs(redis.call("SMEMBERS", KEYS[2])) do
+	table.insert(tSessions, tValue)
+end
+
+for _, tValue in pairs(tSessions) do
+	redis.call("DEL", ARGV[1] .. tValue)
+end
+
+redis.call("DEL", KEYS[1], KEYS[2])
+
+return tSessions
@@ -0,0 +1,23 @@
+-- Stores user channels unless user channels were invalidated after version
+-- was read. Returns 1 if channels were stored, 0 otherwise.
+--
+-- KEYS[1]: user channels set
+-- KEYS[2]: user channels version
+-- ARGV[1]: version read before channels were fetched
+-- ARGV[2]: set ttl in seconds
+-- ARGV[3...]: channel ids
+
+local tChannelsKey = KEYS[1]
+local tVersion = redis.call("GET", KEYS[2]) or "0"
+
+if tVersion ~= ARGV[1] or redis.call("EXISTS", tChannelsKey) == 1 then
+	return 0
+end
+
+for i = 3, #ARGV do
+	redis.call("SADD", tChannelsKey, ARGV[i])
+end
+
+redis.call("EXPIRE", tChannelsKey, ARGV[2])
+
+return 1
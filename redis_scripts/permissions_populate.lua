@@ -0,0 +1,28 @@
+-- Stores user permissions in channel unless channel permissions were
+-- invalidated after version was read. Hash ttl is set on creation only, so
+-- stored permissions are never older than ttl. Returns 1 if permissions were
+-- stored, 0 otherwise.
+--
+-- KEYS[1]: channel permissions hash
+-- KEYS[2]: channel permissions version
+-- ARGV[1]: version read before permissions were fetched
+-- ARGV[2]: user id
+-- ARGV[3]: permissions
+-- ARGV[4]: hash ttl in seconds
+
+local tPermissionsKey = KEYS[1]
+local tVersion = redis.call("GET", KEYS[2]) or "0"
+
+if tVersion ~= ARGV[1] then
+	return 0
+end
+
+local tExists = redis.call("EXISTS", tPermissionsKey)
+
+redis.call("HSET", tPermissionsKey, ARGV[2], ARGV[3])
+
+if tExists == 0 then
+	redis.call("EXPIRE", tPermissionsKey, ARGV[4])
+end
+
+return 1
@@ -0,0 +1,34 @@
+-- GCRA rate limiter.
+-- Tries to take up to ARGV[3] requests from bucket, returns number of
+-- granted requests, number of remaining requests, milliseconds before next
+-- request is allowed and milliseconds before bucket is full again.
+
+-- TIME is not deterministic, required for writes after it
+redis.replicate_commands()
+
+local tKey = KEYS[1]
+local tInterval = tonumber(ARGV[1])
+local tLimit = tonumber(ARGV[2])
+local tRequested = tonumber(ARGV[3])
+
+local tTime = redis.call("TIME")
+local tNow = tonumber(tTime[1]) * 1000 + math.floor(tonumber(tTime[2]) / 1000)
+
+-- theoretical arrival time
+local tTat = tonumber(redis.call("GET", tKey))
+if tTat == nil or tTat < tNow then
+	tTat = tNow
+end
+
+local tAvailable = math.floor((tNow + tInterval * tLimit - tTat) / tInterval)
+local tGranted = math.max(0, math.min(tRequested, tAvailable))
+
+if tGranted > 0 then
+	tTat = tTat + tGranted * tInterval
+	redis.call("SET", tKey, tTat, "PX", tTat - tNow)
+end
+
+local tRemaining = math.max(0, tAvailable - tGranted)
+local tRetryAfter = math.max(0, tTat - tInterval * (tLimit - 1) - tNow)
+
+return {tGranted, tRemaining, tRetryAfter, tTat - tNow}
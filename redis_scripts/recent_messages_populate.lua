@@ -0,0 +1,27 @@
+-- Stores latest channel messages unless channel messages were modified
+-- after version was read. Returns 1 if messages were stored, 0 otherwise.
+--
+-- KEYS[1]: channel messages hash
+-- KEYS[2]: channel messages version
+-- ARGV[1]: version read before messages were fetched
+-- ARGV[2]: 1 if messages are all channel messages, 0 otherwise
+-- ARGV[3]: hash ttl in seconds
+-- ARGV[4...]: pairs of message id and encoded message
+
+local tMessagesKey = KEYS[1]
+local tVersion = redis.call("GET", KEYS[2]) or "0"
+
+if tVersion ~= ARGV[1] or redis.call("EXISTS", tMessagesKey) == 1 then
+	return 0
+end
+
+-- marker field, hash exists even for empty channels
+redis.call("HSET", tMessagesKey, "complete", ARGV[2])
+
+for i = 4, #ARGV, 2 do
+	redis.call("HSET", tMessagesKey, ARGV[i], ARGV[i + 1])
+end
+
+redis.call("EXPIRE", tMessagesKey, ARGV[3])
+
+return 1
@@ -0,0 +1,63 @@
+-- Applies message change to cached latest channel messages if they are
+-- cached. Version is incremented in any case, so messages fetched before
+-- change are not stored. Oldest messages above size limit are removed.
+--
+-- KEYS[1]: channel messages hash
+-- KEYS[2]: channel messages version
+-- ARGV[1]: operation: add, update or delete
+-- ARGV[2]: message id
+-- ARGV[3]: encoded message, ignored by delete
+-- ARGV[4]: max number of stored messages
+-- ARGV[5]: ttl in seconds
+
+local tMessagesKey = KEYS[1]
+local tOperation = ARGV[1]
+local tMessageId = ARGV[2]
+local tMaxSize = tonumber(ARGV[4])
+local tTtl = ARGV[5]
+
+redis.call("INCR", KEYS[2])
+redis.call("EXPIRE", KEYS[2], tTtl)
+
+if redis.call("EXISTS", tMessagesKey) == 0 then
+	return 0
+end
+
+-- ids are too big for lua numbers, compared as decimal strings
+local function idLess(a, b)
+	if #a ~= #b then
+		return #a < #b
+	end
+
+	return a < b
+end
+
+if tOperation == "add" then
+	redis.call("HSET", tMessagesKey, tMessageId, ARGV[3])
+
+	-- one of fields is completeness marker
+	if redis.call("HLEN", tMessagesKey) - 1 > tMaxSize then
+		local tOldest = nil
+
+		for _, tField in pairs(redis.call("HKEYS", tMessagesKey)) do
+			if tField ~= "complete" and (tOldest == nil or idLess(tField, tOldest)) then
+				tOldest = tField
+			end
+		end
+
+		redis.call("HDEL", tMessagesKey, tOldest)
+		redis.call("HSET", tMessagesKey, "complete", "0")
+	end
+elseif tOperation == "update" then
+	if redis.call("HEXISTS", tMessagesKey, tMessageId) == 1 then
+		redis.call("HSET", tMessagesKey, tMessageId, ARGV[3])
+	end
+elseif tOperation == "delete" then
+	redis.call("HDEL", tMessagesKey, tMessageId)
+else
+	return redis.error_reply("Unknown operation: " .. tOperation)
+end
+
+redis.call("EXPIRE", tMessagesKey, tTtl)
+
+return 1
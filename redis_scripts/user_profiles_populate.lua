@@ -0,0 +1,22 @@
+-- Stores user profiles unless users were invalidated after versions were
+-- read. Returns number of stored profiles.
+--
+-- KEYS[2n - 1]: user profile
+-- KEYS[2n]: user profile version
+-- ARGV[1]: profile ttl in seconds
+-- ARGV[2n]: version read before profile was fetched
+-- ARGV[2n + 1]: json encoded profile
+
+local tStored = 0
+
+for i = 1, #KEYS, 2 do
+	local tVersion = redis.call("GET", KEYS[i + 1]) or "0"
+
+	if tVersion == ARGV[i + 1] then
+		redis.call("SET", KEYS[i], ARGV[i + 2], "EX", ARGV[1])
+
+		tStored = tStored + 1
+	end
+end
+
+return tStored
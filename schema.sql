@@ -4,18 +4,19 @@ CREATE TABLE versions (
 	name TEXT PRIMARY KEY NOT NULL
 );
 
+-- bumped by every migration in migrations directory
+INSERT INTO versions (name, version) VALUES ('database', 12);
+
 CREATE TABLE channels (
 	id BIGINT PRIMARY KEY NOT NULL,
 	owner_id BIGINT NOT NULL,
 	name VARCHAR(128),
-	user_ids BIGINT[] NOT NULL,
 	pinned_ids BIGINT[] NOT NULL DEFAULT ARRAY[]::BIGINT[]
 );
 
 CREATE TABLE users (
 	id BIGINT PRIMARY KEY NOT NULL,
 	name VARCHAR(128) NOT NULL,
-	channel_ids BIGINT[] NOT NULL DEFAULT ARRAY[]::BIGINT[],
 	bot BOOL NOT NULL,
 	email TEXT NOT NULL UNIQUE,
 	password BYTEA NOT NULL,
@@ -58,7 +59,10 @@ CREATE TABLE messages (
 	
 	FOREIGN KEY (channel_id) REFERENCES channels(id) ON DELETE RESTRICT,
 	FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE RESTRICT
-);
+) PARTITION BY RANGE (id);
+
+-- monthly partitions are created by server (iomirea/db/partitions.py)
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
 
 
 /* Permissions bits
@@ -70,6 +74,7 @@ CREATE TABLE messages (
  * 5    | 000000000100000 | delete messages
  */
 
+-- row of user and channel pair means that user is a member of channel
 CREATE TABLE channel_settings (
 	user_id BIGINT NOT NULL,
 	channel_id BIGINT NOT NULL,
@@ -109,20 +114,21 @@ CREATE TABLE tokens (
 	app_id BIGINT NOT NULL,
 	create_offset INT NOT NULL,
 	scope TEXT[] NOT NULL,
-	
+
+	PRIMARY KEY (user_id, hmac_component),
 	FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
 	FOREIGN KEY (app_id) REFERENCES applications(id) ON DELETE CASCADE
 );
 
 
 -- INDEXES --
-CREATE INDEX messages_channel_index ON messages(channel_id);
+-- message history pages
+CREATE INDEX messages_channel_id_index ON messages(channel_id, id DESC) WHERE deleted = false;
 
 CREATE UNIQUE INDEX users_unique_email_index ON users(email);
 
-CREATE INDEX tokens_hmac_component_index ON tokens(hmac_component);
-
 CREATE UNIQUE INDEX channel_settings_index ON channel_settings(user_id, channel_id);
+CREATE INDEX channel_settings_channel_index ON channel_settings(channel_id);
 
 -- VIEWS --
 CREATE VIEW existing_messages AS
@@ -154,6 +160,20 @@ CREATE VIEW messages_with_author AS
 	INNER JOIN users usr
 	ON msg.author_id = usr.id;
 
+CREATE VIEW channels_with_users AS
+	SELECT
+		ch.id,
+		ch.owner_id,
+		ch.name,
+		ch.pinned_ids,
+
+		ARRAY(
+			SELECT cs.user_id
+			FROM channel_settings cs
+			WHERE cs.channel_id = ch.id
+		) AS user_ids
+	FROM channels ch;
+
 CREATE VIEW applications_with_owner AS
   SELECT
     app.id,
@@ -180,70 +200,41 @@ CREATE FUNCTION create_channel(
 	owner_id BIGINT,
 	name VARCHAR(128),
 	user_ids BIGINT[]
-) RETURNS channels
+) RETURNS SETOF channels_with_users
 AS $$
-DECLARE
-	channel channels;
-	sanitized_user_ids BIGINT[] := '{}';
-	i BIGINT;
 BEGIN
-	FOREACH i IN ARRAY user_ids
-	LOOP
-		IF i = ANY(sanitized_user_ids) THEN
-			CONTINUE;
-		END IF;
-		IF NOT (SELECT EXISTS(SELECT 1 FROM users WHERE id = i)) THEN
-			CONTINUE;
-		END IF;
-
-		sanitized_user_ids = array_append(sanitized_user_ids, i);
-	END LOOP;
-
-	-- owner id might be included by user
-	IF NOT (owner_id = ANY(sanitized_user_ids)) THEN
-		sanitized_user_ids = array_append(sanitized_user_ids, owner_id);
-	END IF;
-
 	INSERT INTO channels (
 		id,
 		owner_id,
-		name,
-		user_ids
+		name
 	) VALUES (
 		channel_id,
 		owner_id,
-		name,
-		sanitized_user_ids
-	) RETURNING * INTO channel;
-
-	FOREACH i IN ARRAY sanitized_user_ids
-	LOOP
-		UPDATE users SET channel_ids = array_append(channel_ids, channel_id) WHERE id = i;
-		IF i = owner_id THEN
-			INSERT INTO channel_settings (
-				channel_id,
-				user_id,
-				permissions
-			) VALUES (
-				channel_id,
-				i,
-				65535::bit(16)
-			);
-		ELSE
-			INSERT INTO channel_settings (
-				channel_id,
-				user_id
-			) VALUES (
-				channel_id,
-				i
-			);
-		END IF;
-	END LOOP;
-
-	RETURN channel;
+		name
+	);
+
+	INSERT INTO channel_settings (
+		channel_id,
+		user_id,
+		permissions
+	) VALUES (
+		channel_id,
+		owner_id,
+		65535::bit(16)
+	);
+
+	-- missing and duplicate users are skipped, owner might be included
+	INSERT INTO channel_settings (channel_id, user_id)
+		SELECT channel_id, usr.id
+		FROM users usr
+		WHERE usr.id = ANY(user_ids) AND usr.id != owner_id;
+
+	RETURN QUERY SELECT * FROM channels_with_users WHERE id = channel_id;
 END;
 $$ LANGUAGE plpgsql;
 
+-- messages are also inserted in batches by create_messages statement
+-- (iomirea/db/queries.py), keep them in sync
 -- Warning: function does not perform access checks
 CREATE FUNCTION create_message(
 	mid BIGINT,
@@ -304,57 +295,36 @@ $$ LANGUAGE plpgsql;
 
 CREATE FUNCTION add_channel_user(cid BIGINT, uid BIGINT) RETURNS BOOL
 AS $success$
-DECLARE user_channels BIGINT[];
 BEGIN
-        SELECT channel_ids INTO user_channels FROM users WHERE id = uid;
-
-        IF user_channels IS NULL THEN
-                RAISE EXCEPTION 'Not such user: %', uid;
-                RETURN false;
-        END IF;
-
-        IF cid = ANY(user_channels) THEN
-                RETURN false;
-        END IF;
+	IF NOT (SELECT exists(SELECT 1 FROM users WHERE id = uid)) THEN
+		RAISE EXCEPTION 'Not such user: %', uid;
+	END IF;
 
-        IF NOT (SELECT exists(SELECT 1 FROM channels WHERE id = cid)) THEN
-                RAISE EXCEPTION 'No such channel: %', cid;
-                RETURN false;
-        END IF;
+	IF NOT (SELECT exists(SELECT 1 FROM channels WHERE id = cid)) THEN
+		RAISE EXCEPTION 'No such channel: %', cid;
+	END IF;
 
-        UPDATE users SET channel_ids = array_append(channel_ids, cid) WHERE id = uid;
-        UPDATE channels SET user_ids = array_append(user_ids, uid) WHERE id = cid;
-	INSERT INTO channel_settings (channel_id, user_id) VALUES (cid, uid);
+	INSERT INTO channel_settings (channel_id, user_id) VALUES (cid, uid)
+	ON CONFLICT (user_id, channel_id) DO NOTHING;
 
-        RETURN true;
+	RETURN FOUND;
 END;
 $success$ LANGUAGE plpgsql;
 
 CREATE FUNCTION remove_channel_user(cid BIGINT, uid BIGINT) RETURNS BOOL
 AS $success$
-DECLARE user_channels BIGINT[];
 BEGIN
-        SELECT channel_ids INTO user_channels FROM users WHERE id = uid;
-
-        IF user_channels IS NULL THEN
-                RAISE EXCEPTION 'Not such user: %', uid;
-                RETURN false;
-        END IF;
-
-        IF NOT(cid = ANY(user_channels)) THEN
-                RETURN false;
-        END IF;
+	IF NOT (SELECT exists(SELECT 1 FROM users WHERE id = uid)) THEN
+		RAISE EXCEPTION 'Not such user: %', uid;
+	END IF;
 
-        IF NOT (SELECT exists(SELECT 1 FROM channels WHERE id = cid)) THEN
-                RAISE EXCEPTION 'No such channel: %', cid;
-                RETURN false;
-        END IF;
+	IF NOT (SELECT exists(SELECT 1 FROM channels WHERE id = cid)) THEN
+		RAISE EXCEPTION 'No such channel: %', cid;
+	END IF;
 
-        UPDATE users SET channel_ids = array_remove(channel_ids, cid) WHERE id = uid;
-        UPDATE channels SET user_ids = array_remove(user_ids, uid) WHERE id = cid;
 	DELETE FROM channel_settings WHERE channel_id = cid AND user_id = uid;
 
-        RETURN true;
+	RETURN FOUND;
 END;
 $success$ LANGUAGE plpgsql;
 